@@ -5,20 +5,47 @@ import requests
 import json
 import random
 import web3
+import threading
+import asyncio
+import itertools
+import logging
+import uuid
+from collections import OrderedDict
 
 # Add the project root to the Python path
 project_root = Path(__file__).resolve().parent.parent
 sys.path.append(str(project_root))
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from typing import Any, Dict, List, Optional
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Body, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-import pandas as pd
-import joblib
-from app.models.fraud_model import process_data, train_model, predict_fraud_probability
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, ValidationError
+import numpy as np
+from app.models.fraud_model import predict_fraud_probability, predict_fraud_probabilities
+from app.models.bundle import BundleError, current_version, save_bundle
+from app.models.engines import count_trees
+from app.models.feedback import apply_feedback, FeedbackUnsupported
+from app.models.velocity import NO_HISTORY, VelocityWindow, transaction_time
+from app.models.registry import ModelRegistry, check_user_id
+from app.models.training_jobs import TrainingJobs
+from app.utils.ledger import LedgerWriter, LedgerBusy
+from app.utils.address_book import AddressBook
+from app.utils.ledger_index import LedgerIndex, format_record
+from app.utils.ledger_reader import LedgerReader, make_session
+from app.utils.log_queue import start_logging
+from app.utils.metrics import Gauge, RequestMetrics, render as render_metrics, span
+from app.utils.api import (get_verdict_cache, check_company_legitimacy, start_verification_queue,
+                           stop_verification_queue, add_verdict_listener)
 import os
 from web3 import Web3
 
+# Logged messages are written out by a background thread, handlers never wait on stdout
+logger = logging.getLogger(__name__)
+start_logging(os.getenv("LOG_LEVEL", "INFO"))
+# httpx logs every request the ledger writer makes at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
 app = FastAPI()
 
 app.add_middleware(
@@ -28,6 +55,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Times every request for /metrics
+app.add_middleware(RequestMetrics)
 
 class Transaction(BaseModel):
     DateTime: str
@@ -37,127 +66,469 @@ class Transaction(BaseModel):
     Zip: int
     Balance: float
 
-# Global variables related to model
-user_details = None
-model = None
-scaler = None
-X = None
-usual_hour = None
-hour_tolerance = None
-usual_locations = None
-amount_stats = None
-transaction_counter = 1
-
-# Company-Address Mapping
+class FeedbackLabel(BaseModel):
+    # A transaction scored by /predict, by its ID, or the transaction itself
+    transaction_id: Optional[int] = None
+    transaction: Optional[Transaction] = None
+    fraud: bool
+
+# Every user has their own model, saved under models/<user_id>. Everything related
+# to a model lives in one ModelState that's replaced as a whole, handlers take a
+# reference once and use it for the whole request
+model_dir = os.getenv("MODEL_DIR", os.path.join(project_root, 'models'))
+model_cache_bytes = int(os.getenv("MODEL_CACHE_BYTES", str(2 * 1024 ** 3)))
+default_user_id = "default"
+fraud_threshold = 0.57
+
+# Models score with live behavioral profiles that learn from every transaction
+# scored as legitimate. Each worker merges what it has seen into the profile file
+# the workers serving the same model share every PROFILE_SYNC_SECONDS, along with
+# what the models dropped from memory since the last time had seen
+profile_sync_seconds = float(os.getenv("PROFILE_SYNC_SECONDS", "5"))
+profile_sync_task = None
+released_profiles = []
+released_profiles_lock = threading.Lock()
+
+def sync_profile(user_id, state):
+    if state.profile is not None and state.profile.pending:
+        state.profile.sync()
+
+def release_profile(user_id, state):
+    # Models are dropped while a request is waiting on model_registry, so the sync
+    # (a file lock, a read and a write) is left to the background task
+    if state.profile is not None and state.profile.pending:
+        with released_profiles_lock:
+            released_profiles.append((user_id, state))
+
+model_registry = ModelRegistry(model_dir, max_bytes=model_cache_bytes, on_evict=release_profile)
+
+# Every transaction a user makes goes into their velocity window, fraud included,
+# bursts of card testing are what the velocity features are there to catch. The
+# windows live in this worker only and start empty after a restart, the least
+# recently active users' are dropped beyond VELOCITY_USERS
+max_velocity_users = int(os.getenv("VELOCITY_USERS", "100000"))
+velocity_windows = OrderedDict()
+velocity_lock = threading.Lock()
+
+# Transaction IDs are handed out under a lock so concurrent requests never share one
+transaction_ids = itertools.count(1)
+transaction_id_lock = threading.Lock()
+
+# Transactions are recorded on the ledger in the background, scoring doesn't wait on it
+ledger_writer = LedgerWriter(
+    os.getenv("LEDGER_URL", "http://localhost:3001"),
+    batch_size=int(os.getenv("LEDGER_BATCH_SIZE", "20")),
+    max_pending=int(os.getenv("LEDGER_MAX_PENDING", "10000")),
+    workers=int(os.getenv("LEDGER_WORKERS", "1")),
+    spool_path=os.getenv("LEDGER_SPOOL")
+)
+# The loop the writer runs on, for records submitted from other threads
+ledger_loop = None
+
+# Training runs in worker processes, the API keeps serving the current models meanwhile
+training_jobs = TrainingJobs(max_workers=int(os.getenv("TRAINING_WORKERS", "1")))
+upload_chunk_size = 1024 * 1024
+
+# Transactions scored while their merchant was still being verified, kept so they
+# can be re-scored once the verdict is in. Their ledger records wait with them,
+# a record can't be corrected once it's on the ledger
+rescore_webhook_url = os.getenv("RESCORE_WEBHOOK_URL")
+max_provisional_transactions = 10000
+provisional_transactions = OrderedDict()
+rescored_transactions = OrderedDict()
+provisional_lock = threading.Lock()
+
+# Recently scored transactions, so feedback can label them by ID
+max_scored_transactions = int(os.getenv("SCORED_CACHE_SIZE", "20000"))
+scored_transactions = OrderedDict()
+scored_lock = threading.Lock()
+
+# Labeled feedback updates a user's model in place of a full retrain. Updates to
+# one user's model are made one at a time
+feedback_window = int(os.getenv("FEEDBACK_WINDOW", "5000"))
+feedback_refresh_rows = int(os.getenv("FEEDBACK_REFRESH_ROWS", "200"))
+feedback_trees = int(os.getenv("FEEDBACK_TREES", "10"))
+feedback_locks = {}
+feedback_locks_lock = threading.Lock()
+
+# Local index of the records on the contract, and a reader for the ones it doesn't
+# have yet, set up once the chain is connected
+ledger_index = None
+ledger_reader = None
+ledger_index_path = os.getenv("LEDGER_INDEX_PATH", os.path.join(project_root, 'data', 'ledger_index.db'))
+
+# Company-Address Mapping, an append-only log. The old JSON map is imported into it
+# the first time it's opened
+company_address_log_file = 'company_addresses.jsonl'
 company_address_map_file = 'company_address_map.json'
-company_address_map = {}
+address_book = None
 
 # Load Ethereum addresses from ethereum_addresses.txt
 ethereum_addresses_file = '../ethereum_addresses.txt'
 ethereum_addresses = []
 
-# Pointer to the next available Ethereum address
-address_pointer = 0
-
 def load_ethereum_addresses():
     global ethereum_addresses
     if not os.path.exists(ethereum_addresses_file):
-        print(f"Error: {ethereum_addresses_file} not found.")
+        logger.error("%s not found", ethereum_addresses_file)
         sys.exit(1)
     with open(ethereum_addresses_file, 'r') as f:
         ethereum_addresses = [line.strip() for line in f if line.strip()]
-    print(f"Loaded {len(ethereum_addresses)} Ethereum addresses.")
+    logger.info("Loaded %d Ethereum addresses", len(ethereum_addresses))
 
 def load_company_address_map():
-    global company_address_map
-    if os.path.exists(company_address_map_file):
-        with open(company_address_map_file, 'r') as f:
-            company_address_map = json.load(f)
-        print(f"Loaded company-address mappings for {len(company_address_map)} companies.")
-    else:
-        company_address_map = {}
-        print("No existing company-address map found. Starting fresh.")
-
-def save_company_address_map():
-    with open(company_address_map_file, 'w') as f:
-        json.dump(company_address_map, f, indent=4)
-    print("Company-address mappings saved.")
+    global address_book
+    address_book = AddressBook(company_address_log_file, ethereum_addresses, legacy_map_path=company_address_map_file)
+    logger.info("Loaded company-address mappings for %d companies", len(address_book))
 
 def get_sender_address(company_name):
-    global address_pointer
-    # Check if the company already has an assigned address
-    if company_name in company_address_map:
-        return company_address_map[company_name]
-    else:
-        # Assign the next available address
-        if address_pointer >= len(ethereum_addresses):
-            raise Exception("No more Ethereum addresses available to assign.")
-        assigned_address = ethereum_addresses[address_pointer]
-        address_pointer += 1
-        company_address_map[company_name] = assigned_address
-        save_company_address_map()
-        return assigned_address
+    # Companies keep the address they were first given, new ones take the next free one
+    return address_book.get(company_name)
+
+def remember_provisional(transaction_id, user_id, transaction_dict, velocity, record):
+    dropped = []
+    with provisional_lock:
+        provisional_transactions[transaction_id] = (user_id, transaction_dict, velocity, record)
+        while len(provisional_transactions) > max_provisional_transactions:
+            dropped.append(provisional_transactions.popitem(last=False)[1][3])
+    # Too many waiting on verdicts, the oldest are recorded as they were scored rather than lost
+    for oldest in dropped:
+        logger.warning("Recording transaction %s before its merchant was verified", oldest["transactionId"])
+        submit_later(oldest)
+
+def submit_later(record):
+    # Ledger records from outside a request, re-scores from the verification worker
+    # included, are put on the ledger writer's queue on the event loop
+    if ledger_loop is None or ledger_loop.is_closed():
+        logger.error("Ledger writer isn't running, transaction %s not recorded", record["transactionId"])
+        return
+    future = asyncio.run_coroutine_threadsafe(ledger_writer.submit(record), ledger_loop)
+
+    def done(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Error recording transaction %s: %s", record["transactionId"], future.exception())
+    future.add_done_callback(done)
+
+def remember_scored(transaction_id, user_id, transaction_dict, velocity):
+    with scored_lock:
+        scored_transactions[transaction_id] = (user_id, transaction_dict, velocity)
+        while len(scored_transactions) > max_scored_transactions:
+            scored_transactions.popitem(last=False)
+
+def get_velocity_window(user_id):
+    with velocity_lock:
+        window = velocity_windows.get(user_id)
+        if window is None:
+            window = velocity_windows[user_id] = VelocityWindow()
+            while len(velocity_windows) > max_velocity_users:
+                velocity_windows.popitem(last=False)
+        else:
+            velocity_windows.move_to_end(user_id)
+        return window
+
+def peek_velocity(user_id, transaction_dict):
+    # The velocity features a transaction is scored with, without counting it yet
+    return get_velocity_window(user_id).peek(transaction_time(transaction_dict))
+
+def observe_velocity(user_id, transaction_dict):
+    # The velocity features a transaction is scored with, counted before it's added
+    return get_velocity_window(user_id).observe(
+        transaction_time(transaction_dict), transaction_dict['Amount'], transaction_dict['Name']
+    )
+
+def get_feedback_lock(user_id):
+    with feedback_locks_lock:
+        return feedback_locks.setdefault(user_id, threading.Lock())
+
+def rescore_transaction(transaction_id):
+    with provisional_lock:
+        provisional = provisional_transactions.get(transaction_id)
+        if provisional is None:
+            return rescored_transactions.get(transaction_id)
+
+    # Re-scored with the velocity features it had when it came in, not the window as it is now
+    user_id, transaction_dict, velocity, record = provisional
+    state = model_registry.get(user_id)
+    if state is None:
+        return None
+    company_verdict = check_company_legitimacy(transaction_dict['Name'])
+    probability = score_transaction(state, transaction_dict, company_verdict, velocity)
+    result = {
+        "transaction_id": transaction_id,
+        "user_id": user_id,
+        "fraud_probability": probability,
+        "provisional": company_verdict == 'Pending'
+    }
+
+    if not result["provisional"]:
+        with provisional_lock:
+            final = provisional_transactions.pop(transaction_id, None) is not None
+            rescored_transactions[transaction_id] = result
+            while len(rescored_transactions) > max_provisional_transactions:
+                rescored_transactions.popitem(last=False)
+        # Only whoever took it off the list records it, it's re-scored from more than one place
+        if final:
+            is_fraud = 1 if probability > fraud_threshold else 0
+            submit_later(dict(record, isFraudulent=is_fraud))
+            if not is_fraud:
+                observe_transactions(state, [transaction_dict])
+    return result
+
+def rescore_provisional(name_upper, verdict):
+    '''
+    Called from the verification worker once a merchant has its verdict. Re-scores
+    every transaction that was waiting on it and posts the new score to the webhook
+    '''
+    with provisional_lock:
+        waiting = [tid for tid, (_, t, _, _) in provisional_transactions.items() if t['Name'].upper() == name_upper]
+
+    for transaction_id in waiting:
+        result = rescore_transaction(transaction_id)
+        if result is None or not rescore_webhook_url:
+            continue
+        try:
+            requests.post(rescore_webhook_url, json=dict(result, merchant=name_upper, verdict=verdict), timeout=5)
+        except requests.exceptions.RequestException as e:
+            logger.error("Error posting re-score for transaction %s: %s", transaction_id, e)
+
+def score_transaction(state, transaction_dict, company_verdict=None, velocity=None):
+    return predict_fraud_probability(
+        dict(transaction_dict), None, state.scorer, state.scaler, state.user_details,
+        state.usual_hour, state.hour_tolerance, state.usual_locations, state.amount_stats,
+        state.encoder, company_verdict, velocity=velocity
+    )
+
+def observe_transactions(state, transactions):
+    # Only what's been scored as legitimate is taken as the user's habits
+    if state.profile is None:
+        return
+    for transaction_dict in transactions:
+        state.profile.add_transaction(transaction_dict)
+
+def sync_profiles():
+    with released_profiles_lock:
+        released = released_profiles[:]
+        del released_profiles[:]
+    for user_id, state in released + model_registry.resident():
+        try:
+            sync_profile(user_id, state)
+        except Exception as e:
+            logger.error("Error syncing behavioral profile for user %s: %s", user_id, e)
+
+async def run_profile_sync():
+    while True:
+        await asyncio.sleep(profile_sync_seconds)
+        await asyncio.to_thread(sync_profiles)
+
+def next_transaction_id():
+    with transaction_id_lock:
+        return next(transaction_ids)
+
+def get_model_state(user_id):
+    try:
+        state = model_registry.get(user_id)
+    except (ValueError, BundleError) as e:
+        raise model_state_error(user_id, e)
+    return check_model_state(state)
+
+async def get_model_state_async(user_id):
+    # For async handlers, a model that isn't in memory yet is loaded off the event loop
+    try:
+        state = await model_registry.get_async(user_id)
+    except (ValueError, BundleError) as e:
+        raise model_state_error(user_id, e)
+    return check_model_state(state)
+
+def model_state_error(user_id, e):
+    if isinstance(e, BundleError):
+        logger.error("Could not load model for user %s: %s", user_id, e)
+        return HTTPException(status_code=500, detail="Saved model could not be loaded. Please train the model again.")
+    return HTTPException(status_code=400, detail=str(e))
+
+def check_model_state(state):
+    if state is None:
+        raise HTTPException(status_code=400, detail="Model not trained. Please train the model first.")
+    return state
+
+def swap_trained_model(user_id, version):
+    '''
+    Called when a training job has saved a user's bundle. Versions sort by when
+    they were saved, so a job that finishes late never replaces a newer model
+    '''
+    # The bundle's checksums are checked the first time it's loaded after being saved
+    state = model_registry.load(user_id, version, verify=True)
+    logger.info("Model bundle %s in use for user %s", state.version, user_id)
 
 # Initialize on startup
 load_ethereum_addresses()
 load_company_address_map()
 
+@app.on_event("startup")
+def warm_start_model():
+    # Other users' models are loaded the first time they're needed
+    try:
+        state = model_registry.get(default_user_id)
+    except BundleError as e:
+        logger.error("Could not load saved model, train a new one: %s", e)
+        return
+    # Scores a blank row so the first request doesn't wait on the forest kernel being compiled
+    if state is not None:
+        state.scorer.predict_proba(np.zeros((1, len(state.columns))))
+
+@app.on_event("startup")
+def start_merchant_verification():
+    add_verdict_listener(rescore_provisional)
+    start_verification_queue()
+
+@app.on_event("shutdown")
+def stop_merchant_verification():
+    stop_verification_queue()
+
+@app.on_event("shutdown")
+def stop_training_jobs():
+    training_jobs.shutdown(wait=False)
+
+@app.on_event("startup")
+async def start_profile_sync():
+    global profile_sync_task
+    profile_sync_task = asyncio.create_task(run_profile_sync())
+
+@app.on_event("shutdown")
+async def stop_profile_sync():
+    if profile_sync_task is not None:
+        profile_sync_task.cancel()
+    await asyncio.to_thread(sync_profiles)
+
+@app.on_event("startup")
+async def start_ledger_writer():
+    global ledger_loop
+    ledger_loop = asyncio.get_running_loop()
+    await ledger_writer.start()
+
+@app.on_event("shutdown")
+async def stop_ledger_writer():
+    # Transactions still waiting on a verdict are recorded as they were scored rather than lost
+    with provisional_lock:
+        waiting = [entry[3] for entry in provisional_transactions.values()]
+        provisional_transactions.clear()
+    if waiting:
+        logger.warning("Recording %d transactions whose merchants weren't verified yet", len(waiting))
+    for record in waiting:
+        try:
+            await ledger_writer.submit(record)
+        except LedgerBusy as e:
+            logger.error("Error recording transaction %s: %s", record["transactionId"], e)
+    await ledger_writer.stop()
+
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
 @app.post("/train")
-async def train_model_endpoint(file: UploadFile = File(None)):
-    global model, X, user_details, scaler, usual_hour, hour_tolerance, usual_locations, amount_stats
-    
+async def train_model_endpoint(
+    file: UploadFile = File(None),
+    user_id: str = Form(default_user_id),
+    name: str = Form('Alexander Hamilton'),
+    credit_score: int = Form(650),
+    age: int = Form(35),
+    select_model: bool = Form(False)
+):
+    try:
+        check_user_id(user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     if file:
-        file_location = f"data/{file.filename}"
+        # Copied to disk a chunk at a time, the upload is never held in memory whole
+        file_location = os.path.join("data", "uploads", user_id, os.path.basename(file.filename or "transactions.csv"))
         os.makedirs(os.path.dirname(file_location), exist_ok=True)
-        with open(file_location, "wb+") as file_object:
-            file_object.write(file.file.read())
+        tmp_location = f"{file_location}.{uuid.uuid4().hex[:8]}.part"
+        try:
+            with open(tmp_location, "wb") as file_object:
+                while chunk := await file.read(upload_chunk_size):
+                    file_object.write(chunk)
+            os.replace(tmp_location, file_location)
+        finally:
+            if os.path.exists(tmp_location):
+                os.remove(tmp_location)
     else:
         file_location = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'transactions.csv')
         if not os.path.exists(file_location):
             raise HTTPException(status_code=404, detail="File is not found")
 
-    data = pd.read_csv(file_location)
     user_details = {
-        'Name': 'Alexander Hamilton',
-        'credit_score': 650,
-        'age': 35
+        'Name': name,
+        'credit_score': credit_score,
+        'age': age
     }
-    X, y, usual_hour, hour_tolerance, usual_locations, amount_stats = process_data(data, user_details)
-    model, scaler, _, _ = train_model(X, y)
 
-    return {"message": "Your own personal model has been trained to your habits!"}
+    # The model is trained in another process and swapped in once its bundle is saved
+    job_id = training_jobs.submit(
+        os.path.abspath(file_location), user_details, model_registry.user_dir(user_id),
+        on_done=lambda version: swap_trained_model(user_id, version), user_id=user_id, select=select_model
+    )
 
-@app.post("/predict")
-async def predict(transaction: Transaction):
-    global model, scaler, usual_hour, hour_tolerance, usual_locations, amount_stats, transaction_counter
+    return {"message": "Your model is being trained on your habits.", "job_id": job_id}
 
-    print(transaction)
+@app.get("/train/{job_id}")
+async def training_status(job_id: str):
+    job = training_jobs.status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No such training job")
+    if job["status"] == "done":
+        job["message"] = "Your own personal model has been trained to your habits!"
+    return job
 
-    if model is None:
-        raise HTTPException(status_code=400, detail="Model not trained. Please train the model first.")
+@app.post("/model/reload")
+async def reload_model(user_id: str = default_user_id):
+    try:
+        state = await asyncio.to_thread(model_registry.load, user_id, verify=True)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except BundleError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if state is None:
+        raise HTTPException(status_code=404, detail="No saved model to load")
+    return {"user_id": user_id, "version": state.version}
+
+@app.get("/model/registry/stats")
+async def model_registry_stats():
+    return model_registry.stats()
+
+@app.post("/predict")
+async def predict(transaction: Transaction, user_id: str = default_user_id):
+    logger.debug("Scoring %s", transaction)
+
+    state = await get_model_state_async(user_id)
 
     transaction_dict = transaction.model_dump()
 
-    probability = predict_fraud_probability(
-        transaction_dict, X, model, scaler, user_details,
-        usual_hour, hour_tolerance, usual_locations, amount_stats
-    )
+    # Unknown merchants are verified in the background, the score is provisional until then
+    company_verdict = check_company_legitimacy(transaction.Name)
+    provisional = company_verdict == 'Pending'
+
+    # Only read here, the transaction is added to the window once it's been accepted,
+    # so a request that fails and is retried isn't counted twice
+    try:
+        with span('velocity'):
+            velocity = peek_velocity(user_id, transaction_dict)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid DateTime: {e}")
+    probability = score_transaction(state, transaction_dict, company_verdict, velocity)
 
-    is_fraud = 1 if probability > 0.57 else 0
+    is_fraud = 1 if probability > fraud_threshold else 0
 
     # Assign sender address based on company name
     try:
-        sender = get_sender_address(transaction.Name)
+        with span('address'):
+            sender = get_sender_address(transaction.Name)
     except Exception as e:
-        print(f"Error assigning sender address: {e}")
+        logger.error("Error assigning sender address: %s", e)
         raise HTTPException(status_code=500, detail="No available Ethereum addresses to assign.")
 
+    transaction_id = next_transaction_id()
     transaction_data = {
-        "transactionId": transaction_counter,
+        "transactionId": transaction_id,
         "companyId": transaction.Name,
         "senderAddress": sender,
         "receiver": "0x008Ef933C66726e1e7ecBD060919147ee5Fc5844",
@@ -165,34 +536,231 @@ async def predict(transaction: Transaction):
         "amount": transaction.Amount,
         "timestamp": transaction.DateTime
     }
-    json_data = json.dumps(transaction_data)
 
-    try:
-        response = requests.post(
-            "http://localhost:3001/record-transaction",
-            data=json_data,
-            headers = {
-                "Content-Type": "application/json"
-            }
-        )
-    except requests.exceptions.RequestException as e:
-        print(f"Error connecting to backend: {e}")
-        raise HTTPException(status_code=500, detail="Backend service is unavailable.")
-
-    if response.status_code == 200:
-        print("It's public on the blockchain!")
-        print("Response:", response.json())
+    if provisional:
+        # Goes on the ledger once it's been re-scored with the merchant's verdict.
+        # Registered before anything is awaited, so a verdict delivered meanwhile finds it
+        remember_provisional(transaction_id, user_id, transaction_dict, velocity, transaction_data)
     else:
-        print(f"Failed to record transaction: {response.status_code} - {response.text}")
-        raise HTTPException(
-            status_code=response.status_code,
-            detail="Failed to record transaction on blockchain."
-        )
+        try:
+            with span('ledger_submit'):
+                await ledger_writer.submit(transaction_data)
+        except LedgerBusy as e:
+            logger.warning("Ledger queue is full: %s", e)
+            raise HTTPException(status_code=503, detail="Too many transactions waiting for the ledger, try again shortly.")
+
+    observe_velocity(user_id, transaction_dict)
+    remember_scored(transaction_id, user_id, transaction_dict, velocity)
+    if not is_fraud:
+        observe_transactions(state, [transaction_dict])
+    if provisional:
+        # A verdict that came in between the check and the registration above
+        # missed it, the cache has it first, so it's re-scored here instead
+        name_upper = transaction.Name.upper()
+        verdict = get_verdict_cache().get(name_upper)
+        if verdict is not None:
+            asyncio.get_running_loop().run_in_executor(None, rescore_provisional, name_upper, verdict)
+
+    return {"fraud_probability": probability, "transaction_id": transaction_id, "provisional": provisional}
+
+@app.get("/predict/{transaction_id}/rescore")
+async def rescore(transaction_id: int):
+    # Re-scoring may have to load the user's model, which isn't done on the event loop
+    result = await asyncio.to_thread(rescore_transaction, transaction_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="No provisional score for this transaction")
+    return result
+
+@app.post("/predict/batch")
+async def predict_batch(transactions: List[Dict[str, Any]] = Body(...), user_id: str = default_user_id):
+    state = await get_model_state_async(user_id)
+
+    # Validate each transaction on its own so a bad row only fails itself
+    results = [None] * len(transactions)
+    valid_rows = []
+    valid_transactions = []
+    for i, item in enumerate(transactions):
+        try:
+            valid_transactions.append(Transaction.model_validate(item).model_dump())
+            valid_rows.append(i)
+        except ValidationError as e:
+            results[i] = {"index": i, "error": str(e)}
+
+    # Counted in the order they were sent, so each one counts the ones before it, on
+    # a copy of the window. As in /predict only the ones that are accepted are added
+    # to the user's window, so a batch that's sent again isn't counted twice. A
+    # DateTime that can't be read is reported by the scoring below
+    scratch = get_velocity_window(user_id).copy()
+    velocity = []
+    with span('velocity'):
+        for transaction_dict in valid_transactions:
+            try:
+                velocity.append(scratch.observe(transaction_time(transaction_dict), transaction_dict['Amount'],
+                                                transaction_dict['Name']))
+            except ValueError:
+                velocity.append(NO_HISTORY)
+
+    probabilities, verdicts = predict_fraud_probabilities(
+        valid_transactions, None, state.scorer, state.scaler, state.user_details,
+        state.usual_hour, state.hour_tolerance, state.usual_locations, state.amount_stats, state.encoder,
+        velocity=velocity
+    )
 
-    transaction_counter += 1
+    legit = []
+    pending = set()
+    ledger_busy = None
+    for i, transaction_dict, features, probability, verdict in zip(
+            valid_rows, valid_transactions, velocity, probabilities, verdicts):
+        if isinstance(probability, Exception):
+            results[i] = {"index": i, "error": str(probability)}
+            continue
+        provisional = verdict == 'Pending'
+        is_fraud = 1 if probability > fraud_threshold else 0
+
+        # Each accepted transaction goes through what /predict does with it
+        try:
+            with span('address'):
+                sender = get_sender_address(transaction_dict['Name'])
+        except Exception as e:
+            logger.error("Error assigning sender address: %s", e)
+            results[i] = {"index": i, "error": "No available Ethereum addresses to assign."}
+            continue
+
+        transaction_id = next_transaction_id()
+        transaction_data = {
+            "transactionId": transaction_id,
+            "companyId": transaction_dict['Name'],
+            "senderAddress": sender,
+            "receiver": "0x008Ef933C66726e1e7ecBD060919147ee5Fc5844",
+            "isFraudulent": is_fraud,
+            "amount": transaction_dict['Amount'],
+            "timestamp": transaction_dict['DateTime']
+        }
 
-    return {"fraud_probability": probability}
+        if provisional:
+            remember_provisional(transaction_id, user_id, transaction_dict, features, transaction_data)
+            pending.add(transaction_dict['Name'].upper())
+        else:
+            # Once the queue is full the rest of the batch isn't made to wait on it too
+            if ledger_busy is None:
+                try:
+                    with span('ledger_submit'):
+                        await ledger_writer.submit(transaction_data)
+                except LedgerBusy as e:
+                    logger.warning("Ledger queue is full: %s", e)
+                    ledger_busy = e
+            if ledger_busy is not None:
+                results[i] = {"index": i, "error": "Too many transactions waiting for the ledger, try again shortly."}
+                continue
+
+        observe_velocity(user_id, transaction_dict)
+        remember_scored(transaction_id, user_id, transaction_dict, features)
+        results[i] = {"index": i, "fraud_probability": probability, "transaction_id": transaction_id,
+                      "provisional": provisional}
+        if not provisional and not is_fraud:
+            legit.append(transaction_dict)
+    observe_transactions(state, legit)
+
+    # As in /predict, verdicts that came in before these were registered
+    for name_upper in pending:
+        verdict = get_verdict_cache().get(name_upper)
+        if verdict is not None:
+            asyncio.get_running_loop().run_in_executor(None, rescore_provisional, name_upper, verdict)
+
+    return {"results": results}
+
+@app.post("/feedback")
+def feedback(labels: List[Dict[str, Any]] = Body(...), user_id: str = default_user_id):
+    # A plain def, so the tree refresh runs in the threadpool instead of holding up the event loop
+    results = [None] * len(labels)
+    transactions = []
+    fraud = []
+    velocity = []
+    for i, item in enumerate(labels):
+        try:
+            label = FeedbackLabel.model_validate(item)
+        except ValidationError as e:
+            results[i] = {"index": i, "error": str(e)}
+            continue
+
+        if label.transaction is not None:
+            transaction_dict = label.transaction.model_dump()
+            features = None
+        elif label.transaction_id is None:
+            results[i] = {"index": i, "error": "Either transaction_id or transaction is needed"}
+            continue
+        else:
+            with scored_lock:
+                scored = scored_transactions.get(label.transaction_id)
+            if scored is None or scored[0] != user_id:
+                results[i] = {"index": i, "error": "No recently scored transaction with this ID, send the transaction itself"}
+                continue
+            _, transaction_dict, features = scored
+
+        try:
+            time = transaction_time(transaction_dict)
+        except ValueError as e:
+            results[i] = {"index": i, "error": str(e)}
+            continue
+        if features is None:
+            # Not one this worker scored, so it's counted against the window as it is now
+            features = get_velocity_window(user_id).peek(time)
+
+        results[i] = {"index": i, "accepted": True}
+        transactions.append(transaction_dict)
+        fraud.append(label.fraud)
+        velocity.append(features)
+
+    if not transactions:
+        return {"user_id": user_id, "accepted": 0, "results": results}
+
+    directory = model_registry.user_dir(user_id)
+    with get_feedback_lock(user_id):
+        state = get_model_state(user_id)
+        if state.version != current_version(directory):
+            state = model_registry.load(user_id)
+        try:
+            new_state, refreshed = apply_feedback(
+                state, transactions, fraud, velocity=velocity, window=feedback_window,
+                refresh_rows=feedback_refresh_rows, trees=feedback_trees
+            )
+        except FeedbackUnsupported as e:
+            raise HTTPException(status_code=409, detail=str(e))
+
+        # A model trained meanwhile wins, the feedback would be applied to the one it replaced
+        if current_version(directory) != state.version:
+            raise HTTPException(status_code=409, detail="The model was retrained meanwhile, send the feedback again.")
+        save_bundle(new_state, directory)
+        state = model_registry.load(user_id, verify=True)
+
+    return {
+        "user_id": user_id,
+        "version": state.version,
+        "accepted": len(transactions),
+        "refreshed": refreshed,
+        "pending": state.feedback["since_refresh"],
+        "trees": count_trees(state.model),
+        "results": results
+    }
+
+@app.get("/ledger/stats")
+async def ledger_stats():
+    return ledger_writer.stats()
+
+@app.get("/verdict-cache/stats")
+async def verdict_cache_stats():
+    return get_verdict_cache().stats()
 
+# Read whenever /metrics is scraped
+Gauge('fraud_api_ledger_pending', 'Ledger records waiting to be sent', lambda: ledger_writer.pending)
+Gauge('fraud_api_velocity_users', 'Users with a velocity window in this worker', lambda: len(velocity_windows))
+Gauge('fraud_api_models_resident', 'Models held in memory', lambda: model_registry.stats()['resident'])
+Gauge('fraud_api_models_bytes', 'Estimated memory held by resident models', lambda: model_registry.stats()['bytes'])
+
+@app.get("/metrics")
+async def metrics():
+    # Counted since this worker started, each worker keeps its own
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 @app.get("/companies/{companyId}")
 async def get_company(companyId: str):
@@ -202,74 +770,86 @@ async def get_company(companyId: str):
             raise HTTPException(status_code=404, detail="Company not found")
         return {"success": True, "company": company}
     except Exception as e:
-        print(e)
+        logger.error("%s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
+def get_ledger_records(ids):
+    '''
+    Records for the given transaction IDs, from the index where it has them and
+    read from the chain in bulk otherwise. IDs with nothing recorded are left out
+    '''
+    records = ledger_index.get_many(ids) if ledger_index is not None else {}
+    missing = [id for id in ids if id not in records]
+    if missing:
+        if ledger_reader is not None:
+            for id, record in ledger_reader.get_many(missing).items():
+                if record is not None:
+                    records[id] = format_record(record)
+        else:
+            for id in missing:
+                record = contract.functions.transactions(id).call()
+                if record[0] != 0:
+                    records[id] = format_record(record)
+    return records
+
 @app.get("/get-transaction/{transactionId}")
 async def get_transaction(transactionId: int):
     try:
-        # Get transaction from smart contract
-        transaction = contract.functions.transactions(transactionId).call()
-
-        # Decode companyId from bytes32 to string if necessary
-        companyId = Web3.toText(transaction[3]).strip('\x00')  # Adjust the index based on struct
-
-        # Format the data
-        transactionData = {
-            "id": transaction[0],
-            "dataHash": transaction[1],
-            "isFraudulent": transaction[2],
-            "companyId": companyId
-        }
-
-        return {"success": True, "transaction": transactionData}
+        # Reading the chain is blocking RPC, it's kept off the event loop
+        transactionData = (await asyncio.to_thread(get_ledger_records, [transactionId])).get(transactionId)
     except Exception as e:
-        print(e)
+        logger.error("%s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
-
-@app.get("/get-all-transactions")
-async def get_all_transactions():
+    if transactionData is None:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    return {"success": True, "transaction": transactionData}
+
+@app.get("/get-transactions")
+async def get_transactions(ids: List[int] = Query(...)):
+    if len(ids) > 10000:
+        raise HTTPException(status_code=400, detail="At most 10000 IDs can be read at once")
     try:
-        transactionCount = contract.functions.transactionCount().call()
-        count = transactionCount
-
-        transactions = []
-
-        for i in range(1, count + 1):
-            transaction = contract.functions.transactions(i).call()
-
-            # Decode companyId from bytes32 to string if necessary
-            companyId = Web3.toText(transaction[3]).strip('\x00')  # Adjust the index based on struct
+        records = await asyncio.to_thread(get_ledger_records, ids)
+    except Exception as e:
+        logger.error("%s", e)
+        raise HTTPException(status_code=500, detail="Internal server error")
+    return {"success": True, "transactions": [records[id] for id in dict.fromkeys(ids) if id in records]}
 
-            transactions.append({
-                "id": transaction[0],
-                "dataHash": transaction[1],
-                "isFraudulent": transaction[2],
-                "companyId": companyId
-            })
+@app.get("/get-all-transactions")
+async def get_all_transactions(offset: int = 0, limit: int = 100, companyId: str = None, isFraudulent: bool = None):
+    if offset < 0 or not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="offset must be 0 or more and limit between 1 and 1000")
+    if ledger_index is None:
+        raise HTTPException(status_code=500, detail="Not connected to the ledger")
 
-        return {"success": True, "transactions": transactions}
+    try:
+        # Only what's new since the last request is read from the chain, off the event loop
+        await asyncio.to_thread(ledger_index.sync)
+        transactions, total = ledger_index.query(companyId, isFraudulent, offset, limit)
+        return {"success": True, "transactions": transactions, "total": total, "offset": offset, "limit": limit}
     except Exception as e:
-        print(e)
+        logger.error("%s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 # MongoDB Connection and Smart Contract Initialization
 def connectDB():
     from pymongo import MongoClient
-    global transactionsCollection, companiesCollection, contract, web3
+    global transactionsCollection, companiesCollection, contract, web3, ledger_index, ledger_reader
     client = MongoClient(os.getenv("MONGODB_URI"))
     db = client['your_database_name']  # Replace with your database name
     transactionsCollection = db['transactions']
     companiesCollection = db['companies']
-    print("Connected to MongoDB")
+    logger.info("Connected to MongoDB")
 
     # Initialize Web3
     NETWORK_URL = os.getenv("NETWORK_URL")
-    web3 = Web3(Web3.HTTPProvider(NETWORK_URL))
-    if not web3.isConnected():
-        print(f"Failed to connect to Ethereum node at {NETWORK_URL}")
+    # One pool of kept-alive connections, shared with the bulk ledger reader
+    session = make_session(int(os.getenv("LEDGER_READ_CONCURRENCY", "4")))
+    web3 = Web3(Web3.HTTPProvider(NETWORK_URL, session=session))
+    if not web3.is_connected():
+        logger.error("Failed to connect to Ethereum node at %s", NETWORK_URL)
         sys.exit(1)
-    print(f"Connected to Ethereum node at {NETWORK_URL}")
+    logger.info("Connected to Ethereum node at %s", NETWORK_URL)
 
     # Load contract ABI
     contract_json_path = Path(__file__).resolve().parent.parent / 'artifacts' / 'contracts' / 'SimpleFraudDetection.sol' / 'SimpleFraudDetection.json'
@@ -283,7 +863,16 @@ def connectDB():
 
     # Contract instance
     contract = web3.eth.contract(address=CONTRACT_ADDRESS, abi=contract_abi)
-    print(f"Connected to smart contract at {CONTRACT_ADDRESS}")
+    logger.info("Connected to smart contract at %s", CONTRACT_ADDRESS)
+
+    ledger_reader = LedgerReader(
+        NETWORK_URL, CONTRACT_ADDRESS, session=session,
+        batch_size=int(os.getenv("LEDGER_READ_BATCH_SIZE", "100")),
+        concurrency=int(os.getenv("LEDGER_READ_CONCURRENCY", "4"))
+    )
+    ledger_index = LedgerIndex(
+        ledger_index_path, contract, web3, start_block=int(os.getenv("LEDGER_START_BLOCK", "0")), reader=ledger_reader
+    )
 
 # Start server
 if __name__ == "__main__":
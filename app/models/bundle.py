@@ -0,0 +1,241 @@
+import calendar
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Any, NamedTuple
+import joblib
+import numpy as np
+import pandas as pd
+from app.models.feature_encoder import FeatureEncoder
+from app.models.forest_engine import compile_model
+from app.models.profile import BehavioralProfile, LiveProfile, LIVE_PROFILE_FILE
+
+# Bump whenever the files in a bundle or what they hold changes
+BUNDLE_SCHEMA_VERSION = 3
+# Older schemas that still load. Version 1 bundles have no profile or feedback, so
+# they score with the stats they were trained with and can't take feedback.
+# Version 2 ones kept exact location counts in history.json
+READABLE_SCHEMA_VERSIONS = (1, 2, 3)
+CURRENT_FILE = 'CURRENT'
+KEEP_BUNDLES = 3
+VERSION_TIME_FORMAT = '%Y%m%d-%H%M%S'
+
+
+class BundleError(Exception):
+    pass
+
+
+class ModelState(NamedTuple):
+    '''
+    Everything needed to score a transaction, swapped in as one object so a
+    request never sees a model paired with another training run's scaler or stats.
+    Transactions are scored with scorer, the model compiled for fast predict_proba
+    calls, model is kept as it was fit for saving and refreshing. report is what
+    select_model measured, if the model was picked by it
+    '''
+    model: Any
+    scaler: Any
+    columns: list
+    user_details: dict
+    usual_hour: int
+    hour_tolerance: float
+    usual_locations: list
+    amount_stats: pd.DataFrame
+    encoder: FeatureEncoder
+    version: str = None
+    profile: Any = None
+    feedback: dict = None
+    scorer: Any = None
+    report: dict = None
+
+    @classmethod
+    def create(cls, model, scaler, columns, user_details, usual_hour, hour_tolerance, usual_locations, amount_stats,
+               version=None, profile=None, feedback=None, report=None):
+        encoder = FeatureEncoder(columns, scaler, user_details, usual_hour, hour_tolerance, usual_locations, amount_stats,
+                                 profile=profile)
+        return cls(model, scaler, list(columns), user_details, usual_hour, hour_tolerance,
+                   list(usual_locations), amount_stats, encoder, version, profile, feedback, compile_model(model), report)
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _new_version(directory):
+    '''
+    A version that sorts after every bundle already in directory. It's the UTC
+    time, so versions keep the order they were saved in across DST changes and a
+    move to another time zone, and a second past the current bundle's if the
+    clock says otherwise (set back, or bundles saved in local time before)
+    '''
+    now = calendar.timegm(time.gmtime())
+    current = current_version(directory)
+    if current is not None:
+        try:
+            now = max(now, calendar.timegm(time.strptime(current[:15], VERSION_TIME_FORMAT)) + 1)
+        except ValueError:
+            pass
+    return time.strftime(VERSION_TIME_FORMAT, time.gmtime(now)) + '-' + uuid.uuid4().hex[:8]
+
+
+def _fsync_write(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def save_bundle(state, directory):
+    '''
+    Writes the model state as a new versioned bundle under directory and points
+    CURRENT at it. The bundle is written to a temporary folder and renamed into
+    place, and CURRENT is replaced atomically, so a reader only ever sees a
+    complete bundle. Returns the new version
+    '''
+    os.makedirs(directory, exist_ok=True)
+    version = _new_version(directory)
+    tmp_path = os.path.join(directory, f'.tmp-{version}')
+    os.makedirs(tmp_path)
+
+    try:
+        # Uncompressed, so the arrays inside can be memory-mapped on load
+        joblib.dump(state.model, os.path.join(tmp_path, 'model.joblib'))
+        joblib.dump(state.scaler, os.path.join(tmp_path, 'scaler.joblib'))
+
+        np.save(os.path.join(tmp_path, 'amount_hours.npy'), state.amount_stats.index.to_numpy(dtype=np.int64))
+        np.save(os.path.join(tmp_path, 'amount_mean.npy'), state.amount_stats['amount_mean'].to_numpy(dtype=np.float64))
+        np.save(os.path.join(tmp_path, 'amount_std.npy'), state.amount_stats['amount_std'].to_numpy(dtype=np.float64))
+
+        metadata = {
+            'columns': list(state.columns),
+            'user_details': state.user_details,
+            'usual_hour': int(state.usual_hour),
+            'hour_tolerance': float(state.hour_tolerance),
+            'usual_locations': list(state.usual_locations),
+        }
+        _fsync_write(os.path.join(tmp_path, 'metadata.json'), json.dumps(metadata, indent=2))
+
+        # The user's behavioral profile and the recent labeled transactions feedback refits trees on
+        if state.profile is not None:
+            _fsync_write(os.path.join(tmp_path, 'profile.json'), json.dumps(state.profile.to_dict()))
+        _fsync_write(os.path.join(tmp_path, 'feedback.json'), json.dumps(state.feedback or {'rows': [], 'since_refresh': 0}))
+        if state.report is not None:
+            _fsync_write(os.path.join(tmp_path, 'selection.json'), json.dumps(state.report, indent=2))
+
+        manifest = {
+            'schema_version': BUNDLE_SCHEMA_VERSION,
+            'version': version,
+            'created_at': time.time(),
+            'files': {name: _sha256(os.path.join(tmp_path, name)) for name in sorted(os.listdir(tmp_path))},
+        }
+        _fsync_write(os.path.join(tmp_path, 'manifest.json'), json.dumps(manifest, indent=2))
+
+        os.rename(tmp_path, os.path.join(directory, version))
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    current_tmp = os.path.join(directory, f'.{CURRENT_FILE}-{version}')
+    _fsync_write(current_tmp, version)
+    os.replace(current_tmp, os.path.join(directory, CURRENT_FILE))
+
+    _prune_bundles(directory, keep=version)
+    return version
+
+
+def _prune_bundles(directory, keep):
+    bundles = sorted(name for name in os.listdir(directory)
+                     if not name.startswith('.') and os.path.isdir(os.path.join(directory, name)))
+    for name in bundles[:-KEEP_BUNDLES]:
+        if name != keep:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def current_version(directory):
+    '''
+    The version CURRENT points at, or None if nothing has been saved yet
+    '''
+    try:
+        with open(os.path.join(directory, CURRENT_FILE), 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_bundle(directory, version=None, verify=False, mmap_mode='r'):
+    '''
+    Loads a bundle (the CURRENT one unless a version is given) back into a
+    ModelState. The schema version is checked, and with verify every file is
+    checked against its checksum. That reads the whole bundle, so it's left to
+    the first load after a save and to explicit reloads, a bundle that doesn't
+    load is reported as a BundleError either way. Arrays are memory-mapped where
+    they can be
+    '''
+    version = version or current_version(directory)
+    if version is None:
+        raise BundleError(f"No model bundle found in {directory}")
+    path = os.path.join(directory, version)
+
+    try:
+        with open(os.path.join(path, 'manifest.json'), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise BundleError(f"Unreadable manifest for bundle {version}: {e}")
+
+    if manifest.get('schema_version') not in READABLE_SCHEMA_VERSIONS:
+        raise BundleError(f"Bundle {version} has schema version {manifest.get('schema_version')}, "
+                          f"expected one of {READABLE_SCHEMA_VERSIONS}")
+
+    if verify:
+        for name, checksum in manifest['files'].items():
+            file_path = os.path.join(path, name)
+            if not os.path.exists(file_path) or _sha256(file_path) != checksum:
+                raise BundleError(f"Checksum mismatch for {name} in bundle {version}")
+
+    try:
+        return _read_bundle(directory, path, version, mmap_mode)
+    except Exception as e:
+        raise BundleError(f"Unreadable bundle {version}: {e}") from e
+
+
+def _read_bundle(directory, path, version, mmap_mode):
+    with open(os.path.join(path, 'metadata.json'), 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+
+    model = joblib.load(os.path.join(path, 'model.joblib'), mmap_mode=mmap_mode)
+    scaler = joblib.load(os.path.join(path, 'scaler.joblib'))
+
+    amount_stats = pd.DataFrame({
+        'amount_mean': np.load(os.path.join(path, 'amount_mean.npy'), mmap_mode=mmap_mode),
+        'amount_std': np.load(os.path.join(path, 'amount_std.npy'), mmap_mode=mmap_mode),
+    }, index=pd.Index(np.load(os.path.join(path, 'amount_hours.npy')), name='Hour'))
+
+    # Served from a live profile, picking up where the workers serving this bundle left it
+    profile = None
+    for name in ('profile.json', 'history.json'):
+        if os.path.exists(os.path.join(path, name)):
+            with open(os.path.join(path, name), 'r', encoding='utf-8') as f:
+                base = BehavioralProfile.from_dict(json.load(f))
+            profile = LiveProfile(base, os.path.join(directory, LIVE_PROFILE_FILE), version)
+            break
+    feedback = None
+    if os.path.exists(os.path.join(path, 'feedback.json')):
+        with open(os.path.join(path, 'feedback.json'), 'r', encoding='utf-8') as f:
+            feedback = json.load(f)
+    report = None
+    if os.path.exists(os.path.join(path, 'selection.json')):
+        with open(os.path.join(path, 'selection.json'), 'r', encoding='utf-8') as f:
+            report = json.load(f)
+
+    return ModelState.create(
+        model, scaler, metadata['columns'], metadata['user_details'], metadata['usual_hour'],
+        metadata['hour_tolerance'], metadata['usual_locations'], amount_stats, version=version,
+        profile=profile, feedback=feedback, report=report
+    )
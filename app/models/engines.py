@@ -0,0 +1,78 @@
+from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
+from sklearn.utils.class_weight import compute_sample_weight
+from threadpoolctl import threadpool_limits
+
+# Past this many rows each tree of the forest is grown on a bootstrap sample of
+# this size rather than of the whole training set
+FOREST_MAX_SAMPLES = 1_000_000
+
+
+class ForestEngine:
+    '''
+    A random forest grown on every core. Fraud is rare, so classes are weighted
+    by how rare they are in each tree's bootstrap sample (balanced_subsample)
+    rather than oversampled, and on big histories each tree only sees a sample of
+    max_samples rows, which keeps the fit time from growing with the history
+    '''
+    name = 'forest'
+
+    def __init__(self, n_estimators=100, max_depth=5, min_samples_leaf=5, max_samples=FOREST_MAX_SAMPLES, n_jobs=-1):
+        self.n_estimators = n_estimators
+        self.max_depth = max_depth
+        self.min_samples_leaf = min_samples_leaf
+        self.max_samples = max_samples
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y):
+        max_samples = self.max_samples if self.max_samples and len(y) > self.max_samples else None
+        model = RandomForestClassifier(n_estimators=self.n_estimators, min_samples_leaf=self.min_samples_leaf,
+                                       max_depth=self.max_depth, class_weight="balanced_subsample",
+                                       max_samples=max_samples, n_jobs=self.n_jobs, random_state=42)
+        model.fit(X, y)
+        # Only the fit is spread over cores, a model scores on the thread that calls it.
+        # The sample size was for this history, trees added later are fit on far fewer rows
+        model.set_params(n_jobs=None, max_samples=None)
+        return model
+
+
+class BoostingEngine:
+    '''
+    Histogram gradient boosting, which bins every feature into at most 255 values
+    once and so fits millions of rows in a fraction of the forest's time. Classes
+    are balanced with sample weights. With early stopping (on for 10000 rows and
+    up) it stops adding trees once a held out tenth of the rows stops improving
+    '''
+    name = 'boosting'
+
+    def __init__(self, max_iter=200, max_depth=6, learning_rate=0.1, min_samples_leaf=20, n_jobs=-1):
+        self.max_iter = max_iter
+        self.max_depth = max_depth
+        self.learning_rate = learning_rate
+        self.min_samples_leaf = min_samples_leaf
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y):
+        model = HistGradientBoostingClassifier(max_iter=self.max_iter, max_depth=self.max_depth,
+                                               learning_rate=self.learning_rate,
+                                               min_samples_leaf=self.min_samples_leaf, random_state=42)
+        sample_weight = compute_sample_weight('balanced', y)
+        # It threads with OpenMP, which only a thread pool limit can hold to n_jobs
+        with threadpool_limits(limits=None if self.n_jobs == -1 else self.n_jobs, user_api='openmp'):
+            model.fit(X, y, sample_weight=sample_weight)
+        return model
+
+
+ENGINES = {engine.name: engine for engine in (ForestEngine, BoostingEngine)}
+
+
+def get_engine(name, **params):
+    if name not in ENGINES:
+        raise ValueError(f"Unknown engine {name!r}, expected one of {', '.join(ENGINES)}")
+    return ENGINES[name](**params)
+
+
+def count_trees(model):
+    # Forests keep their trees in estimators_, boosting models count iterations
+    if hasattr(model, 'estimators_'):
+        return len(model.estimators_)
+    return int(model.n_trees_per_iteration_ * model.n_iter_)
@@ -0,0 +1,183 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from app.models.velocity import NO_HISTORY, VELOCITY_COLUMNS
+from app.utils.metrics import span
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class FeatureEncoder:
+    '''
+    Fitted after training, turns transactions straight into the scaled feature
+    vectors the model expects. Everything that used to be rebuilt with pandas on
+    every request (column order, location one-hots, per-hour amount stats and the
+    StandardScaler) is laid out once here as plain NumPy arrays. Given a
+    BehavioralProfile, the usual hour, usual locations and per-hour amount stats
+    are read from it on every call instead, so they follow the profile as it's
+    updated. Velocity features aren't in the transaction itself, they come from
+    the user's VelocityWindow and are passed in alongside it
+    '''
+
+    def __init__(self, columns, scaler, user_details, usual_hour, hour_tolerance, usual_locations, amount_stats, profile=None):
+        self.columns = list(columns)
+        self.profile = profile
+        self.usual_hour = usual_hour
+        self.hour_tolerance = hour_tolerance
+        self.usual_locations = frozenset(usual_locations)
+
+        index = {col: i for i, col in enumerate(self.columns)}
+        self.amount_idx = index.get('Amount')
+        self.hour_idx = index.get('Hour')
+        self.day_idx = index.get('DayOfWeek')
+        self.zscore_idx = index.get('Amt_To_Hour_Zscore')
+        self.usual_loc_idx = index.get('Usual_Location')
+        self.unusual_time_idx = index.get('Unusual_Time')
+        self.out_of_bounds_idx = index.get('Out_of_bounds')
+        # Models trained before velocity features don't have these columns
+        self.velocity_idx = [index.get(col) for col in VELOCITY_COLUMNS]
+
+        # Where each usual location's one-hot lives in the vector
+        self.location_slots = {}
+        for loc in usual_locations:
+            if f'Location_{loc}' in index:
+                self.location_slots[loc] = index[f'Location_{loc}']
+
+        # Per-hour amount stats, hours we have no stats for fall back on the average over all hours
+        self.amount_mean = np.full(24, amount_stats['amount_mean'].mean())
+        self.amount_std = np.full(24, amount_stats['amount_std'].mean())
+        hours = amount_stats.index.to_numpy()
+        self.amount_mean[hours] = amount_stats['amount_mean'].to_numpy()
+        self.amount_std[hours] = amount_stats['amount_std'].to_numpy()
+
+        # The user's columns never change between transactions, so they're filled in up front
+        self.base = np.zeros(len(self.columns))
+        for col in ('credit_score', 'age'):
+            if col in index:
+                self.base[index[col]] = user_details[col]
+
+        # Fold the scaler in, applied the same way StandardScaler.transform does it
+        self.scale_mean = np.zeros(len(self.columns))
+        self.scale = np.ones(len(self.columns))
+        if scaler is not None:
+            if scaler.with_mean:
+                self.scale_mean = np.asarray(scaler.mean_, dtype=np.float64)
+            if scaler.with_std:
+                self.scale = np.asarray(scaler.scale_, dtype=np.float64)
+
+    @property
+    def n_features(self):
+        return len(self.columns)
+
+    def encode(self, transaction, out=None, velocity=None):
+        '''
+        Encodes a single transaction into a scaled feature vector. Pass a
+        preallocated array as out to skip the allocation, and the transaction's
+        velocity features in VELOCITY_COLUMNS order, without them it's scored as
+        the user's first
+        '''
+        if out is None:
+            out = np.empty(len(self.columns))
+
+        with span('parse_datetime'):
+            date_time = datetime.strptime(transaction['DateTime'], DATETIME_FORMAT)
+
+        with span('build_features'):
+            hour = date_time.hour
+            amount = abs(transaction['Amount'])
+
+            profile = self.profile
+            if profile is not None:
+                usual_loc = profile.is_usual_location(transaction['Location'])
+                unusual_time = abs(hour - profile.usual_hour()) > profile.hour_tolerance()
+                amount_mean, amount_std = profile.hour_amount_stats(hour)
+            else:
+                usual_loc = transaction['Location'] in self.usual_locations
+                unusual_time = abs(hour - self.usual_hour) > self.hour_tolerance
+                amount_mean, amount_std = self.amount_mean[hour], self.amount_std[hour]
+
+            zscore = (amount - amount_mean) / amount_std
+            if zscore > 1e6:
+                zscore = 1e6
+            elif zscore < -1e6:
+                zscore = -1e6
+
+            out[:] = self.base
+            self._put(out, self.amount_idx, amount)
+            self._put(out, self.hour_idx, hour)
+            self._put(out, self.day_idx, date_time.weekday())
+            self._put(out, self.zscore_idx, zscore)
+            self._put(out, self.usual_loc_idx, usual_loc)
+            self._put(out, self.unusual_time_idx, unusual_time)
+            self._put(out, self.out_of_bounds_idx, unusual_time and not usual_loc)
+            for idx, value in zip(self.velocity_idx, NO_HISTORY if velocity is None else velocity):
+                self._put(out, idx, value)
+
+            slot = self.location_slots.get(transaction['Location'])
+            if slot is not None:
+                out[slot] = 1
+
+        with span('scale'):
+            out -= self.scale_mean
+            out /= self.scale
+
+        return out
+
+    def encode_batch(self, transactions, velocity=None):
+        '''
+        Encodes a list of transactions into one scaled feature matrix, velocity
+        being one row of velocity features per transaction. Returns the matrix and
+        a mask of the rows whose DateTime could be parsed, rows outside the mask
+        hold garbage and shouldn't be scored
+        '''
+        n = len(transactions)
+
+        with span('parse_datetime'):
+            date_times = pd.to_datetime(pd.Series([t['DateTime'] for t in transactions], dtype=object),
+                                        format=DATETIME_FORMAT, errors='coerce')
+            valid = date_times.notna().to_numpy()
+            hour = date_times.dt.hour.fillna(0).to_numpy(dtype=np.int64)
+            day = date_times.dt.dayofweek.fillna(0).to_numpy(dtype=np.int64)
+
+        with span('build_features'):
+            amount = np.abs(np.array([t['Amount'] for t in transactions], dtype=np.float64))
+            locations = [t['Location'] for t in transactions]
+
+            profile = self.profile
+            if profile is not None:
+                usual_loc = np.fromiter((profile.is_usual_location(loc) for loc in locations), dtype=bool, count=n)
+                unusual_time = np.abs(hour - profile.usual_hour()) > profile.hour_tolerance()
+                amount_mean, amount_std = profile.scoring_amount_arrays()
+            else:
+                usual_loc = np.fromiter((loc in self.usual_locations for loc in locations), dtype=bool, count=n)
+                unusual_time = np.abs(hour - self.usual_hour) > self.hour_tolerance
+                amount_mean, amount_std = self.amount_mean, self.amount_std
+            zscore = np.clip((amount - amount_mean[hour]) / amount_std[hour], -1e6, 1e6)
+
+            matrix = np.tile(self.base, (n, 1))
+            self._put(matrix, self.amount_idx, amount)
+            self._put(matrix, self.hour_idx, hour)
+            self._put(matrix, self.day_idx, day)
+            self._put(matrix, self.zscore_idx, zscore)
+            self._put(matrix, self.usual_loc_idx, usual_loc)
+            self._put(matrix, self.unusual_time_idx, unusual_time)
+            self._put(matrix, self.out_of_bounds_idx, unusual_time & ~usual_loc)
+            velocity = np.tile(NO_HISTORY, (n, 1)) if velocity is None else np.asarray(velocity, dtype=np.float64).reshape(n, -1)
+            for slot, idx in enumerate(self.velocity_idx):
+                self._put(matrix, idx, velocity[:, slot])
+
+            slots = np.fromiter((self.location_slots.get(loc, -1) for loc in locations), dtype=np.int64, count=n)
+            rows = np.flatnonzero(slots >= 0)
+            matrix[rows, slots[rows]] = 1
+
+        with span('scale'):
+            matrix -= self.scale_mean
+            matrix /= self.scale
+
+        return matrix, valid
+
+    @staticmethod
+    def _put(target, idx, value):
+        # Features that were dropped from the training columns are skipped
+        if idx is not None:
+            target[..., idx] = value
@@ -0,0 +1,92 @@
+import copy
+import warnings
+from datetime import datetime
+import numpy as np
+from app.models.bundle import ModelState
+from app.models.feature_encoder import DATETIME_FORMAT
+from app.models.fraud_model import scoring_amount_stats
+from app.models.velocity import NO_HISTORY
+
+
+class FeedbackUnsupported(Exception):
+    pass
+
+
+def refresh_forest(model, X, y, trees, max_trees=None):
+    '''
+    A copy of the forest with trees new trees fit on X and y by warm start. Once
+    it has max_trees (as many as it has now, by default) the oldest trees make room
+    for the new ones. The model passed in is left as it is, requests may still be
+    scoring with it
+    '''
+    estimators = list(model.estimators_)
+    max_trees = max_trees or len(estimators)
+    drop = max(0, len(estimators) + trees - max_trees)
+
+    model = copy.copy(model)
+    # Warm start appends to the end, so the oldest trees are always at the front
+    model.estimators_ = estimators[drop:]
+    # Models saved with a sample size bigger than the window would refuse to fit on it
+    model.set_params(warm_start=True, n_estimators=len(model.estimators_) + trees, max_samples=None)
+    with warnings.catch_warnings():
+        # sklearn warns that the class weights only reflect X and y, which is what's wanted for the new trees
+        warnings.filterwarnings('ignore', message='class_weight presets', category=UserWarning)
+        model.fit(X, y)
+    model.set_params(warm_start=False)
+    return model
+
+
+def apply_feedback(state, transactions, labels, velocity=None, window=5000, refresh_rows=200, trees=10, max_trees=None):
+    '''
+    Folds labeled transactions into a model without retraining it. Transactions
+    confirmed legitimate are merged into the behavioral profile, which moves the
+    usual hour, usual locations and per-hour amount stats, fraud isn't a habit and
+    is left out of it. Every label joins the window of recent feedback, and once
+    refresh_rows have come in since the last refresh, and the window holds both
+    fraud and legitimate transactions, trees new trees are fit on the window and
+    replace the oldest ones. Boosting models only get the profile updates, their
+    trees depend on each other and can't be swapped one at a time. velocity holds
+    the velocity features each transaction was scored with, they're kept with it
+    in the window. Returns the new ModelState and whether the trees were refreshed
+    '''
+    if state.profile is None:
+        raise FeedbackUnsupported("This model was saved before feedback was supported, train it again to use feedback.")
+
+    labels = [int(bool(label)) for label in labels]
+    legit = [t for t, label in zip(transactions, labels) if not label]
+    profile = state.profile.copy()
+    if legit:
+        hours = [datetime.strptime(t['DateTime'], DATETIME_FORMAT).hour for t in legit]
+        profile.update(hours, [abs(t['Amount']) for t in legit], [t['Location'] for t in legit])
+
+    feedback = state.feedback or {'rows': [], 'since_refresh': 0}
+    velocity = velocity or [NO_HISTORY] * len(transactions)
+    rows = feedback['rows'] + [dict(t, Fraud=label, Velocity=[float(v) for v in features])
+                               for t, label, features in zip(transactions, labels, velocity)]
+    rows = rows[-window:]
+    since_refresh = feedback['since_refresh'] + len(transactions)
+
+    usual_locations = profile.usual_locations()
+    amount_stats = scoring_amount_stats(profile.amount_stats())
+    updated = ModelState.create(
+        state.model, state.scaler, state.columns, state.user_details, profile.usual_hour(),
+        profile.hour_tolerance(), usual_locations, amount_stats, profile=profile
+    )
+
+    model = state.model
+    refreshed = False
+    y = np.array([row['Fraud'] for row in rows])
+    if hasattr(state.model, 'estimators_') and since_refresh >= refresh_rows and 0 < y.sum() < len(y):
+        # Encoded with the updated stats, as they'll be scored from now on
+        # Rows from before velocity features were kept count as having no history
+        X, valid = updated.encoder.encode_batch(rows, velocity=[row.get('Velocity', NO_HISTORY) for row in rows])
+        model = refresh_forest(state.model, X[valid], y[valid], trees, max_trees)
+        since_refresh = 0
+        refreshed = True
+
+    new_state = ModelState.create(
+        model, state.scaler, state.columns, state.user_details, updated.usual_hour, updated.hour_tolerance,
+        usual_locations, amount_stats, profile=profile, feedback={'rows': rows, 'since_refresh': since_refresh},
+        report=state.report
+    )
+    return new_state, refreshed
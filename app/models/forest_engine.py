@@ -0,0 +1,139 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    # Optional, without it forests are scored with the NumPy version
+    numba = None
+
+# Batches at least this big are split across threads by the Numba kernel
+PARALLEL_ROWS = 256
+# Rows are walked through the trees this many at a time, so the index arrays
+# (NumPy) or the tree being walked (Numba) stay in cache
+BLOCK_ROWS = 128
+# Without Numba, batches this big are left to the forest's own predict_proba,
+# which walks them quicker than NumPy can once its fixed cost is spread out
+NUMPY_MAX_ROWS = 1024
+
+
+class FlatForest:
+    '''
+    A fitted random forest laid out as flat arrays, every tree's nodes one after
+    another: the feature and threshold each node splits on, its children, where
+    rows missing the feature go, and the class probabilities at the leaves. All
+    trees are walked for a whole batch at once, which skips the input checks,
+    joblib dispatch and per-tree Python loop predict_proba goes through, the bulk
+    of the time for a single row. Gives the same probabilities as the forest's
+    predict_proba, rows are compared in float32 the way sklearn does it. Numba,
+    when it's installed, compiles a kernel that walks them faster still
+    '''
+
+    def __init__(self, model, use_numba=None):
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        self.model = model
+        self.classes_ = model.classes_
+        self.n_features_in_ = model.n_features_in_
+        self.use_numba = numba is not None if use_numba is None else use_numba and numba is not None
+
+        sizes = np.array([tree.node_count for tree in trees])
+        self.roots = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.int64)
+        offsets = np.repeat(self.roots, sizes)
+        nodes = np.arange(sizes.sum())
+
+        left = np.concatenate([tree.children_left for tree in trees]).astype(np.int64)
+        right = np.concatenate([tree.children_right for tree in trees]).astype(np.int64)
+        leaf = left == -1
+        # Leaves point back at themselves, so a batch can take as many steps as the deepest tree needs
+        self.left = np.where(leaf, nodes, left + offsets)
+        self.right = np.where(leaf, nodes, right + offsets)
+        # Both children side by side, a node's next one is children[2 * node + goes_right]
+        self.children = np.column_stack((self.left, self.right)).ravel()
+        self.feature = np.where(leaf, 0, np.concatenate([tree.feature for tree in trees])).astype(np.int64)
+        self.threshold = np.concatenate([tree.threshold for tree in trees])
+        self.missing_left = np.concatenate([tree.missing_go_to_left for tree in trees]).astype(bool)
+        self.depth = max(tree.max_depth for tree in trees)
+
+        # The same normalization DecisionTreeClassifier.predict_proba does
+        value = np.concatenate([tree.value[:, 0, :len(self.classes_)] for tree in trees])
+        normalizer = value.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0] = 1
+        self.value = value / normalizer
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.roots, self.left, self.right, self.children,
+                                              self.feature, self.threshold, self.missing_left, self.value))
+
+    def predict_proba(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has {X.shape[-1]} features, the forest expects {self.n_features_in_}")
+
+        if self.use_numba:
+            out = np.zeros((len(X), len(self.classes_)))
+            kernel = _parallel_kernel if len(X) >= PARALLEL_ROWS else _kernel
+            kernel(X, self.roots, self.left, self.right, self.feature, self.threshold,
+                   self.missing_left, self.value, out)
+            return out
+        if len(X) >= NUMPY_MAX_ROWS:
+            return self.model.predict_proba(X)
+
+        out = np.empty((len(X), len(self.classes_)))
+        missing = np.isnan(X).any()
+        for start in range(0, len(X), BLOCK_ROWS):
+            out[start:start + BLOCK_ROWS] = self._predict_block(X[start:start + BLOCK_ROWS], missing)
+        return out
+
+    def _predict_block(self, X, missing):
+        # Every row starts at every root and steps down one level at a time
+        n_features = X.shape[1]
+        X = X.ravel()
+        row_starts = (np.arange(len(X) // n_features) * n_features)[:, None]
+        nodes = np.broadcast_to(self.roots, (len(row_starts), len(self.roots)))
+        for _ in range(self.depth):
+            x = X.take(row_starts + self.feature.take(nodes))
+            goes_right = x > self.threshold.take(nodes)
+            if missing:
+                goes_right = np.where(np.isnan(x), ~self.missing_left.take(nodes), goes_right)
+            nodes = self.children.take(2 * nodes + goes_right)
+        return self.value[nodes].sum(axis=1) / len(self.roots)
+
+
+def _predict_rows(X, roots, left, right, feature, threshold, missing_left, value, out):
+    # Tree by tree over blocks of rows, so a tree's nodes stay in cache while its
+    # rows go through it. Each row still adds its trees up in order and is
+    # divided once at the end, as predict_proba does
+    n_blocks = (X.shape[0] + BLOCK_ROWS - 1) // BLOCK_ROWS
+    for block in numba.prange(n_blocks):
+        end = min((block + 1) * BLOCK_ROWS, X.shape[0])
+        for root in roots:
+            for i in range(block * BLOCK_ROWS, end):
+                node = root
+                while left[node] != node:
+                    x = X[i, feature[node]]
+                    if np.isnan(x):
+                        go_left = missing_left[node]
+                    else:
+                        go_left = x <= threshold[node]
+                    node = left[node] if go_left else right[node]
+                for k in range(value.shape[1]):
+                    out[i, k] += value[node, k]
+        for i in range(block * BLOCK_ROWS, end):
+            for k in range(value.shape[1]):
+                out[i, k] /= len(roots)
+
+
+if numba is not None:
+    _kernel = numba.njit(cache=True, nogil=True)(_predict_rows)
+    _parallel_kernel = numba.njit(cache=True, nogil=True, parallel=True)(_predict_rows)
+
+
+def compile_model(model, use_numba=None):
+    '''
+    The model to call predict_proba on when scoring: a FlatForest for forests of
+    decision trees, anything else as it is
+    '''
+    estimators = getattr(model, 'estimators_', None)
+    if isinstance(estimators, list) and estimators and all(hasattr(e, 'tree_') for e in estimators):
+        return FlatForest(model, use_numba)
+    return model
@@ -1,38 +1,67 @@
+import logging
 import pandas as pd
 import numpy as np
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
-from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import classification_report, roc_auc_score
-from imblearn.over_sampling import SMOTE
 import sys
 import os
 from pathlib import Path
+from typing import NamedTuple
 
 project_root = Path(__file__).resolve().parent.parent.parent
 sys.path.append(str(project_root))
 from app.utils.api import check_company_legitimacy
+from app.models.engines import get_engine
+from app.models.feature_encoder import FeatureEncoder
+from app.models.profile import BehavioralProfile, SpaceSaving
+from app.models.velocity import VELOCITY_COLUMNS, epoch_seconds, velocity_features
+from app.utils.ingest import parse_datetime
+from app.utils.metrics import span
 
+logger = logging.getLogger(__name__)
 
-def process_data(data, user_details):
+
+class HistoryStats(NamedTuple):
     '''
-    Preprocesses the data to extract features, and engineer a few extra features
-    to get the most useful inputs in determining fraud
+    What process_data learns from the whole history before it can build features.
+    amount_stats keeps the per-hour std as computed, zeros included, the z-scores
+    are taken with it before zeros are replaced for scoring
     '''
+    usual_hour: int
+    hour_tolerance: float
+    usual_locs: list
+    amount_stats: pd.DataFrame
+    location_order: list
+    profile: BehavioralProfile
+
 
-    # Extract the time features
-    data['DateTime'] = pd.to_datetime(data['Date'] + ' ' + data['Time'], format='%Y-%m-%d %H:%M:%S')
+def _add_time_features(data):
+    if 'DateTime' not in data.columns:
+        data['DateTime'] = parse_datetime(data['Date'], data['Time'])
     data['Hour'] = data['DateTime'].dt.hour
     data['DayOfWeek'] = data['DateTime'].dt.dayofweek
 
     data['Amount'] = data['Amount'].abs()
+    return data
 
-    data['credit_score'] = user_details['credit_score']
-    data['age'] = user_details['age']
 
+def _location_order(locations, usual_locs):
+    # The order location columns have always come out in: sorted, or in category order
+    if isinstance(locations.dtype, pd.CategoricalDtype):
+        usual = set(usual_locs)
+        return [loc for loc in locations.cat.categories if loc in usual]
+    return sorted(usual_locs)
+
+
+def history_stats(data):
+    '''
+    HistoryStats for a history that's all in memory, with time features added
+    '''
     # Calculate usual shopping time (i.e, 10AM - 6PM) and hour tolerance
     usual_hour = data['Hour'].mode()[0]
-    hour_tolerance = data['Hour'].std() if data['Hour'].std() > 0 else 1
+    hour_std = data['Hour'].std()
+    hour_tolerance = hour_std if hour_std > 0 else 1
 
     # Gather the most usual locations by frequency
     loc_counts = data['Location'].value_counts()
@@ -40,117 +69,324 @@ def process_data(data, user_details):
 
     # Getting the mean and std for Amt/hour spent to calc z-score
     amount_stats = data.groupby('Hour')['Amount'].agg(['mean', 'std']).rename(columns={'mean': 'amount_mean', 'std': 'amount_std'})
-    data = data.merge(amount_stats, on='Hour', how='left')
-    amount_stats['amount_std'] = amount_stats['amount_std'].replace(0, 1e-6)
-    print(amount_stats)
 
-    # Now we create these new features from the data we scrapped
-    data['Amt_To_Hour_Zscore'] = ((data['Amount'] - data['amount_mean']) / data['amount_std'])
-    data['Amt_To_Hour_Zscore'] = data['Amt_To_Hour_Zscore'].clip(-1e6, 1e6)
+    # The counts behind these, kept with the model so they can follow the user from here on
+    profile = BehavioralProfile()
+    profile.update(data['Hour'].to_numpy(), data['Amount'].to_numpy(), data['Location'])
 
-    data['Usual_Location'] = data['Location'].apply(lambda x: 1 if x in usual_locs else 0)
-    data['Unusual_Time'] = (abs(data['Hour'] - usual_hour) > hour_tolerance).astype(int)
-    data['Out_of_bounds'] = ((~data['Location'].isin(usual_locs)) & (abs(data['Hour'] - usual_hour) > hour_tolerance)).astype(int)
+    return HistoryStats(usual_hour, hour_tolerance, usual_locs, amount_stats,
+                        _location_order(data['Location'], usual_locs), profile)
 
-    high_freq_locations = data['Location'].where(data['Location'].isin(usual_locs))
-    location_dummies = pd.get_dummies(high_freq_locations, prefix='Location')
-    data = pd.concat([data, location_dummies], axis=1)
 
-    # Get our features for X
-    X = pd.concat([data[['Amount', 'Hour', 'DayOfWeek', 'Amt_To_Hour_Zscore', 
-                         'Usual_Location', 'Unusual_Time', 'Out_of_bounds', 'credit_score', 'age']], location_dummies], axis=1)
-    y = data['Fraud']
+def collect_history_stats(chunks, velocity_inputs=None):
+    '''
+    HistoryStats gathered in one pass over a history read in chunks, without ever
+    holding all of it. Per-hour amount moments are merged chunk by chunk, so they
+    match the in-memory ones up to floating point rounding. Pass a list as
+    velocity_inputs to have each chunk's times, amounts and merchants appended to it
+    '''
+    profile = BehavioralProfile()
+    # Exact counts while training, the profile only keeps a summary of them
+    loc_counts = {}
+    for chunk in chunks:
+        chunk = _add_time_features(chunk)
+        profile.update(chunk['Hour'].to_numpy(), chunk['Amount'].to_numpy())
+        if velocity_inputs is not None:
+            velocity_inputs.append((epoch_seconds(chunk['DateTime']), chunk['Amount'].to_numpy(), chunk['Name'].to_numpy()))
+        for loc, count in chunk['Location'].value_counts(sort=False).items():
+            if count:
+                loc_counts[loc] = loc_counts.get(loc, 0) + int(count)
+
+    if profile.transactions == 0:
+        raise ValueError("The history has no transactions")
+
+    loc_counts = pd.Series(loc_counts, dtype=np.int64).sort_values(ascending=False, kind='stable')
+    usual_locs = loc_counts[loc_counts > 1].index.tolist()
+    profile.locations = SpaceSaving.from_counts(loc_counts.to_dict(), profile.locations.capacity)
 
-    return X, y, usual_hour, hour_tolerance, usual_locs, amount_stats
+    return HistoryStats(profile.usual_hour(), profile.hour_tolerance(), usual_locs, profile.amount_stats(),
+                        sorted(usual_locs), profile)
 
-def predict_fraud_probability(transaction, X, model, scaler, user_details, usual_hour, hour_tolerance, usual_locations, amount_stats):
-    
-    # Grab the features out of the test transaction
-    transaction['DateTime'] = pd.to_datetime(transaction['DateTime'], format='%Y-%m-%d %H:%M:%S')
-    transaction['Hour'] = transaction['DateTime'].hour
-    transaction['DayOfWeek'] = transaction['DateTime'].dayofweek
-    transaction['Amount'] = abs(transaction['Amount'])
-    transaction['credit_score'] = user_details['credit_score']
-    transaction['age'] = user_details['age']
-
-    # Determine out engineered features
-    usual_loc = 1 if transaction['Location'] in usual_locations else 0
-    unusual_time = 1 if abs(transaction['Hour'] - usual_hour) > hour_tolerance else 0
-
-    if transaction['Hour'] in amount_stats.index:
-        mean_amt = amount_stats.loc[transaction['Hour'], 'amount_mean']
-        std_amt = amount_stats.loc[transaction['Hour'], 'amount_std']
-    else:
-        mean_amt = amount_stats['amount_mean'].mean()
-        std_amt = amount_stats['amount_std'].mean()
-
-    Amt_To_Hour_Zscore = (transaction['Amount'] - mean_amt) / std_amt
-    Amt_To_Hour_Zscore = np.clip(Amt_To_Hour_Zscore, -1e6, 1e6)
-
-    # If out of their usual time, or out of their usual locations of transactions
-    out_of_bounds = 1 if (unusual_time and not usual_loc) else 0
-
-    # Check company exists
-    company_exists = check_company_legitimacy(transaction['Name'])
-    company_exists = 1 if company_exists == 'Yes' else 0
-
-    features = pd.DataFrame({
-        'Amount': [transaction['Amount']],
-        'Hour': [transaction['Hour']],
-        'DayOfWeek': [transaction['DayOfWeek']],
-        'Amt_To_Hour_Zscore': [Amt_To_Hour_Zscore],
-        'Usual_Location': [usual_loc],
-        'Unusual_Time': [unusual_time],
-        'Out_of_bounds': [out_of_bounds],
-        'Company_Exists': [company_exists],
-        'credit_score': [user_details['credit_score']],
-        'age': [user_details['age']]
+
+def build_features(data, user_details, stats, velocity):
+    '''
+    Feature rows X and labels y for a history (or a chunk of one) with time
+    features added, given the stats of the whole history and the rows' velocity
+    features
+    '''
+    n = len(data)
+    hours = data['Hour'].to_numpy()
+    amount = data['Amount'].to_numpy()
+
+    # Now we create these new features from the data we scrapped
+    slots = stats.amount_stats.index.get_indexer(hours)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        zscore = (amount - stats.amount_stats['amount_mean'].to_numpy()[slots]) / stats.amount_stats['amount_std'].to_numpy()[slots]
+    zscore = np.clip(zscore, -1e6, 1e6)
+
+    # Usual locations by their position in the column order, -1 for anything else
+    codes = pd.Categorical(data['Location'], categories=stats.location_order).codes
+    usual = codes >= 0
+    unusual_time = np.abs(hours - stats.usual_hour) > stats.hour_tolerance
+
+    columns = {
+        'Amount': amount,
+        'Hour': hours,
+        'DayOfWeek': data['DayOfWeek'].to_numpy(),
+        'Amt_To_Hour_Zscore': zscore,
+        'Usual_Location': usual.astype(int),
+        'Unusual_Time': unusual_time.astype(int),
+        'Out_of_bounds': (~usual & unusual_time).astype(int),
+    }
+    # How busy the user was just before each transaction, bursts are what card testing looks like
+    for slot, col in enumerate(VELOCITY_COLUMNS):
+        columns[col] = velocity[:, slot]
+    columns.update({
+        'credit_score': np.full(n, user_details['credit_score']),
+        'age': np.full(n, user_details['age']),
     })
 
-    for loc in usual_locations:
-        features[f'Location_{loc}'] = 1 if transaction['Location'] == loc else 0
+    location_dummies = np.zeros((n, len(stats.location_order)), dtype=bool)
+    rows = np.flatnonzero(usual)
+    location_dummies[rows, codes[rows]] = True
+    for slot, loc in enumerate(stats.location_order):
+        columns[f'Location_{loc}'] = location_dummies[:, slot]
 
-    for col in X.columns:
-        if col not in features.columns:
-            features[col] = 0
+    X = pd.DataFrame(columns)
+    y = pd.Series(data['Fraud'].to_numpy(), name='Fraud')
+    return X, y
 
-    features = features.reindex(columns=X.columns, fill_value=0)
 
-    features_scaled = scaler.transform(features)
+def scoring_amount_stats(amount_stats):
+    '''
+    Per-hour amount stats as they're scored with, a std of 0 would make every
+    z-score infinite
+    '''
+    amount_stats = amount_stats.copy()
+    amount_stats['amount_std'] = amount_stats['amount_std'].replace(0, 1e-6)
+    return amount_stats
+
+
+def process_data(data, user_details):
+    '''
+    Preprocesses the data to extract features, and engineer a few extra features
+    to get the most useful inputs in determining fraud. The BehavioralProfile
+    the stats came from is returned last
+    '''
+    data = _add_time_features(data)
+    stats = history_stats(data)
+    velocity = velocity_features(epoch_seconds(data['DateTime']), data['Amount'].to_numpy(), data['Name'].to_numpy())
+    X, y = build_features(data, user_details, stats, velocity)
+    amount_stats = scoring_amount_stats(stats.amount_stats)
+    logger.debug("Per-hour amount stats:\n%s", amount_stats)
+    return X, y, stats.usual_hour, stats.hour_tolerance, stats.usual_locs, amount_stats, stats.profile
+
+
+def process_data_chunked(read_chunks, user_details):
+    '''
+    process_data for histories too big to hold in memory as read. read_chunks is
+    called twice and should return a fresh iterator over the history's chunks each
+    time: the first pass collects the stats, the second builds the features chunk
+    by chunk straight into one float32 matrix sized from the first pass, the type
+    the model is fit on, so the history is never held whole and the features only
+    once. Gives the same results as process_data on the whole history, up to
+    floating point rounding in the per-hour amount stats
+    '''
+    # Velocity features look back across chunks and histories aren't always in time
+    # order, so they're worked out for the whole history between the two passes
+    # from just the times, amounts and merchants
+    velocity_inputs = []
+    stats = collect_history_stats(read_chunks(), velocity_inputs)
+    velocity = velocity_features(*(np.concatenate(parts) for parts in zip(*velocity_inputs)))
+    del velocity_inputs
+
+    matrix = None
+    start = 0
+    for chunk in read_chunks():
+        X_chunk, y_chunk = build_features(_add_time_features(chunk), user_details, stats, velocity[start:start + len(chunk)])
+        if matrix is None:
+            # Column-major like _float32_matrix, so the train and test sets are cut a column at a time
+            columns = list(X_chunk.columns)
+            matrix = np.empty((len(velocity), len(columns)), dtype=np.float32, order='F')
+            labels = np.empty(len(velocity), dtype=y_chunk.dtype)
+        end = start + len(chunk)
+        for j, col in enumerate(columns):
+            matrix[start:end, j] = X_chunk[col].to_numpy()
+        labels[start:end] = y_chunk.to_numpy()
+        start = end
+        del X_chunk, y_chunk
+
+    if start != len(velocity):
+        raise ValueError("The history changed between the two passes over it")
+    # The DataFrame is a view of the matrix, not a copy
+    X = pd.DataFrame(matrix, columns=columns, copy=False)
+    y = pd.Series(labels, name='Fraud')
+    amount_stats = scoring_amount_stats(stats.amount_stats)
+    logger.debug("Per-hour amount stats:\n%s", amount_stats)
+    return X, y, stats.usual_hour, stats.hour_tolerance, stats.usual_locs, amount_stats, stats.profile
+
+
+def predict_fraud_probability(transaction, X, model, scaler, user_details, usual_hour, hour_tolerance, usual_locations, amount_stats, encoder=None, company_verdict=None, profile=None, velocity=None):
+    '''
+    Scores a single transaction. Pass the FeatureEncoder fitted after training to
+    skip rebuilding it from the training state on every call, and the result of
+    check_company_legitimacy if it's already been looked up. With the user's
+    BehavioralProfile, the hour, location and amount features are read from it
+    rather than from the stats passed in (a ModelState's encoder already does).
+    velocity is what the user's VelocityWindow gave for the transaction
+    '''
+    if encoder is None:
+        encoder = FeatureEncoder(X.columns, scaler, user_details, usual_hour, hour_tolerance, usual_locations, amount_stats,
+                                 profile=profile)
+
+    # Check company exists, anything still pending verification counts as not yet
+    if company_verdict is None:
+        company_verdict = check_company_legitimacy(transaction['Name'])
+    company_exists = 1 if company_verdict == 'Yes' else 0
+
+    features_scaled = encoder.encode(transaction, velocity=velocity).reshape(1, -1)
 
     # Get the probability of this transaction
-    fraud_probability = model.predict_proba(features_scaled)[0, 1]
+    with span('predict_proba'):
+        fraud_probability = model.predict_proba(features_scaled)[0, 1]
 
     # basically can assume this is a fraud charge
     if not company_exists:
         fraud_probability = max(fraud_probability, 0.9)
     
-    fraud_probability = adjust_prob_by_risks(fraud_probability, calc_cred_risk(transaction['credit_score']), calculate_age_risk(transaction['age']))
+    fraud_probability = adjust_prob_by_risks(fraud_probability, calc_cred_risk(user_details['credit_score']), calculate_age_risk(user_details['age']))
 
     return fraud_probability
 
-def train_model(X, y):
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+def predict_fraud_probabilities(transactions, X, model, scaler, user_details, usual_hour, hour_tolerance, usual_locations, amount_stats, encoder=None, profile=None, velocity=None):
+    '''
+    Scores a batch of transactions with one feature engineering pass and a single
+    predict_proba call, velocity holding each one's velocity features. Gives the
+    same probabilities as predict_fraud_probability.
+    Returns one entry per transaction, either its probability or the exception
+    that stopped it from being scored, so one bad row doesn't fail the batch,
+    and each one's check_company_legitimacy verdict ('Yes', 'No', 'Pending', or
+    None where it wasn't checked)
+    '''
+    results = [None] * len(transactions)
+    verdicts = [None] * len(transactions)
+    if not transactions:
+        return results, verdicts
+
+    if encoder is None:
+        encoder = FeatureEncoder(X.columns, scaler, user_details, usual_hour, hour_tolerance, usual_locations, amount_stats,
+                                 profile=profile)
+
+    # Rows that fail to parse are reported on their own and left out of the scoring
+    features_scaled, valid = encoder.encode_batch(transactions, velocity=velocity)
+    for i in np.flatnonzero(~valid):
+        results[i] = ValueError(f"Invalid DateTime: {transactions[i]['DateTime']}")
+
+    # Check each distinct company once for the whole batch, anything still pending
+    # verification counts as not existing yet
+    company_verdicts = {}
+    for i in np.flatnonzero(valid):
+        name = transactions[i]['Name']
+        if name not in company_verdicts:
+            try:
+                company_verdicts[name] = check_company_legitimacy(name)
+            except Exception as e:
+                company_verdicts[name] = e
+        if isinstance(company_verdicts[name], Exception):
+            results[i] = company_verdicts[name]
+            valid[i] = False
+        else:
+            verdicts[i] = company_verdicts[name]
+
+    rows = np.flatnonzero(valid)
+    if len(rows) == 0:
+        return results, verdicts
+
+    # Get the probability of every transaction at once
+    with span('predict_proba'):
+        fraud_probabilities = model.predict_proba(features_scaled[rows])[:, 1]
+
+    credit_risk = calc_cred_risk(user_details['credit_score'])
+    age_risk = calculate_age_risk(user_details['age'])
+
+    for row, fraud_probability in zip(rows, fraud_probabilities):
+        # basically can assume this is a fraud charge
+        if verdicts[row] != 'Yes':
+            fraud_probability = max(fraud_probability, 0.9)
+
+        results[row] = adjust_prob_by_risks(fraud_probability, credit_risk, age_risk)
+
+    return results, verdicts
+
+def compact_features(X, rows=None):
+    '''
+    X (or the given rows of it) as one float32 matrix, the type the forest is fit
+    on, so sklearn doesn't make another copy of it. Location one-hots become 0/1
+    in the same block. Columns that hold a single value throughout, like
+    credit_score and age, can never be split on and are dropped. Returns the
+    matrix and the columns kept
+    '''
+    columns = []
+    for col in X.columns:
+        values = X[col].to_numpy()
+        if len(values) == 0 or values.min() != values.max():
+            columns.append(col)
+    return _float32_matrix(X, columns, rows), columns
+
 
-    # Scale our sets
-    scaler = StandardScaler()
-    X_train_scaled = scaler.fit_transform(X_train)
-    X_test_scaled = scaler.transform(X_test)
+def _float32_matrix(X, columns, rows=None):
+    n = len(X) if rows is None else len(rows)
+    matrix = np.empty((n, len(columns)), dtype=np.float32, order='F')
+    for j, col in enumerate(columns):
+        values = X[col].to_numpy()
+        matrix[:, j] = values if rows is None else values[rows]
+    return matrix
 
-    # smote = SMOTE(random_state=42)
-    # X_train_resampled, y_train_resampled = smote.fit_resample(X_train_scaled, y_train)
 
-    # Print class distribution before and after SMOTE
-    # print("Class distribution before SMOTE:")
-    # print(pd.Series(y_train).value_counts(normalize=True))
-    # print("\nClass distribution after SMOTE:")
-    # print(pd.Series(y_train_resampled).value_counts(normalize=True))
+def split_features(X, y, compact=True):
+    '''
+    The 80/20 split of X and y models are fit and tested on. compact cuts both
+    sets as float32 matrices without the constant columns and without scaling,
+    which a forest doesn't need since its splits don't change under it. Returns
+    the train and test sets, the scaler (None when compact) and the columns kept
+    '''
+    train_rows, test_rows = train_test_split(np.arange(len(X)), test_size=0.2, random_state=42)
+    y = np.asarray(y)
+    y_train, y_test = y[train_rows], y[test_rows]
+
+    if compact:
+        # The train and test sets are cut straight from the columns, X is never copied whole
+        X_train, columns = compact_features(X, train_rows)
+        X_test = _float32_matrix(X, columns, test_rows)
+        scaler = None
+    else:
+        columns = list(X.columns)
+        X_train, X_test = X.iloc[train_rows], X.iloc[test_rows]
+
+        # Scale our sets
+        scaler = StandardScaler()
+        X_train = scaler.fit_transform(X_train)
+        X_test = scaler.transform(X_test)
+
+    return X_train, X_test, y_train, y_test, scaler, columns
+
+
+def train_model(X, y, compact=True, engine=None):
+    '''
+    Fits a model on 80% of X and holds the rest out for testing, see
+    split_features for compact. engine is what fits it, an engine from
+    app.models.engines or its name, the multi-core forest by default. Returns
+    the model, the scaler (None when compact), the test set and the columns fit on
+    '''
+    if engine is None or isinstance(engine, str):
+        engine = get_engine(engine or 'forest')
+    X_train, X_test, y_train, y_test, scaler, columns = split_features(X, y, compact)
 
-    # Fit the model to the data, n_estimators is the number of trees, making a class prediction independenlty
-    model = RandomForestClassifier(n_estimators=100, min_samples_leaf=5, max_depth=5, class_weight="balanced_subsample", random_state=42)
-    model.fit(X_train_scaled, y_train)
+    # Fraud is rare, the engines weight it up rather than oversampling it with
+    # SMOTE, which made copies of the whole training set and was too slow to use
+    model = engine.fit(X_train, y_train)
 
-    return model, scaler, X_test_scaled, y_test
+    return model, scaler, X_test, y_test, columns
 
 def test_model(model, X_test_scaled, y_test, feature_names):
     y_pred = model.predict(X_test_scaled)
@@ -0,0 +1,440 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    # No file locks on Windows, only one worker should write live profiles there
+    fcntl = None
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+LIVE_PROFILE_FILE = 'live-profile.json'
+
+
+class SpaceSaving:
+    '''
+    Bounded heavy-hitters counter (Metwally et al.'s Space-Saving). At most
+    capacity items are tracked. A new item past that takes over the counter of the
+    least counted one, and inherits its count as an overestimate (kept as the
+    item's error), so the frequent items are never lost however many rare ones
+    go by. Below capacity every count is exact
+    '''
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # Lazy min-heap over the counters, entries go stale as counts grow and are fixed up on eviction
+        self.heap = []
+        self.sequence = itertools.count()
+
+    def add(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+            return
+        if len(self.counts) < self.capacity:
+            self._track(item, count, 0)
+            return
+
+        least = self._pop_least()
+        floor = self.counts.pop(least)
+        del self.errors[least]
+        self._track(item, floor + count, floor)
+
+    def _track(self, item, count, error):
+        self.counts[item] = count
+        self.errors[item] = error
+        heapq.heappush(self.heap, (count, next(self.sequence), item))
+
+    def _pop_least(self):
+        while True:
+            count, _, item = heapq.heappop(self.heap)
+            current = self.counts.get(item)
+            if current == count:
+                return item
+            if current is not None:
+                heapq.heappush(self.heap, (current, next(self.sequence), item))
+
+    def min_count(self):
+        # What an untracked item could have been counted at most
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+    def count(self, item):
+        '''
+        How many times item was certainly seen
+        '''
+        return self.counts.get(item, 0) - self.errors.get(item, 0)
+
+    def merge(self, other):
+        '''
+        Adds other's counts in. An item only one side tracks is counted on the
+        other side at that side's smallest counter, as it may have been evicted
+        there (Agarwal et al.'s mergeable summaries)
+        '''
+        self_floor = self.min_count()
+        other_floor = other.min_count()
+        counts = {}
+        errors = {}
+        for item in set(self.counts) | set(other.counts):
+            counts[item] = self.counts.get(item, self_floor) + other.counts.get(item, other_floor)
+            errors[item] = self.errors.get(item, self_floor) + other.errors.get(item, other_floor)
+        self._rebuild(counts, errors)
+
+    def _rebuild(self, counts, errors):
+        kept = sorted(counts, key=lambda item: counts[item], reverse=True)[:self.capacity]
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+        for item in kept:
+            self._track(item, counts[item], errors[item])
+
+    def items(self):
+        '''
+        (item, certain count) pairs, the most counted first
+        '''
+        return sorted(((item, self.count(item)) for item in self.counts), key=lambda pair: pair[1], reverse=True)
+
+    def copy(self):
+        other = SpaceSaving(self.capacity)
+        other._rebuild(self.counts, self.errors)
+        return other
+
+    def to_dict(self):
+        return {'capacity': self.capacity,
+                'items': [[item, self.counts[item], self.errors[item]] for item in self.counts]}
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls(data['capacity'])
+        summary._rebuild({item: count for item, count, _ in data['items']},
+                         {item: error for item, _, error in data['items']})
+        return summary
+
+    @classmethod
+    def from_counts(cls, counts, capacity=1000):
+        summary = cls(capacity)
+        summary._rebuild({item: int(count) for item, count in counts.items()}, {item: 0 for item in counts})
+        return summary
+
+
+class BehavioralProfile:
+    '''
+    A user's habits as the model's features see them: transactions per hour (for
+    the usual hour and its spread), count, mean and sum of squared deviations (M2)
+    of the amounts in each hour, and the user's most frequent locations in a
+    SpaceSaving summary. A transaction is added in O(1), with Welford's update for
+    its hour's amount moments. Batches are merged per hour the way Chan et al.
+    combine partial moments, and two profiles merge the same way, so workers that
+    each saw part of the traffic can be combined
+    '''
+
+    def __init__(self, hour_counts=None, amount_n=None, amount_mean=None, amount_m2=None, locations=None,
+                 location_capacity=1000):
+        self.hour_counts = np.zeros(24, dtype=np.int64) if hour_counts is None else np.array(hour_counts, dtype=np.int64)
+        self.amount_n = np.zeros(24) if amount_n is None else np.array(amount_n, dtype=np.float64)
+        self.amount_mean = np.zeros(24) if amount_mean is None else np.array(amount_mean, dtype=np.float64)
+        self.amount_m2 = np.zeros(24) if amount_m2 is None else np.array(amount_m2, dtype=np.float64)
+        self.locations = locations if locations is not None else SpaceSaving(location_capacity)
+        self.lock = threading.RLock()
+        self._recount_hours()
+
+    def _recount_hours(self):
+        # Sums over the hour histogram, exact integers, so the hour std is O(1) to read
+        hours = np.arange(24)
+        self.total = int(self.hour_counts.sum())
+        self.hour_sum = int((hours * self.hour_counts).sum())
+        self.hour_square_sum = int((hours * hours * self.hour_counts).sum())
+        self.mode_hour = int(np.argmax(self.hour_counts))
+
+    def add(self, hour, amount, location):
+        '''
+        Adds one transaction, given as its hour, absolute amount and location
+        '''
+        with self.lock:
+            self.hour_counts[hour] += 1
+            self.total += 1
+            self.hour_sum += hour
+            self.hour_square_sum += hour * hour
+            # Series.mode breaks ties on the earliest hour
+            mode_count = self.hour_counts[self.mode_hour]
+            if self.hour_counts[hour] > mode_count or (self.hour_counts[hour] == mode_count and hour < self.mode_hour):
+                self.mode_hour = hour
+
+            if amount == amount:
+                n = self.amount_n[hour] + 1
+                delta = amount - self.amount_mean[hour]
+                self.amount_n[hour] = n
+                self.amount_mean[hour] += delta / n
+                self.amount_m2[hour] += delta * (amount - self.amount_mean[hour])
+
+            if location is not None:
+                self.locations.add(location)
+
+    def add_transaction(self, transaction):
+        date_time = datetime.strptime(transaction['DateTime'], DATETIME_FORMAT)
+        self.add(date_time.hour, abs(transaction['Amount']), transaction['Location'])
+
+    def update(self, hours, amounts, locations=None):
+        '''
+        Merges in a batch of transactions, given as their hours, absolute amounts
+        and locations
+        '''
+        hours = np.asarray(hours, dtype=np.int64)
+        amounts = np.asarray(amounts, dtype=np.float64)
+
+        # Missing amounts count towards the hour but not its amount stats
+        known = ~np.isnan(amounts)
+        batch_n = np.bincount(hours[known], minlength=24).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            batch_mean = np.bincount(hours[known], weights=amounts[known], minlength=24) / batch_n
+        batch_mean[batch_n == 0] = 0
+        batch_m2 = np.bincount(hours[known], weights=(amounts[known] - batch_mean[hours[known]]) ** 2, minlength=24)
+
+        location_counts = None
+        if locations is not None:
+            location_counts = pd.Series(locations).value_counts(sort=False)
+
+        with self.lock:
+            self.hour_counts += np.bincount(hours, minlength=24)
+            self._merge_moments(batch_n, batch_mean, batch_m2)
+            if location_counts is not None:
+                for loc, count in location_counts.items():
+                    if count:
+                        self.locations.add(loc, int(count))
+            self._recount_hours()
+
+    def _merge_moments(self, n, mean, m2):
+        total = self.amount_n + n
+        delta = mean - self.amount_mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.amount_mean = np.where(total > 0, self.amount_mean + delta * n / total, 0)
+            self.amount_m2 = self.amount_m2 + m2 + np.where(total > 0, delta ** 2 * self.amount_n * n / total, 0)
+        self.amount_n = total
+
+    def merge(self, other):
+        '''
+        Adds everything other has seen
+        '''
+        with other.lock:
+            hour_counts, n, mean, m2 = other.hour_counts.copy(), other.amount_n.copy(), other.amount_mean.copy(), other.amount_m2.copy()
+            locations = other.locations.copy()
+        with self.lock:
+            self.hour_counts += hour_counts
+            self._merge_moments(n, mean, m2)
+            self.locations.merge(locations)
+            self._recount_hours()
+
+    def copy(self):
+        with self.lock:
+            return BehavioralProfile(self.hour_counts, self.amount_n, self.amount_mean, self.amount_m2,
+                                     self.locations.copy())
+
+    def _replace(self, other):
+        with self.lock:
+            self.hour_counts = other.hour_counts.copy()
+            self.amount_n = other.amount_n.copy()
+            self.amount_mean = other.amount_mean.copy()
+            self.amount_m2 = other.amount_m2.copy()
+            self.locations = other.locations.copy()
+            self._recount_hours()
+
+    @property
+    def transactions(self):
+        return self.total
+
+    def usual_hour(self):
+        # The most common hour, the earliest one on a tie like Series.mode
+        return np.int32(self.mode_hour)
+
+    def hour_tolerance(self):
+        with self.lock:
+            total, hour_sum, hour_square_sum = self.total, self.hour_sum, self.hour_square_sum
+        if total < 2:
+            return 1
+        variance = (total * hour_square_sum - hour_sum * hour_sum) / (total * (total - 1))
+        hour_std = np.sqrt(max(variance, 0))
+        return hour_std if hour_std > 0 else 1
+
+    def is_usual_location(self, location):
+        with self.lock:
+            return self.locations.count(location) > 1
+
+    def usual_locations(self):
+        '''
+        Locations seen more than once, the most frequent first
+        '''
+        with self.lock:
+            return [loc for loc, count in self.locations.items() if count > 1]
+
+    def amount_stats(self):
+        '''
+        Per-hour amount mean and std for the hours seen, as process_data computes
+        them. std is NaN for hours with a single amount, and zeros are kept
+        '''
+        with self.lock:
+            seen = np.flatnonzero(self.amount_n > 0)
+            n = self.amount_n[seen]
+            mean = self.amount_mean[seen]
+            m2 = self.amount_m2[seen]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.where(n > 1, np.sqrt(m2 / np.maximum(n - 1, 1)), np.nan)
+        return pd.DataFrame({'amount_mean': mean, 'amount_std': std},
+                            index=pd.Index(seen.astype(np.int32), name='Hour'))
+
+    def hour_amount_stats(self, hour):
+        '''
+        The amount mean and std a transaction in hour is scored against, the same
+        as FeatureEncoder lays them out from amount_stats
+        '''
+        with self.lock:
+            n = self.amount_n[hour]
+            mean = self.amount_mean[hour]
+            m2 = self.amount_m2[hour]
+        if n == 0:
+            means, stds = self.scoring_amount_arrays()
+            return means[hour], stds[hour]
+        std = np.sqrt(m2 / (n - 1)) if n > 1 else np.nan
+        return mean, (1e-6 if std == 0 else std)
+
+    def scoring_amount_arrays(self):
+        '''
+        Amount mean and std for all 24 hours as they're scored with: std 0 becomes
+        1e-6, and hours never seen fall back on the average over the seen ones
+        '''
+        with self.lock:
+            n = self.amount_n.copy()
+            mean = self.amount_mean.copy()
+            m2 = self.amount_m2.copy()
+        seen = n > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.where(n > 1, np.sqrt(m2 / np.maximum(n - 1, 1)), np.nan)
+        std[std == 0] = 1e-6
+        if seen.any() and not seen.all():
+            mean[~seen] = mean[seen].mean()
+            std_seen = std[seen][~np.isnan(std[seen])]
+            std[~seen] = std_seen.mean() if len(std_seen) else np.nan
+        return mean, std
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'hour_counts': self.hour_counts.tolist(),
+                'amount_n': self.amount_n.tolist(),
+                'amount_mean': self.amount_mean.tolist(),
+                'amount_m2': self.amount_m2.tolist(),
+                'locations': self.locations.to_dict(),
+            }
+
+    @classmethod
+    def from_dict(cls, data, location_capacity=1000):
+        if 'locations' in data:
+            locations = SpaceSaving.from_dict(data['locations'])
+        else:
+            # Saved before locations were summarized, with every location's exact count
+            locations = SpaceSaving.from_counts(data.get('location_counts', {}), location_capacity)
+        return cls(data['hour_counts'], data['amount_n'], data['amount_mean'], data['amount_m2'], locations)
+
+
+class LiveProfile(BehavioralProfile):
+    '''
+    The profile a served model scores with, updated with every transaction it
+    scores. What this worker has added since it last synced is kept apart as a
+    delta. sync merges the delta into the live profile file shared by every
+    worker serving the same bundle, and takes the merged profile back, so each
+    worker's profile follows everyone's traffic
+    '''
+
+    def __init__(self, base, path, version):
+        super().__init__(base.hour_counts, base.amount_n, base.amount_mean, base.amount_m2, base.locations.copy())
+        self.base = base
+        self.path = path
+        self.version = version
+        self.delta = BehavioralProfile(location_capacity=base.locations.capacity)
+
+        shared_version, shared = self._read()
+        if shared_version == version:
+            self._replace(shared)
+
+    def add(self, hour, amount, location):
+        with self.lock:
+            super().add(hour, amount, location)
+            self.delta.add(hour, amount, location)
+
+    def update(self, hours, amounts, locations=None):
+        with self.lock:
+            super().update(hours, amounts, locations)
+            self.delta.update(hours, amounts, locations)
+
+    @property
+    def pending(self):
+        return self.delta.transactions
+
+    def _read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data['version'], BehavioralProfile.from_dict(data['profile'])
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+    def _write(self, delta):
+        # The shared file with delta merged in, or None if a newer bundle owns it
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            shared_version, shared = self._read()
+            if shared_version is not None and shared_version > self.version:
+                return None
+            if shared_version != self.version:
+                shared = self.base.copy()
+            shared.merge(delta)
+
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'version': self.version, 'profile': shared.to_dict()}, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            return shared
+        finally:
+            os.close(fd)
+
+    def sync(self):
+        '''
+        Merges what this worker has seen into the shared file and picks up what
+        the others have. The file belongs to one bundle: an older one's is started
+        over from this bundle's profile, and if a newer bundle owns it this worker's
+        model is on its way out and its delta is dropped
+        '''
+        with self.lock:
+            delta, self.delta = self.delta, BehavioralProfile(location_capacity=self.base.locations.capacity)
+
+        try:
+            shared = self._write(delta)
+        except Exception:
+            # Nothing reached the file, so what was taken out is kept for the next sync
+            with self.lock:
+                delta.merge(self.delta)
+                self.delta = delta
+            raise
+        if shared is None:
+            return False
+
+        # Transactions added while the file was being written are kept on top
+        with self.lock:
+            pending = self.delta.copy()
+            self._replace(shared)
+            BehavioralProfile.merge(self, pending)
+        return True
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from app.models.bundle import load_bundle, current_version
+
+logger = logging.getLogger(__name__)
+
+USER_ID = re.compile(r'^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}$')
+
+
+def check_user_id(user_id):
+    '''
+    User IDs name a folder under the model directory, so only plain names are allowed
+    '''
+    if not isinstance(user_id, str) or not USER_ID.match(user_id):
+        raise ValueError(f"Invalid user ID {user_id!r}")
+    return user_id
+
+
+def bundle_bytes(directory, version):
+    path = os.path.join(directory, version)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+class ModelRegistry:
+    '''
+    Every user's ModelState, loaded from their own bundle folder (root/<user_id>)
+    the first time it's asked for. The most recently used ones stay in memory while
+    their bundles add up to no more than max_bytes, and concurrent requests for a
+    user that isn't loaded yet all wait on the same load. on_evict, if given, is
+    called with the user ID and state of every entry that's dropped or replaced
+    '''
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, on_evict=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def user_dir(self, user_id):
+        return os.path.join(self.root, check_user_id(user_id))
+
+    def get(self, user_id):
+        '''
+        The user's model state, or None if they have no saved model yet
+        '''
+        state, pending, owner = self._claim(user_id)
+        if pending is None:
+            return state
+        if not owner:
+            return pending.result()
+        return self._fill(user_id, pending)
+
+    async def get_async(self, user_id):
+        '''
+        get for the event loop. A model that isn't in memory is loaded in a worker
+        thread, and requests waiting on a load that's already running await it
+        instead of blocking the loop
+        '''
+        state, pending, owner = self._claim(user_id)
+        if pending is None:
+            return state
+        if not owner:
+            return await asyncio.wrap_future(pending)
+        return await asyncio.to_thread(self._fill, user_id, pending)
+
+    def _claim(self, user_id):
+        # The user's state if it's in memory, otherwise the future its load is
+        # on and whether this caller is the one to run the load
+        check_user_id(user_id)
+        with self.lock:
+            state = self.entries.get(user_id)
+            if state is not None:
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return state, None, False
+
+            self.misses += 1
+            pending = self.loading.get(user_id)
+            if pending is not None:
+                return None, pending, False
+            pending = self.loading[user_id] = Future()
+            # Running from the start, so a waiter that gives up can't cancel the load for the others
+            pending.set_running_or_notify_cancel()
+            return None, pending, True
+
+    def _fill(self, user_id, pending):
+        try:
+            state = self._load(user_id)
+            if state is not None:
+                state = self._insert(user_id, state)
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.loading[user_id]
+
+        pending.set_result(state)
+        return state
+
+    def load(self, user_id, version=None, verify=False):
+        '''
+        Loads a saved bundle for the user (the last one unless a version is given)
+        and swaps it in, checking its files' checksums with verify. Bundles older
+        than the one in memory are ignored. Returns the state in use afterwards, or
+        None if the user has nothing saved
+        '''
+        state = self._load(user_id, version, verify)
+        if state is None:
+            return None
+        return self._insert(user_id, state, force=version is None)
+
+    def _load(self, user_id, version=None, verify=False):
+        directory = self.user_dir(user_id)
+        if version is None and current_version(directory) is None:
+            return None
+        state = load_bundle(directory, version, verify=verify)
+        with self.lock:
+            self.loads += 1
+        return state
+
+    def _insert(self, user_id, state, force=False):
+        # The compiled forest is held alongside the model, on top of what the bundle takes
+        size = bundle_bytes(self.user_dir(user_id), state.version) + getattr(state.scorer, 'nbytes', 0)
+        released = []
+        with self.lock:
+            current = self.entries.get(user_id)
+            if not force and current is not None and current.version and current.version > state.version:
+                self.entries.move_to_end(user_id)
+                return current
+            if current is not None and current is not state:
+                released.append((user_id, current))
+
+            self.total_bytes += size - self.sizes.get(user_id, 0)
+            self.entries[user_id] = state
+            self.sizes[user_id] = size
+            self.entries.move_to_end(user_id)
+
+            # The newest entry always stays, even if it's over the budget on its own
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                evicted, evicted_state = self.entries.popitem(last=False)
+                self.total_bytes -= self.sizes.pop(evicted)
+                self.evictions += 1
+                released.append((evicted, evicted_state))
+
+        self._release(released)
+        return state
+
+    def _release(self, released):
+        if self.on_evict is None:
+            return
+        for user_id, state in released:
+            try:
+                self.on_evict(user_id, state)
+            except Exception as e:
+                logger.error("Error releasing model for user %s: %s", user_id, e)
+
+    def evict(self, user_id):
+        with self.lock:
+            state = self.entries.pop(user_id, None)
+            if state is not None:
+                self.total_bytes -= self.sizes.pop(user_id)
+        if state is not None:
+            self._release([(user_id, state)])
+
+    def resident(self):
+        '''
+        (user ID, state) for every model in memory
+        '''
+        with self.lock:
+            return list(self.entries.items())
+
+    def __contains__(self, user_id):
+        with self.lock:
+            return user_id in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'resident': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'loads': self.loads,
+                'evictions': self.evictions,
+            }
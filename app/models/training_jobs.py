@@ -0,0 +1,194 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from app.models.bundle import ModelState, save_bundle
+from app.models.fraud_model import process_data, process_data_chunked, train_model
+from app.models.model_selection import select_model
+from app.utils.ingest import iter_transactions, read_transactions
+from app.utils.log_queue import start_logging
+
+logger = logging.getLogger(__name__)
+
+# Files bigger than this are processed in two passes over chunks instead of being read whole
+IN_MEMORY_BYTES = int(os.environ.get("TRAINING_IN_MEMORY_BYTES", 512 * 1024 * 1024))
+
+# What fits the model when it isn't selected, 'forest' or 'boosting'
+TRAINING_ENGINE = os.environ.get("TRAINING_ENGINE", "forest")
+
+# Jobs that select their model keep the most accurate one whose p99 scoring
+# latency, measured where it's trained, fits these budgets
+LATENCY_BUDGET_MS = float(os.environ.get("LATENCY_BUDGET_MS", 5))
+BATCH_LATENCY_BUDGET_MS = float(os.environ.get("BATCH_LATENCY_BUDGET_MS", 50))
+SELECTION_ENGINES = tuple(os.environ.get("SELECTION_ENGINES", "forest,boosting").split(","))
+
+# How far along a job is when it reaches each stage
+STAGES = {
+    'queued': 0.0,
+    'reading': 0.05,
+    'processing': 0.15,
+    'training': 0.35,
+    'saving': 0.9,
+    'done': 1.0,
+}
+
+
+def run_training(job_id, file_location, user_details, model_dir, progress, select=False):
+    '''
+    Trains a model from a transactions file (CSV, Parquet or Arrow IPC) and saves
+    it as a bundle. With select the model is picked by select_model within the
+    latency budgets rather than fit as train_model has it. Runs in a worker
+    process, reports its stage through the shared progress dict and returns the
+    saved bundle's version
+    '''
+    def report(stage):
+        progress[job_id] = {'stage': stage, 'progress': STAGES[stage]}
+
+    if os.path.getsize(file_location) <= IN_MEMORY_BYTES:
+        report('reading')
+        data = read_transactions(file_location)
+
+        report('processing')
+        X, y, usual_hour, hour_tolerance, usual_locations, amount_stats, profile = process_data(data, user_details)
+        del data
+    else:
+        report('processing')
+        X, y, usual_hour, hour_tolerance, usual_locations, amount_stats, profile = process_data_chunked(
+            lambda: iter_transactions(file_location), user_details
+        )
+
+    report('training')
+    selection = None
+    if select:
+        model, scaler, _, _, columns, selection = select_model(X, y, LATENCY_BUDGET_MS, BATCH_LATENCY_BUDGET_MS,
+                                                            engines=SELECTION_ENGINES)
+    else:
+        model, scaler, _, _, columns = train_model(X, y, engine=TRAINING_ENGINE)
+    del X
+    state = ModelState.create(model, scaler, columns, user_details, usual_hour, hour_tolerance, usual_locations,
+                              amount_stats, profile=profile, report=selection)
+
+    report('saving')
+    version = save_bundle(state, model_dir)
+
+    report('done')
+    return version
+
+
+class TrainingJobs:
+    '''
+    Runs training in a pool of worker processes so the API keeps serving while a
+    model is being fit. Each job gets an ID its status can be looked up with, and
+    on_done(version) is called with the saved bundle's version when one finishes
+    '''
+
+    def __init__(self, max_workers=1, max_jobs=100):
+        self.max_workers = max_workers
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = None
+        self.manager = None
+        self.progress = None
+
+    def _start(self):
+        # Spawned rather than forked, the API process has threads running
+        context = multiprocessing.get_context('spawn')
+        self.manager = context.Manager()
+        self.progress = self.manager.dict()
+        # Workers log the way the API does, they don't inherit its handlers
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context, initializer=start_logging,
+                                            initargs=(os.environ.get("LOG_LEVEL", "INFO"),))
+
+    def submit(self, file_location, user_details, model_dir, on_done=None, user_id=None, select=False):
+        '''
+        Queues a model to be trained from file_location and saved under model_dir,
+        selected within the latency budgets if select is set. Returns the job's ID
+        '''
+        with self.lock:
+            if self.executor is None:
+                self._start()
+
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {
+                'job_id': job_id,
+                'user_id': user_id,
+                'select': select,
+                'status': 'queued',
+                'stage': 'queued',
+                'progress': 0.0,
+                'version': None,
+                'error': None,
+                'submitted_at': time.time(),
+                'finished_at': None,
+            }
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+
+            future = self.executor.submit(run_training, job_id, file_location, user_details, model_dir, self.progress, select)
+
+        future.add_done_callback(lambda f: self._finish(job_id, f, on_done))
+        return job_id
+
+    def _finish(self, job_id, future, on_done):
+        error = None
+        version = None
+        try:
+            version = future.result()
+            if on_done is not None:
+                on_done(version)
+        except Exception as e:
+            error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+            logger.error("Training job %s failed: %s", job_id, error)
+
+        try:
+            reported = self.progress.pop(job_id, None) or {}
+        except Exception:
+            reported = {}
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                # A failed job keeps the stage it got to
+                job.update(reported)
+                job.update({
+                    'status': 'failed' if error else 'done',
+                    'version': version,
+                    'error': error,
+                    'finished_at': time.time(),
+                })
+                if not error:
+                    job.update(stage='done', progress=1.0)
+
+    def status(self, job_id):
+        '''
+        The job's status, or None if there's no such job
+        '''
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+
+        if job['status'] == 'queued':
+            try:
+                reported = self.progress.get(job_id)
+            except Exception:
+                reported = None
+            if reported is not None:
+                job.update(reported, status='running')
+        return job
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=wait, cancel_futures=not wait)
+                self.executor = None
+            if self.manager is not None:
+                self.manager.shutdown()
+                self.manager = None
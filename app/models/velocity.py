@@ -0,0 +1,209 @@
+import threading
+from collections import Counter, deque
+from itertools import islice
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+HOUR = 3600
+DAY = 24 * 3600
+# Seconds since the previous transaction are capped here, and a user's first transaction gets it
+MAX_GAP = 30 * DAY
+
+VELOCITY_COLUMNS = ['Txn_Count_1h', 'Amount_Sum_1h', 'Txn_Count_24h', 'Amount_Sum_24h', 'Merchants_24h', 'Seconds_Since_Last']
+# What a transaction with nothing before it gets
+NO_HISTORY = (0, 0.0, 0, 0.0, 0, MAX_GAP)
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_cents(amounts):
+    # Sums are kept in whole cents so training and serving add them up to exactly the same values
+    return np.rint(np.nan_to_num(np.abs(np.asarray(amounts, dtype=np.float64))) * 100).astype(np.int64)
+
+
+def velocity_features(times, amounts, names):
+    '''
+    The velocity features for every transaction in a history, given as their
+    times in epoch seconds, amounts and merchant names. Each one only counts the
+    transactions before it: earlier ones, and ones at the same second that come
+    before it in the history. Returns an (n, 6) array in VELOCITY_COLUMNS order,
+    rows in the order given
+    '''
+    times = np.asarray(times, dtype=np.int64)
+    n = len(times)
+    result = np.empty((n, len(VELOCITY_COLUMNS)))
+    if n == 0:
+        return result
+
+    order = np.argsort(times, kind='stable')
+    t = times[order]
+    rows = np.arange(n)
+    cents = np.concatenate(([0], np.cumsum(to_cents(np.asarray(amounts)[order]))))
+
+    features = np.empty((n, len(VELOCITY_COLUMNS)))
+    for col, window in ((0, HOUR), (2, DAY)):
+        # The earliest transaction still inside (t - window, t]
+        start = np.searchsorted(t, t - window, side='right')
+        features[:, col] = rows - start
+        features[:, col + 1] = (cents[rows] - cents[start]) / 100
+
+    # A transaction counts towards a later one's distinct merchants while it's the
+    # last one at its merchant and less than a day older, so each one covers a run
+    # of the rows after it, and the counts are a running sum over where runs start and end
+    codes = pd.factorize(np.asarray(names)[order])[0]
+    by_name = np.lexsort((rows, codes))
+    same = codes[by_name[1:]] == codes[by_name[:-1]]
+    next_same = np.full(n, n - 1)
+    next_same[by_name[:-1][same]] = by_name[1:][same]
+    within_day = np.searchsorted(t, t + DAY, side='left') - 1
+    last = np.minimum(next_same, within_day)
+    covers = last > rows
+    runs = np.bincount(rows[covers] + 1, minlength=n + 1) - np.bincount(last[covers] + 1, minlength=n + 1)
+    features[:, 4] = np.cumsum(runs)[:n]
+
+    gaps = np.empty(n)
+    gaps[0] = MAX_GAP
+    gaps[1:] = np.minimum(np.diff(t), MAX_GAP)
+    features[:, 5] = gaps
+
+    result[order] = features
+    return result
+
+
+def epoch_seconds(date_times):
+    return date_times.to_numpy(dtype='datetime64[s]').astype(np.int64)
+
+
+class VelocityWindow:
+    '''
+    One user's recent transactions, for velocity features at serving time. The
+    last hour and the last day are kept as ring buffers with running counts and
+    cent sums, and the last day's merchants with their counts, so a transaction
+    in time order is added and its features read in O(1) amortized. One that
+    arrives late is placed in order and its features counted from the buffer
+    directly. At most max_events are kept a day
+    '''
+
+    def __init__(self, max_events=100000):
+        self.max_events = max_events
+        self.day = deque()
+        self.hour = deque()
+        self.day_cents = 0
+        self.hour_cents = 0
+        self.merchants = Counter()
+        self.last_time = None
+        self.lock = threading.Lock()
+
+    def _evict(self, now):
+        while self.hour and (self.hour[0][0] <= now - HOUR or len(self.hour) > self.max_events):
+            self.hour_cents -= self.hour.popleft()[1]
+        while self.day and (self.day[0][0] <= now - DAY or len(self.day) > self.max_events):
+            _, cents, name = self.day.popleft()
+            self.day_cents -= cents
+            self.merchants[name] -= 1
+            if not self.merchants[name]:
+                del self.merchants[name]
+
+    def observe(self, time, amount, name):
+        '''
+        The features of a transaction at time (epoch seconds), counted from the
+        transactions before it, which is then added to the window
+        '''
+        cents = int(to_cents([amount])[0])
+        with self.lock:
+            if self.last_time is None or time >= self.last_time:
+                self._evict(time)
+                features = (len(self.hour), self.hour_cents / 100, len(self.day), self.day_cents / 100,
+                            len(self.merchants),
+                            MAX_GAP if self.last_time is None else min(time - self.last_time, MAX_GAP))
+                self.day.append((time, cents, name))
+                self.hour.append((time, cents))
+                self.day_cents += cents
+                self.hour_cents += cents
+                self.merchants[name] += 1
+                self.last_time = time
+                return features
+
+            features = self._count(time)
+            self._insert(time, cents, name)
+            return features
+
+    def copy(self):
+        '''
+        A separate window holding the same transactions
+        '''
+        with self.lock:
+            window = VelocityWindow(self.max_events)
+            window.day = deque(self.day)
+            window.hour = deque(self.hour)
+            window.day_cents = self.day_cents
+            window.hour_cents = self.hour_cents
+            window.merchants = Counter(self.merchants)
+            window.last_time = self.last_time
+        return window
+
+    def peek(self, time):
+        '''
+        The features a transaction at time would get, without adding it. As with
+        observe, one in time order is read in O(1) amortized
+        '''
+        with self.lock:
+            if self.last_time is None or time >= self.last_time:
+                return self._count_latest(time)
+            return self._count(time)
+
+    def _dropped(self, events, cutoff):
+        # How many of the oldest events _evict would drop for a transaction at cutoff's time
+        expired = 0
+        for event in events:
+            if event[0] > cutoff:
+                break
+            expired += 1
+        return max(expired, len(events) - self.max_events)
+
+    def _count_latest(self, time):
+        # The features observe gives a transaction in time order, read around what
+        # it would evict instead of evicting it
+        hour_dropped = self._dropped(self.hour, time - HOUR)
+        day_dropped = self._dropped(self.day, time - DAY)
+        hour_cents = self.hour_cents - sum(event[1] for event in islice(self.hour, hour_dropped))
+        day_cents = self.day_cents - sum(event[1] for event in islice(self.day, day_dropped))
+        gone = Counter(event[2] for event in islice(self.day, day_dropped))
+        merchants = len(self.merchants) - sum(1 for name, count in gone.items() if self.merchants[name] == count)
+        return (len(self.hour) - hour_dropped, hour_cents / 100, len(self.day) - day_dropped, day_cents / 100,
+                merchants, MAX_GAP if self.last_time is None else min(time - self.last_time, MAX_GAP))
+
+    def _count(self, time):
+        before = [event for event in self.day if event[0] <= time]
+        hour = [event for event in before if event[0] > time - HOUR]
+        day = [event for event in before if event[0] > time - DAY]
+        if before:
+            gap = min(time - before[-1][0], MAX_GAP)
+        elif self.last_time is not None and self.last_time <= time:
+            # Everything before it has aged out of the window, but the last time is still known
+            gap = min(time - self.last_time, MAX_GAP)
+        else:
+            gap = MAX_GAP
+        return (len(hour), sum(event[1] for event in hour) / 100, len(day), sum(event[1] for event in day) / 100,
+                len({event[2] for event in day}), gap)
+
+    def _insert(self, time, cents, name):
+        # Late ones go in after everything at or before their time, like a stable sort would put them
+        for events, event in ((self.day, (time, cents, name)), (self.hour, (time, cents))):
+            position = len(events)
+            while position > 0 and events[position - 1][0] > time:
+                position -= 1
+            events.insert(position, event)
+        self.day_cents += cents
+        self.hour_cents += cents
+        self.merchants[name] += 1
+        self._evict(self.last_time)
+
+
+def transaction_time(transaction):
+    '''
+    A transaction's DateTime in epoch seconds, read as naive the way pandas reads
+    it for training
+    '''
+    return int((datetime.strptime(transaction['DateTime'], DATETIME_FORMAT) - EPOCH).total_seconds())
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # No file locks on Windows, only threads in one process are kept apart there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class AddressesExhausted(Exception):
+    pass
+
+
+class AddressBook:
+    '''
+    Which Ethereum address each company was given, kept as an append-only log with
+    one JSON line per assignment. Each new company takes the next unused address
+    from the list, and that costs one appended line no matter how many companies
+    there already are. The next free address is worked out from the log on start,
+    so nothing is handed out twice after a restart. Assigning takes a lock on the
+    log file, so several workers can share it, and each worker catches up on lines
+    the others wrote before it assigns anything
+    '''
+
+    def __init__(self, path, addresses, legacy_map_path=None):
+        self.path = path
+        self.addresses = addresses
+        self.assigned = {}
+        self.next_slot = 0
+        self.offset = 0
+        self.lock = threading.Lock()
+
+        with self.lock, self._file_lock() as fd:
+            if os.fstat(fd).st_size == 0 and legacy_map_path and os.path.exists(legacy_map_path):
+                self._import_legacy(fd, legacy_map_path)
+            self._catch_up()
+
+    def _file_lock(self):
+        book = self
+
+        class FileLock:
+            def __enter__(self):
+                self.fd = os.open(book.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+                if fcntl is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_EX)
+                return self.fd
+
+            def __exit__(self, *exc):
+                # Closing the file releases the lock
+                os.close(self.fd)
+
+        return FileLock()
+
+    def _import_legacy(self, fd, legacy_map_path):
+        with open(legacy_map_path, 'r') as f:
+            legacy = json.load(f)
+        slots = {address: i for i, address in enumerate(self.addresses)}
+        lines = [self._line(company, address, slots.get(address)) for company, address in legacy.items()]
+        self._append(fd, b''.join(lines))
+        logger.info("Imported %d company-address mappings from %s", len(lines), legacy_map_path)
+
+    def _line(self, company, address, slot):
+        entry = {'company': company, 'address': address, 'slot': slot, 'assigned_at': time.time()}
+        return (json.dumps(entry) + '\n').encode('utf-8')
+
+    def _append(self, fd, data):
+        # A writer that died mid-line leaves it unterminated, end it so it's skipped as one bad line
+        size = os.fstat(fd).st_size
+        if size > 0:
+            os.lseek(fd, size - 1, os.SEEK_SET)
+            if os.read(fd, 1) != b'\n':
+                data = b'\n' + data
+        os.write(fd, data)
+        os.fsync(fd)
+
+    def _catch_up(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                self.offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                # The first assignment a company got is the one that stands
+                self.assigned.setdefault(entry['company'], entry['address'])
+                if entry.get('slot') is not None:
+                    self.next_slot = max(self.next_slot, entry['slot'] + 1)
+
+    def __len__(self):
+        return len(self.assigned)
+
+    def __contains__(self, company):
+        return company in self.assigned
+
+    def get(self, company):
+        '''
+        The address assigned to company, assigning it the next free one if it
+        doesn't have one yet. Raises AddressesExhausted when they've all been used
+        '''
+        address = self.assigned.get(company)
+        if address is not None:
+            return address
+
+        with self.lock, self._file_lock() as fd:
+            self._catch_up()
+            address = self.assigned.get(company)
+            if address is not None:
+                return address
+
+            if self.next_slot >= len(self.addresses):
+                raise AddressesExhausted("No more Ethereum addresses available to assign.")
+            slot = self.next_slot
+            address = self.addresses[slot]
+            self._append(fd, self._line(company, address, slot))
+            self._catch_up()
+            return self.assigned[company]
+
+    def mapping(self):
+        '''
+        Every company and its address
+        '''
+        return dict(self.assigned)
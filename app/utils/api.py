@@ -1,40 +1,73 @@
 import os
 from dotenv import load_dotenv, dotenv_values
-from fuzzywuzzy import process, fuzz
 import csv
+import logging
 import pandas as pd
 import openai
+import threading
+from app.utils.company_index import CompanyIndex
+from app.utils.merchant_store import MerchantStore
+from app.utils.metrics import MERCHANT_CHECKS, span
+from app.utils.verdict_cache import VerdictCache
+from app.utils.verifier import OpenAIVerifier, StubVerifier, VerificationQueue
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 openai.api_key = os.getenv("MY_API_KEY") 
 COMPANY_LIST = None
-COMPANY_LIST_PATH = None
-
-def load_company_list():
-    global COMPANY_LIST_PATH
-    name_mapping = {}
-
-    project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
-    COMPANY_LIST_PATH = os.path.join(project_root, 'data', 'combined_comp_database.csv')
-    
-    if os.path.exists(COMPANY_LIST_PATH):
-        with open(COMPANY_LIST_PATH, 'r', newline='', encoding='utf-8') as csvfile:
-            reader = csv.reader(csvfile)
-            next(reader)
-            COMPANY_LIST = [row[0] for row in reader]
-        return COMPANY_LIST
-    
+COMPANY_STORE = None
+COMPANY_INDEX = None
+COMPANY_LOCK = threading.Lock()
+VERDICT_CACHE = None
+VERIFIER = None
+VERIFICATION_QUEUE = None
+VERDICT_LISTENERS = []
+
+# How long LLM verdicts are remembered for, in seconds
+VERDICT_TTLS = {
+    'Yes': int(os.getenv("VERDICT_TTL_YES", 30 * 24 * 3600)),
+    'No': int(os.getenv("VERDICT_TTL_NO", 7 * 24 * 3600)),
+    'error': int(os.getenv("VERDICT_TTL_ERROR", 5 * 60)),
+}
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", 100_000))
+
+def get_verdict_cache():
+    global VERDICT_CACHE
+    if VERDICT_CACHE is None:
+        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+        path = os.getenv("VERDICT_CACHE_PATH", os.path.join(project_root, 'data', 'verdict_cache.db'))
+        VERDICT_CACHE = VerdictCache(path, capacity=VERDICT_CACHE_SIZE, ttls=VERDICT_TTLS)
+    return VERDICT_CACHE
+
+def get_company_store():
+    '''
+    Opens the merchant store (data/merchants.db, or MERCHANT_STORE_PATH), building
+    it from the company lists in data/ the first time it's used
+    '''
+    global COMPANY_STORE
+    if COMPANY_STORE is None:
+        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+        store = MerchantStore(os.getenv("MERCHANT_STORE_PATH", os.path.join(project_root, 'data', 'merchants.db')))
+        if len(store) == 0:
+            build_company_store(store, os.path.join(project_root, 'data'))
+        COMPANY_STORE = store
+    return COMPANY_STORE
+
+def build_company_store(store, data_dir):
+    '''
+    Fills an empty merchant store from the Fortune 1000, INC 5000 and company
+    database lists, keeping which official name each alias stands for. Names from
+    the old combined_comp_database.csv, including ones the LLM verified, are
+    carried over too
+    '''
     # Construct paths to the csv files...
-    fort1000_path = os.path.join(project_root, 'data', 'fort1000.csv')
-    inc5000_path = os.path.join(project_root, 'data', 'inc5000.csv')
-    company_database_path = os.path.join(project_root, 'data', 'company_database.csv')
-
-    #read and combine fortune1000 and INC5000 data
-    df1 = pd.read_csv(fort1000_path)
-    df2 = pd.read_csv(inc5000_path)
-    fort1000comp = df1['Company'].tolist()
-    inc5000comp = df2['name'].tolist()
+    fort1000_path = os.path.join(data_dir, 'fort1000.csv')
+    inc5000_path = os.path.join(data_dir, 'inc5000.csv')
+    company_database_path = os.path.join(data_dir, 'company_database.csv')
+    combined_path = os.path.join(data_dir, 'combined_comp_database.csv')
 
+    name_mapping = {}
     with open(company_database_path, 'r', encoding='utf-8') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
@@ -46,82 +79,160 @@ def load_company_list():
             if alternative_names:
                 alternatives = [alt.strip().upper() for alt in alternative_names.split(',')]
                 for alt_name in alternatives:
-                    name_mapping[alt_name] = official_name
-    company_names = list(name_mapping.keys())
-
-    # Combine all lists
-    comps = fort1000comp + inc5000comp + company_names
-    comps = list(set([x.upper() for x in comps]))
+                    if alt_name:
+                        name_mapping.setdefault(alt_name, official_name)
+    store.add_many(name_mapping.items(), source='company_database')
+
+    #read fortune1000 and INC5000 data
+    fort1000comp = pd.read_csv(fort1000_path, usecols=['Company'])['Company'].dropna().str.upper()
+    store.add_many(((name, name) for name in fort1000comp), source='fort1000')
+    inc5000comp = pd.read_csv(inc5000_path, usecols=['name'])['name'].dropna().str.upper()
+    store.add_many(((name, name) for name in inc5000comp), source='inc5000')
+
+    if os.path.exists(combined_path):
+        with open(combined_path, 'r', newline='', encoding='utf-8') as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader)
+            store.add_many(((row[0], row[0]) for row in reader if row), source='combined_comp_database')
 
-    with open(COMPANY_LIST_PATH, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['Name'])
-        for company in comps:
-            writer.writerow([company])
+    logger.info("Built merchant store with %d names", len(store))
 
-    # save initial company list
+def load_company_list():
+    '''
+    Builds the fuzzy match index over every name in the merchant store
+    '''
+    global COMPANY_LIST, COMPANY_INDEX
+    COMPANY_LIST = get_company_store().names()
+    COMPANY_INDEX = CompanyIndex(COMPANY_LIST)
+    return COMPANY_LIST
 
-    return comps
+def get_official_name(company_name):
+    '''
+    The official company name for a known name or alias, or None
+    '''
+    return get_company_store().official_name(company_name.upper())
 
 
 def check_company_legitimacy(company_name):
-    global COMPANY_LIST
-    if COMPANY_LIST is None:
-        COMPANY_LIST = load_company_list()
+    '''
+    Returns 'Yes' if the company is in the list or was verified as legitimate,
+    'No' if it was turned down, and 'Pending' if it's been sent off for
+    verification in the background and the answer isn't back yet
+    '''
+    logger.debug("Verifying %s if exists", company_name)
 
-    print(f"Verifying {company_name} if exists...\n")
-    
     name_upper = company_name.upper()
-    result = process.extractOne(name_upper, COMPANY_LIST, scorer=fuzz.token_set_ratio, score_cutoff=80)
+
+    with span('legitimacy_fuzzy'):
+        # Known names are answered by the store without touching the fuzzy index
+        if name_upper in get_company_store():
+            MERCHANT_CHECKS.inc('store')
+            logger.debug("Found match in list")
+            return "Yes"
+
+        # Same result as process.extractOne(name_upper, COMPANY_LIST, scorer=fuzz.token_set_ratio, score_cutoff=80)
+        with COMPANY_LOCK:
+            if COMPANY_INDEX is None:
+                load_company_list()
+            result = COMPANY_INDEX.extract_one(name_upper, score_cutoff=80)
 
     if result is not None:
         match, score = result
-        print("Found match in list")
+        MERCHANT_CHECKS.inc('fuzzy')
+        logger.debug("Found match in list")
         return "Yes"
-    else:
-        # Get answer from ChatGPT
-        prompt = f"""
-        I am attempting to detect fraudulent purchases with the help of an LLM to determine whether a company is real and trustworthy. 
-        I will provide a company name, and you should respond with 'Yes' if the company is legitimate and is a place that an individual 
-        would typically purchase something from using a personal credit card. If the company is not real or if it is something that 
-        an individual would not typically purchase with their personal credit card (e.g., Lockheed Martin, Naval Nuclear Laboratory), 
-        respond with 'No.' Typical credit card users would be more likely to buy things from popular restaurants, retailers, and some
-        specialty stores (that regular people still shop at). Respond only with a one-word answer after each name. Do not elaborate or 
-        state anything other than 'Yes' or 'No.'
-
-        Note: Product names, such as 'iPhone,' should also be treated as 'No' because they represent a product and not a company that 
-        would appear on a credit card transaction.
-
-        Please think hard about what companies a typical individual would be purchasing from on their normal credit card. Even if
-        a company is legitimate and trustworthy in name, a purchase from them by a personal card might still be fraud and should be
-        marked 'No.'
-
-        Company: {company_name}
-        """
 
+    with span('legitimacy_cache'):
+        # Remember what the LLM said last time, including No's and errors
+        cached = get_verdict_cache().get(name_upper)
+        if cached is not None:
+            MERCHANT_CHECKS.inc('cache')
+            return "Yes" if cached == "Yes" else "No"
+
+        # With the queue running the answer comes back later, otherwise ask right away
+        if VERIFICATION_QUEUE is not None:
+            VERIFICATION_QUEUE.submit(name_upper, company_name)
+            MERCHANT_CHECKS.inc('pending')
+            return "Pending"
+
+    MERCHANT_CHECKS.inc('llm')
+    with span('llm_verify'):
         try:
-            response = openai.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=10,
-                temperature=0  # lower the more deterministic the output
-            )
-
-            # strip response of any whitespace or newlines
-            answer = response.choices[0].message.content.strip()
-
-            if answer == "Yes":
-                COMPANY_LIST.append(name_upper) # append to dataset
-                with open(COMPANY_LIST_PATH, 'a', newline='', encoding='utf-8') as csvfile:
-                    print("Writing to cvs file")
-                    writer = csv.writer(csvfile)
-                    writer.writerow([name_upper])
-                return answer
+            verdict = get_verifier().verify([company_name]).get(company_name, "error")
         except Exception as e:
-            return "No" # Default to No in any error
-        
-        return "No" # Default in any case
-    
+            verdict = "error"
+    record_verdict(name_upper, verdict)
+
+    return "Yes" if verdict == "Yes" else "No" # Default to No in any error
+
+
+def record_verdict(name_upper, verdict):
+    '''
+    Stores a verifier's verdict ('Yes', 'No' or 'error') for a merchant and lets
+    anyone listening for verdicts know
+    '''
+    if verdict == "Yes":
+        with COMPANY_LOCK:
+            if get_company_store().add(name_upper, source='llm') and COMPANY_INDEX is not None:
+                COMPANY_LIST.append(name_upper) # append to dataset
+                COMPANY_INDEX.add(name_upper)
+
+    get_verdict_cache().put(name_upper, verdict)
+
+    for listener in VERDICT_LISTENERS:
+        listener(name_upper, verdict)
+
+
+def add_verdict_listener(listener):
+    '''
+    Registers listener(name_upper, verdict) to be called whenever a merchant gets a
+    verdict. With the verification queue running it's called from its worker thread
+    '''
+    VERDICT_LISTENERS.append(listener)
+
+
+def get_verifier():
+    global VERIFIER
+    if VERIFIER is None:
+        if os.getenv("MERCHANT_VERIFIER", "openai") == "stub":
+            VERIFIER = StubVerifier(default=os.getenv("STUB_VERIFIER_DEFAULT", "No"),
+                                    delay=float(os.getenv("STUB_VERIFIER_DELAY", 0)))
+        else:
+            VERIFIER = OpenAIVerifier()
+    return VERIFIER
+
+
+def set_verifier(verifier):
+    global VERIFIER
+    VERIFIER = verifier
+
+
+def start_verification_queue(verifier=None, batch_size=20, max_wait=0.5):
+    '''
+    Moves merchant verification off the request path. From here on unknown
+    merchants come back as 'Pending' and are verified in batches in the background
+    '''
+    global VERIFICATION_QUEUE
+    if VERIFICATION_QUEUE is not None:
+        return VERIFICATION_QUEUE
+
+    if verifier is not None:
+        set_verifier(verifier)
+    with COMPANY_LOCK:
+        if COMPANY_INDEX is None:
+            load_company_list()
+
+    VERIFICATION_QUEUE = VerificationQueue(get_verifier(), record_verdict, batch_size=batch_size, max_wait=max_wait)
+    VERIFICATION_QUEUE.start()
+    return VERIFICATION_QUEUE
+
+
+def stop_verification_queue():
+    global VERIFICATION_QUEUE
+    if VERIFICATION_QUEUE is not None:
+        VERIFICATION_QUEUE.stop()
+        VERIFICATION_QUEUE = None
+
+
+def is_verification_pending(company_name):
+    return VERIFICATION_QUEUE is not None and VERIFICATION_QUEUE.is_pending(company_name.upper())
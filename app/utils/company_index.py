@@ -0,0 +1,174 @@
+from collections import Counter
+import numpy as np
+from fuzzywuzzy import fuzz, utils
+
+
+class CompanyIndex:
+    '''
+    Index over the known company names that gives the same answer as
+
+        process.extractOne(name, names, scorer=fuzz.token_set_ratio, score_cutoff=cutoff)
+
+    without scoring every name, down to which name wins a tie. Exact names are
+    found through a hash lookup, and fuzzy matches are only scored against the small set of names that could
+    possibly reach the cutoff:
+
+    - names sharing a token with the query, found through a token inverted index
+    - names sharing no token, where token_set_ratio comes down to a plain ratio of
+      the sorted token strings. A ratio of 80 needs a long common subsequence, and
+      every gap in that subsequence costs a character, so these names have to share
+      a minimum number of character bigrams with the query. They're found through a
+      bigram inverted index and that count
+    '''
+
+    def __init__(self, names=()):
+        self.names = []
+        self.exact = {}
+        self.tokens = {}
+        self.bigrams = {}
+        self.short_ids = []
+        self._processed = []
+        self._lengths = np.zeros(1024, dtype=np.int32)
+        self._token_arrays = {}
+        self._bigram_arrays = {}
+
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self._process_choice(name) in self.exact
+
+    def add(self, name):
+        '''
+        Adds a name to the index. Names that process down to nothing only ever
+        match a query that does too, so they're kept out of the fuzzy index
+        '''
+        idx = len(self.names)
+        self.names.append(name)
+
+        processed = self._process_choice(name)
+        self._processed.append(processed)
+        self.exact.setdefault(processed, idx)
+        if not processed:
+            return
+
+        token_set = set(processed.split())
+        for token in token_set:
+            self.tokens.setdefault(token, []).append(idx)
+            self._token_arrays.pop(token, None)
+
+        sorted_tokens = " ".join(sorted(token_set))
+        for bigram in set(self._bigrams_of(sorted_tokens)):
+            self.bigrams.setdefault(bigram, []).append(idx)
+            self._bigram_arrays.pop(bigram, None)
+
+        if idx >= len(self._lengths):
+            self._lengths = np.resize(self._lengths, len(self._lengths) * 2)
+        self._lengths[idx] = len(sorted_tokens)
+
+        # Strings this short can reach the cutoff without sharing a bigram
+        if len(sorted_tokens) <= 4:
+            self.short_ids.append(idx)
+
+    def extract_one(self, query, score_cutoff=80):
+        '''
+        Returns (name, score) for the best match at or above score_cutoff, or None.
+        Like extractOne, ties go to the name that was added first. That holds for
+        an exact match too: a name added before it whose tokens are a subset or
+        superset of the query's also scores 100, and wins
+        '''
+        processed_query = self._process_query(query)
+
+        exact = self.exact.get(processed_query)
+        if exact is not None:
+            if processed_query:
+                for idx in self.candidates(processed_query, 100):
+                    if idx >= exact:
+                        break
+                    if fuzz.token_set_ratio(processed_query, self._processed[idx], full_process=False) == 100:
+                        return self.names[idx], 100
+            return self.names[exact], 100
+        if not processed_query:
+            return None
+
+        best = None
+        best_score = score_cutoff - 1
+        for idx in self.candidates(processed_query, score_cutoff):
+            score = fuzz.token_set_ratio(processed_query, self._processed[idx], full_process=False)
+            if score > best_score:
+                best, best_score = idx, score
+                if score == 100:
+                    break
+
+        if best is None:
+            return None
+        return self.names[best], best_score
+
+    def candidates(self, processed_query, score_cutoff=80):
+        '''
+        Ids of every name that could score at least score_cutoff against the
+        already processed query, in the order they were added
+        '''
+        n = len(self.names)
+        token_set = set(processed_query.split())
+
+        # Names sharing a token get scored regardless
+        shared = [self._postings(self.tokens, self._token_arrays, token) for token in token_set]
+
+        # Names sharing no token have to share enough bigrams with the sorted token string
+        sorted_tokens = " ".join(sorted(token_set))
+        query_len = len(sorted_tokens)
+        query_bigrams = Counter(self._bigrams_of(sorted_tokens))
+        max_repeat = max(query_bigrams.values(), default=1)
+
+        postings = [self._postings(self.bigrams, self._bigram_arrays, bigram) for bigram in query_bigrams]
+        postings = [p for p in postings if len(p)]
+        if postings:
+            counts = np.bincount(np.concatenate(postings), minlength=n)
+            ids = np.flatnonzero(counts)
+        else:
+            counts = np.zeros(n, dtype=np.int64)
+            ids = np.empty(0, dtype=np.int64)
+        if self.short_ids:
+            ids = np.union1d(ids, self.short_ids)
+
+        lengths = self._lengths[ids].astype(np.int64)
+        total = query_len + lengths
+
+        # ratio = 2 * lcs / total has to round to the cutoff, so lcs >= (cutoff - 0.5) / 200 * total
+        min_lcs = -((-(2 * score_cutoff - 1) * total) // 400)
+        # Every character of the lcs not followed by its neighbour in both strings needs a gap
+        min_shared = 3 * min_lcs - total - 1
+        min_distinct = -(-min_shared // max_repeat)
+        possible = (np.minimum(query_len, lengths) >= min_lcs) & (counts[ids] >= min_distinct)
+
+        shared.append(ids[possible])
+        shared = [s for s in shared if len(s)]
+        if not shared:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(shared))
+
+    @staticmethod
+    def _postings(index, arrays, key):
+        array = arrays.get(key)
+        if array is None:
+            array = np.array(index.get(key, ()), dtype=np.int64)
+            arrays[key] = array
+        return array
+
+    @staticmethod
+    def _bigrams_of(s):
+        return [s[i:i + 2] for i in range(len(s) - 1)]
+
+    @staticmethod
+    def _process_choice(name):
+        # Same processing extractOne applies to every choice for token_set_ratio
+        return utils.full_process(name, force_ascii=True)
+
+    @staticmethod
+    def _process_query(query):
+        # extractOne runs its default processor over the query before the one for the scorer
+        return utils.full_process(utils.full_process(query), force_ascii=True)
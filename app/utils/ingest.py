@@ -0,0 +1,156 @@
+import os
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Column types to parse transaction histories with, anything else in the file is skipped
+DTYPES = {
+    'Date': 'category',
+    'Time': 'category',
+    'DateTime': 'str',
+    'Name': 'category',
+    'Amount': 'float32',
+    'Location': 'category',
+    'Zip': 'float32',
+    'Balance': 'float32',
+    'Fraud': 'int8',
+}
+
+FORMATS = {
+    '.csv': 'csv',
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.ipc': 'arrow',
+}
+
+
+def detect_format(path):
+    '''
+    csv, parquet or arrow, going by the file's magic bytes and then its extension
+    '''
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    if head[:4] == b'PAR1':
+        return 'parquet'
+    if head[:6] == b'ARROW1' or head[:4] == b'\xff\xff\xff\xff':
+        return 'arrow'
+    return FORMATS.get(os.path.splitext(path)[1].lower(), 'csv')
+
+
+def parse_datetime(date, time):
+    '''
+    Combines Date ('%Y-%m-%d') and Time ('%H:%M:%S') columns into one datetime
+    column. Histories repeat the same days and times over and over, so each distinct
+    value is parsed once and the rest is array indexing
+    '''
+    date_codes, dates = pd.factorize(date)
+    time_codes, times = pd.factorize(time)
+    days = pd.to_datetime(pd.Index(dates).astype(str), format='%Y-%m-%d').to_numpy()
+    offsets = pd.to_timedelta(pd.Index(times).astype(str)).to_numpy()
+    values = days[date_codes] + offsets[time_codes]
+    values[(date_codes < 0) | (time_codes < 0)] = np.datetime64('NaT')
+    return pd.Series(values, index=date.index, name='DateTime')
+
+
+def _prepare(chunk):
+    # One datetime parse per chunk, the Date and Time columns are dropped right after
+    if 'DateTime' not in chunk.columns or not pd.api.types.is_datetime64_any_dtype(chunk['DateTime']):
+        if 'Date' in chunk.columns and 'Time' in chunk.columns:
+            chunk['DateTime'] = parse_datetime(chunk['Date'], chunk['Time'])
+        else:
+            chunk['DateTime'] = pd.to_datetime(chunk['DateTime'], format=DATETIME_FORMAT)
+    chunk = chunk.drop(columns=[c for c in ('Date', 'Time') if c in chunk.columns])
+
+    for column, dtype in DTYPES.items():
+        if column in chunk.columns and column not in ('Date', 'Time', 'DateTime') and chunk[column].dtype != dtype:
+            chunk[column] = chunk[column].astype(dtype)
+        # Sorted categories, as the CSV parser gives, so location columns come out in the same order
+        if column in chunk.columns and dtype == 'category' and not chunk[column].cat.categories.is_monotonic_increasing:
+            chunk[column] = chunk[column].cat.reorder_categories(chunk[column].cat.categories.sort_values())
+    return chunk
+
+
+def _concat(chunks):
+    if len(chunks) == 1:
+        return chunks[0]
+
+    # Chunks have their own categories, merge them so the columns stay categorical
+    categorical = [c for c in chunks[0].columns if isinstance(chunks[0][c].dtype, pd.CategoricalDtype)]
+    for column in categorical:
+        merged = union_categoricals([chunk[column] for chunk in chunks], sort_categories=True)
+        for chunk in chunks:
+            chunk[column] = pd.Categorical(chunk[column], categories=merged.categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _arrow_batches(path, format, columns, chunksize):
+    import pyarrow as pa
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        names = [c for c in columns if c in parquet_file.schema_arrow.names]
+        yield from parquet_file.iter_batches(batch_size=chunksize, columns=names)
+        return
+
+    with pa.memory_map(path, 'r') as source:
+        try:
+            reader = pa.ipc.open_file(source)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        except pa.ArrowInvalid:
+            source.seek(0)
+            batches = pa.ipc.open_stream(source)
+        for batch in batches:
+            batch = batch.select([c for c in columns if c in batch.schema.names])
+            # Slices are views, so big batches are still converted a chunk at a time
+            for offset in range(0, batch.num_rows, chunksize):
+                yield batch.slice(offset, chunksize)
+
+
+def _arrow_to_frame(batch):
+    import pyarrow as pa
+    table = pa.Table.from_batches([batch])
+    # Strings go straight to categories instead of through Python objects
+    for name in ('Date', 'Time', 'Name', 'Location'):
+        if name in table.column_names and (pa.types.is_string(table.schema.field(name).type)
+                                           or pa.types.is_large_string(table.schema.field(name).type)):
+            i = table.column_names.index(name)
+            table = table.set_column(i, name, table.column(name).dictionary_encode())
+    return _prepare(table.to_pandas())
+
+
+def iter_transactions(path, format=None, chunksize=1_000_000):
+    '''
+    Reads a transaction history from a CSV, Parquet or Arrow IPC file chunksize
+    rows at a time, each chunk as compact as read_transactions makes it
+    '''
+    format = format or detect_format(path)
+    if format == 'csv':
+        for chunk in pd.read_csv(path, usecols=lambda c: c in DTYPES, dtype=DTYPES, chunksize=chunksize):
+            yield _prepare(chunk)
+        return
+
+    if format not in ('parquet', 'arrow'):
+        raise ValueError(f"Unsupported format {format!r}")
+    try:
+        import pyarrow
+    except ImportError:
+        raise ValueError("Parquet and Arrow uploads need pyarrow installed")
+    for batch in _arrow_batches(path, format, list(DTYPES), chunksize):
+        yield _arrow_to_frame(batch)
+
+
+def read_transactions(path, format=None, chunksize=1_000_000):
+    '''
+    Reads a transaction history from a CSV, Parquet or Arrow IPC file into a
+    compact frame: categorical Name and Location, float32 amounts and a single
+    parsed DateTime column. It's read chunksize rows at a time so only one chunk
+    is ever held as strings
+    '''
+    chunks = list(iter_transactions(path, format, chunksize))
+    if not chunks:
+        raise ValueError(f"{path} has no transactions")
+    return _concat(chunks)
@@ -0,0 +1,233 @@
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+import httpx
+from app.utils.metrics import span
+
+logger = logging.getLogger(__name__)
+
+
+class LedgerBusy(Exception):
+    pass
+
+
+class LedgerWriter:
+    '''
+    Records transactions on the ledger service off the request path. submit puts a
+    record on an in-process queue and returns right away, and background workers
+    send whatever has queued up in batches over a pool of kept-alive connections,
+    retrying failures with exponential backoff. Once max_pending records are
+    waiting, submit waits up to put_timeout for room and then raises LedgerBusy.
+
+    With a spool_path every record is also written to a SQLite file until the
+    ledger has it, so records that were still queued, or ran out of retries, are
+    sent again after a restart. The ledger service records each transaction once
+    however many times it's sent, so a batch that timed out can be sent again
+    whole.
+
+    The ledger writes a batch's records on-chain one after another, so a request
+    is given timeout plus record_timeout for every record in it
+    '''
+
+    def __init__(self, url, batch_size=20, max_wait=0.05, max_pending=10000, put_timeout=1.0,
+                 workers=1, max_retries=8, backoff=0.5, max_backoff=30.0, spool_path=None,
+                 timeout=10.0, record_timeout=5.0, transport=None):
+        self.url = url.rstrip('/')
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.spool_path = spool_path
+        self.timeout = timeout
+        self.record_timeout = record_timeout
+        self.transport = transport
+
+        self.client = None
+        self.queue = None
+        self.space = None
+        self.tasks = []
+        self.pending = 0
+        self.spool = None
+        # The spool is written from worker threads, one at a time
+        self.spool_lock = threading.Lock()
+
+        self.recorded = 0
+        self.failed = 0
+        self.retries = 0
+        self.rejected = 0
+        self.batches = 0
+
+    async def start(self):
+        if self.client is not None:
+            return
+        self.client = httpx.AsyncClient(
+            base_url=self.url,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.workers, max_keepalive_connections=self.workers),
+            transport=self.transport
+        )
+        self.queue = asyncio.Queue()
+        self.space = asyncio.Condition()
+
+        if self.spool_path:
+            self.spool = sqlite3.connect(self.spool_path, check_same_thread=False)
+            with self.spool:
+                self.spool.execute('PRAGMA journal_mode=WAL')
+                self.spool.execute(
+                    'CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                    'record TEXT NOT NULL, added_at REAL NOT NULL)'
+                )
+            # Whatever is still in the spool never made it to the ledger
+            rows = self.spool.execute('SELECT id, record FROM spool ORDER BY id').fetchall()
+            for spool_id, record in rows:
+                self.queue.put_nowait((spool_id, json.loads(record)))
+            self.pending += len(rows)
+            if rows:
+                logger.info("Re-sending %d spooled ledger records", len(rows))
+
+        self.tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10.0):
+        '''
+        Gives the queue up to timeout seconds to drain, then stops the workers.
+        Spooled records that didn't make it are sent on the next start
+        '''
+        if self.client is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping with %d ledger records not recorded", self.pending)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self.client.aclose()
+        self.client = None
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+    async def submit(self, record):
+        '''
+        Queues a record for the ledger. Raises LedgerBusy if the queue stays full
+        for put_timeout seconds
+        '''
+        async with self.space:
+            try:
+                await asyncio.wait_for(self.space.wait_for(lambda: self.pending < self.max_pending), self.put_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise LedgerBusy(f"{self.pending} ledger records are already waiting")
+            self.pending += 1
+
+        spool_id = None
+        if self.spool is not None:
+            # SQLite writes wait on the disk, they're kept off the event loop
+            spool_id = await asyncio.to_thread(self._spool_add, record)
+        self.queue.put_nowait((spool_id, record))
+
+    def _spool_add(self, record):
+        with self.spool_lock, self.spool:
+            return self.spool.execute(
+                'INSERT INTO spool (record, added_at) VALUES (?, ?)', (json.dumps(record), time.time())
+            ).lastrowid
+
+    def _spool_remove(self, spool_ids):
+        with self.spool_lock, self.spool:
+            self.spool.executemany('DELETE FROM spool WHERE id = ?', [(spool_id,) for spool_id in spool_ids])
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        # Give a few more records the chance to join the batch
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._send(batch)
+            except Exception as e:
+                logger.error("Error recording ledger batch: %s", e)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+                async with self.space:
+                    self.pending -= len(batch)
+                    self.space.notify_all()
+
+    async def _post(self, records):
+        '''
+        Sends records to the ledger and returns the ones it didn't take
+        '''
+        timeout = self.timeout + self.record_timeout * len(records)
+        try:
+            if len(records) == 1:
+                response = await self.client.post('/record-transaction', json=records[0][1], timeout=timeout)
+                return [] if response.status_code == 200 else records
+
+            response = await self.client.post('/record-transactions', json={"transactions": [r for _, r in records]},
+                                              timeout=timeout)
+            if response.status_code != 200:
+                return records
+            results = response.json().get('results', [])
+            return [item for i, item in enumerate(records) if i >= len(results) or not results[i].get('success')]
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning("Error connecting to ledger: %s", e)
+            return records
+
+    async def _send(self, batch):
+        self.batches += 1
+        remaining = batch
+        attempt = 0
+        while True:
+            with span('ledger_post'):
+                failed = await self._post(remaining)
+            failed_items = set(map(id, failed))
+            done = [item[0] for item in remaining if item[0] is not None and id(item) not in failed_items]
+            self.recorded += len(remaining) - len(failed)
+            if done and self.spool is not None:
+                await asyncio.to_thread(self._spool_remove, done)
+            if not failed:
+                return
+
+            attempt += 1
+            if attempt > self.max_retries:
+                self.failed += len(failed)
+                kept = " (kept in the spool)" if self.spool is not None else ""
+                logger.error("Giving up on %d ledger records after %d retries%s", len(failed), self.max_retries, kept)
+                return
+
+            self.retries += len(failed)
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            remaining = failed
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'recorded': self.recorded,
+            'failed': self.failed,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'batches': self.batches,
+            'spool': self.spool_path,
+        }
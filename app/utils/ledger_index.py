@@ -0,0 +1,196 @@
+import sqlite3
+import threading
+from web3 import Web3
+
+
+def decode_company_id(raw):
+    '''
+    companyId is a name padded out to bytes32, or an address padded on the left.
+    Anything that isn't text comes back as hex
+    '''
+    raw = bytes(raw)
+    try:
+        return Web3.to_text(raw).strip('\x00')
+    except UnicodeDecodeError:
+        return '0x' + raw.hex()
+
+
+def format_record(record):
+    '''
+    A contract record tuple as the API returns it
+    '''
+    id, data_hash, is_fraudulent, company_id = record[:4]
+    return {
+        "id": int(id),
+        "dataHash": '0x' + bytes(data_hash).hex(),
+        "isFraudulent": bool(is_fraudulent),
+        "companyId": decode_company_id(company_id)
+    }
+
+
+class LedgerIndex:
+    '''
+    Local SQLite copy of the transactions recorded on the contract, so reading the
+    ledger doesn't take one RPC call per record on every request. sync picks up
+    where the last one stopped: it reads TransactionRecorded and FraudFlagged events
+    in block ranges, so flags set after a record was written are picked up too, and
+    fetches any records the events didn't cover, in bulk if there's a reader
+    '''
+
+    def __init__(self, path, contract, w3, start_block=0, chunk_size=2000, reader=None):
+        self.contract = contract
+        self.w3 = w3
+        self.reader = reader
+        self.start_block = start_block
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, data_hash TEXT NOT NULL, '
+                'is_fraudulent INTEGER NOT NULL, company_id TEXT NOT NULL)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS records_company ON records (company_id, id)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS records_fraud ON records (is_fraudulent, id)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    def _get_state(self, key, default):
+        row = self.conn.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_state(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value))
+
+    def _store(self, id, data_hash, is_fraudulent, company_id):
+        record = format_record((id, data_hash, is_fraudulent, company_id))
+        # A flag is never cleared on the contract, so don't clear it here either
+        self.conn.execute(
+            'INSERT INTO records (id, data_hash, is_fraudulent, company_id) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET data_hash = excluded.data_hash, company_id = excluded.company_id, '
+            'is_fraudulent = MAX(is_fraudulent, excluded.is_fraudulent)',
+            (record["id"], record["dataHash"], int(record["isFraudulent"]), record["companyId"])
+        )
+
+    def _get_logs(self, event, from_block, to_block):
+        # Nodes limit how many blocks one query can cover, so shrink the range if it's refused
+        chunk = to_block - from_block + 1
+        logs = []
+        while from_block <= to_block:
+            end = min(to_block, from_block + chunk - 1)
+            try:
+                logs.extend(event.get_logs(from_block=from_block, to_block=end))
+            except Exception:
+                if chunk == 1:
+                    raise
+                chunk = max(1, chunk // 2)
+                continue
+            from_block = end + 1
+        return logs
+
+    def sync(self):
+        '''
+        Brings the index up to date with the chain. Returns how many records were
+        added or changed
+        '''
+        with self.lock:
+            changed = 0
+            last_block = self._get_state('last_block', self.start_block - 1)
+            latest = self.w3.eth.block_number
+
+            for from_block in range(last_block + 1, latest + 1, self.chunk_size):
+                to_block = min(latest, from_block + self.chunk_size - 1)
+                recorded = self._get_logs(self.contract.events.TransactionRecorded, from_block, to_block)
+                flagged = self._get_logs(self.contract.events.FraudFlagged, from_block, to_block)
+                with self.conn:
+                    for log in recorded:
+                        args = log['args']
+                        self._store(args['id'], args['dataHash'], args['isFraudulent'], args['companyId'])
+                    for log in flagged:
+                        self.conn.execute('UPDATE records SET is_fraudulent = 1 WHERE id = ?', (int(log['args']['id']),))
+                    self._set_state('last_block', to_block)
+                changed += len(recorded) + len(flagged)
+
+            # Records from before start_block, or that the events missed, are read directly
+            last_id = self._get_state('last_id', 0)
+            if self.reader is not None:
+                block = hex(latest)
+                count = self.reader.transaction_count(block)
+            else:
+                count = self.contract.functions.transactionCount().call()
+            if count > last_id:
+                known = {row[0] for row in self.conn.execute('SELECT id FROM records WHERE id > ?', (last_id,))}
+                missing = [i for i in range(last_id + 1, count + 1) if i not in known]
+                # Committed a slice at a time so a long catch-up isn't lost if it's interrupted
+                for start in range(0, len(missing), 10000):
+                    ids = missing[start:start + 10000]
+                    if self.reader is not None:
+                        records = [r for r in self.reader.get_many(ids, block).values() if r is not None]
+                    else:
+                        records = [self.contract.functions.transactions(i).call() for i in ids]
+                    with self.conn:
+                        for record in records:
+                            self._store(*record[:4])
+                        self._set_state('last_id', ids[-1])
+                    changed += len(records)
+                with self.conn:
+                    self._set_state('last_id', count)
+            return changed
+
+    def get(self, id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT id, data_hash, is_fraudulent, company_id FROM records WHERE id = ?', (id,)
+            ).fetchone()
+        return self._as_dict(row) if row else None
+
+    def get_many(self, ids):
+        '''
+        The indexed records among ids, as a dict of id -> record
+        '''
+        ids = [int(id) for id in ids]
+        records = {}
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = self.conn.execute(
+                    'SELECT id, data_hash, is_fraudulent, company_id FROM records WHERE id IN (%s)' % ','.join('?' * len(chunk)),
+                    chunk
+                ).fetchall()
+                records.update((row[0], self._as_dict(row)) for row in rows)
+        return records
+
+    def query(self, company_id=None, is_fraudulent=None, offset=0, limit=100):
+        '''
+        Records in ID order, optionally only one company's or only (non-)fraudulent
+        ones. Returns the page of records and how many match in total
+        '''
+        where = []
+        params = []
+        if company_id is not None:
+            where.append('company_id = ?')
+            params.append(company_id)
+        if is_fraudulent is not None:
+            where.append('is_fraudulent = ?')
+            params.append(int(bool(is_fraudulent)))
+        clause = (' WHERE ' + ' AND '.join(where)) if where else ''
+
+        with self.lock:
+            total = self.conn.execute('SELECT COUNT(*) FROM records' + clause, params).fetchone()[0]
+            rows = self.conn.execute(
+                'SELECT id, data_hash, is_fraudulent, company_id FROM records' + clause + ' ORDER BY id LIMIT ? OFFSET ?',
+                params + [limit, offset]
+            ).fetchall()
+        return [self._as_dict(row) for row in rows], total
+
+    def _as_dict(self, row):
+        return {
+            "id": row[0],
+            "dataHash": row[1],
+            "isFraudulent": bool(row[2]),
+            "companyId": row[3]
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
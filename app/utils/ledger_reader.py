@@ -0,0 +1,109 @@
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from web3 import Web3
+
+TRANSACTIONS_SELECTOR = bytes(Web3.keccak(text='transactions(uint256)')[:4]).hex()
+TRANSACTION_COUNT_SELECTOR = bytes(Web3.keccak(text='transactionCount()')[:4]).hex()
+
+
+class LedgerReadError(Exception):
+    pass
+
+
+def make_session(pool_size=10):
+    '''
+    An HTTP session with room for pool_size kept-alive connections, to share
+    between the reader and the Web3 provider
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class LedgerReader:
+    '''
+    Reads contract records in bulk. The transactions(i) calls are sent as batched
+    JSON-RPC requests, batch_size calls in each, with up to concurrency requests in
+    flight at once over one kept-alive session. Records come back as the same
+    (id, dataHash, isFraudulent, companyId) tuples a contract call returns
+    '''
+
+    def __init__(self, url, contract_address, batch_size=100, concurrency=4, timeout=30, session=None):
+        self.url = url
+        self.contract_address = contract_address
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.session = session or make_session(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='ledger-reader')
+        self.request_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def _call(self, data, block='latest'):
+        with self.lock:
+            request_id = next(self.request_ids)
+        return {
+            "jsonrpc": "2.0",
+            "id": request_id,
+            "method": "eth_call",
+            "params": [{"to": self.contract_address, "data": data}, block]
+        }
+
+    def _post(self, payload):
+        try:
+            response = self.session.post(self.url, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise LedgerReadError(f"Ledger read failed: {e}")
+
+    def transaction_count(self, block='latest'):
+        reply = self._post(self._call('0x' + TRANSACTION_COUNT_SELECTOR, block))
+        if 'error' in reply:
+            raise LedgerReadError(f"transactionCount failed: {reply['error']}")
+        return int(reply['result'], 16)
+
+    def _read_batch(self, ids, block):
+        calls = [self._call('0x' + TRANSACTIONS_SELECTOR + id.to_bytes(32, 'big').hex(), block) for id in ids]
+        replies = self._post(calls)
+        if not isinstance(replies, list):
+            # Nodes that don't take batches answer with a single error
+            raise LedgerReadError(f"Batch request refused: {replies.get('error', replies)}")
+
+        by_request = {reply.get('id'): reply for reply in replies}
+        records = {}
+        for id, call in zip(ids, calls):
+            reply = by_request.get(call['id'])
+            if reply is None or 'error' in reply:
+                raise LedgerReadError(f"Reading transaction {id} failed: {reply and reply['error']}")
+            data = bytes.fromhex(reply['result'][2:])
+            if len(data) < 128:
+                raise LedgerReadError(f"Short reply for transaction {id}")
+            record_id = int.from_bytes(data[0:32], 'big')
+            # Unused slots in the mapping read back as all zeroes
+            records[id] = None if record_id == 0 else (record_id, data[32:64], data[95] != 0, data[96:128])
+        return records
+
+    def get_many(self, ids, block='latest'):
+        '''
+        Reads the records with the given IDs. Returns a dict of id -> record, where
+        IDs with nothing recorded map to None
+        '''
+        ids = list(dict.fromkeys(int(id) for id in ids))
+        batches = [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+        records = {}
+        for result in self.executor.map(lambda batch: self._read_batch(batch, block), batches):
+            records.update(result)
+        return records
+
+    def get(self, id, block='latest'):
+        return self.get_many([id], block)[int(id)]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
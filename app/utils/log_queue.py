@@ -0,0 +1,46 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+_listener = None
+
+
+def start_logging(level='INFO', stream=None):
+    '''
+    Sends everything logged in this process through a queue to one background
+    thread that writes it to stream (stdout by default). Logging a message only
+    puts it on the queue, so a handler never waits on the terminal or a pipe.
+    Calling it again changes the level and keeps the running listener
+    '''
+    global _listener
+    root = logging.getLogger()
+    root.setLevel(level)
+    if _listener is not None:
+        return
+
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    # Whatever is still queued is written out when the process exits
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    '''
+    Writes out what's left on the queue and stops the listener thread
+    '''
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in logging.getLogger().handlers[:]:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logging.getLogger().removeHandler(handler)
+    _listener = None
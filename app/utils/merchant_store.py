@@ -0,0 +1,83 @@
+import sqlite3
+import threading
+import time
+
+
+class MerchantStore:
+    '''
+    Known merchant names in a single SQLite file, each with the official company
+    name it stands for and where it came from. Opening it doesn't read the names,
+    exact lookups go straight to the primary key index. The file is in WAL mode so
+    any number of threads and workers can read while one writes, and every insert
+    is its own transaction on an already open connection
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS merchants ('
+                'name TEXT PRIMARY KEY, official_name TEXT NOT NULL, source TEXT NOT NULL, added_at REAL NOT NULL)'
+            )
+
+    def _conn(self):
+        # One connection per thread, so readers never wait on each other
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def __contains__(self, name):
+        row = self._conn().execute('SELECT 1 FROM merchants WHERE name = ?', (name,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM merchants').fetchone()[0]
+
+    def official_name(self, name):
+        '''
+        The official company name an alias stands for, or None if it isn't known
+        '''
+        row = self._conn().execute('SELECT official_name FROM merchants WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def names(self):
+        '''
+        Every known name, in the order they were added
+        '''
+        return [row[0] for row in self._conn().execute('SELECT name FROM merchants ORDER BY rowid')]
+
+    def add(self, name, official_name=None, source='verified'):
+        '''
+        Adds a name if it isn't known yet. Returns whether it was added
+        '''
+        with self._conn() as conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO merchants (name, official_name, source, added_at) VALUES (?, ?, ?, ?)',
+                (name, official_name or name, source, time.time())
+            )
+        return cursor.rowcount == 1
+
+    def add_many(self, rows, source):
+        '''
+        Adds (name, official_name) pairs in one transaction, skipping names already
+        known. Returns how many were added
+        '''
+        now = time.time()
+        with self._conn() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR IGNORE INTO merchants (name, official_name, source, added_at) VALUES (?, ?, ?, ?)',
+                ((name, official or name, source, now) for name, official in rows)
+            )
+            return conn.total_changes - before
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
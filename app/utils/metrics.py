@@ -0,0 +1,175 @@
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds of the histogram buckets in seconds, from 10 µs up to 10 s
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+           0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = []
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    '''
+    A count that only goes up, one per combination of label values
+    '''
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            values = sorted(self.values.items())
+        lines += [f'{self.name}{_labels(self.labels, labels)} {value}' for labels, value in values]
+        return lines
+
+
+class Gauge:
+    '''
+    A value read with read() whenever the metrics are rendered
+    '''
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+        METRICS.append(self)
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {self.read()}']
+
+
+class Histogram:
+    '''
+    How long something took, counted into BUCKETS, one set of buckets per
+    combination of label values. Timing a block with span costs about a
+    microsecond, so it can go on every request
+    '''
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Label values -> [count in each bucket and past the last one, sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def span(self, *labels):
+        return Span(self, labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            values = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self.values.items())
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labels, labels)} {count}')
+        return lines
+
+
+class Span:
+    '''
+    Times a with block into a histogram, whether or not it raises
+    '''
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+# The stages a transaction goes through on its way to a score, and the request as a whole
+STAGE_SECONDS = Histogram('fraud_api_stage_seconds', 'Time spent in each stage of scoring a transaction', ('stage',))
+REQUEST_SECONDS = Histogram('fraud_api_request_seconds', 'Time to answer a request, by route', ('route',))
+REQUESTS = Counter('fraud_api_requests_total', 'Requests answered, by route and status code', ('route', 'status'))
+MERCHANT_CHECKS = Counter('fraud_api_merchant_checks_total',
+                          'Merchant legitimacy checks, by what answered them', ('source',))
+
+
+def span(stage):
+    '''
+    Times a with block as one of the scoring stages in STAGE_SECONDS
+    '''
+    return Span(STAGE_SECONDS, (stage,))
+
+
+def render():
+    '''
+    Every metric in the Prometheus text format
+    '''
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+class RequestMetrics:
+    '''
+    ASGI middleware that times every HTTP request into REQUEST_SECONDS and counts
+    it in REQUESTS, under the path of the route it matched rather than the URL,
+    so IDs in paths don't make a series each
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            REQUEST_SECONDS.observe(time.perf_counter() - start, route)
+            REQUESTS.inc(route, str(status[0]))
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import sqlite3
+import threading
+import time
+
+# How long each kind of LLM verdict is trusted for, in seconds
+DEFAULT_TTLS = {
+    'Yes': 30 * 24 * 3600,
+    'No': 7 * 24 * 3600,
+    'error': 5 * 60,
+}
+
+
+class VerdictCache:
+    '''
+    Bounded LRU cache of merchant legitimacy verdicts, each kept for as long as the
+    TTL of its outcome ('Yes', 'No' or 'error'). Every write goes through to a small
+    SQLite file so verdicts survive restarts, and the file is trimmed along with the
+    in-memory entries so it stays bounded too
+    '''
+
+    def __init__(self, path, capacity=100_000, ttls=None):
+        self.path = path
+        self.capacity = capacity
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS verdicts ('
+                'name TEXT PRIMARY KEY, verdict TEXT NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL)'
+            )
+        self._load()
+
+    def _load(self):
+        now = time.time()
+        with self.conn:
+            self.conn.execute('DELETE FROM verdicts WHERE expires_at <= ?', (now,))
+            # Recency on disk is the time of the last write, hits aren't written back
+            rows = self.conn.execute(
+                'SELECT name, verdict, expires_at FROM verdicts ORDER BY used_at DESC LIMIT ?', (self.capacity,)
+            ).fetchall()
+            # Anything past capacity would have been evicted already
+            if len(rows) == self.capacity:
+                self.conn.execute(
+                    'DELETE FROM verdicts WHERE name NOT IN '
+                    '(SELECT name FROM verdicts ORDER BY used_at DESC LIMIT ?)', (self.capacity,)
+                )
+
+        # Oldest first, so the most recently used end up at the back of the LRU
+        for name, verdict, expires_at in reversed(rows):
+            self.entries[name] = (verdict, expires_at)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, name):
+        '''
+        Returns the cached verdict for name, or None if there isn't a live one
+        '''
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            verdict, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[name]
+                with self.conn:
+                    self.conn.execute('DELETE FROM verdicts WHERE name = ?', (name,))
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(name)
+            self.hits += 1
+            return verdict
+
+    def put(self, name, verdict):
+        '''
+        Caches a verdict, which must be one of the outcomes there's a TTL for
+        '''
+        if verdict not in self.ttls:
+            raise ValueError(f"No TTL configured for verdict {verdict!r}")
+
+        now = time.time()
+        expires_at = now + self.ttls[verdict]
+        with self.lock:
+            self.entries[name] = (verdict, expires_at)
+            self.entries.move_to_end(name)
+
+            evicted = []
+            while len(self.entries) > self.capacity:
+                evicted.append(self.entries.popitem(last=False)[0])
+                self.evictions += 1
+
+            with self.conn:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO verdicts (name, verdict, expires_at, used_at) VALUES (?, ?, ?, ?)',
+                    (name, verdict, expires_at, now)
+                )
+                self.conn.executemany('DELETE FROM verdicts WHERE name = ?', [(e,) for e in evicted])
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+            }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,193 @@
+import logging
+import re
+from abc import ABC, abstractmethod
+import threading
+import time
+import openai
+from app.utils.metrics import span
+
+logger = logging.getLogger(__name__)
+
+VERIFY_PROMPT = """
+I am attempting to detect fraudulent purchases with the help of an LLM to determine whether a company is real and trustworthy.
+I will provide a numbered list of company names, and you should respond with 'Yes' if the company is legitimate and is a place that an individual
+would typically purchase something from using a personal credit card. If the company is not real or if it is something that
+an individual would not typically purchase with their personal credit card (e.g., Lockheed Martin, Naval Nuclear Laboratory),
+respond with 'No.' Typical credit card users would be more likely to buy things from popular restaurants, retailers, and some
+specialty stores (that regular people still shop at). Respond with one line per company, in the form '<number>. Yes' or
+'<number>. No'. Do not elaborate or state anything other than 'Yes' or 'No.'
+
+Note: Product names, such as 'iPhone,' should also be treated as 'No' because they represent a product and not a company that
+would appear on a credit card transaction.
+
+Please think hard about what companies a typical individual would be purchasing from on their normal credit card. Even if
+a company is legitimate and trustworthy in name, a purchase from them by a personal card might still be fraud and should be
+marked 'No.'
+
+Companies:
+{companies}
+"""
+
+ANSWER_LINE = re.compile(r'^\s*(\d+)\s*[.):-]?\s*(yes|no)\b', re.IGNORECASE | re.MULTILINE)
+
+
+class MerchantVerifier(ABC):
+    '''
+    Decides whether merchants are places people really buy from with a personal
+    card. verify takes a list of names and returns a dict of name -> 'Yes' or 'No'.
+    Names it couldn't get an answer for are left out, and raising fails the
+    whole batch
+    '''
+
+    @abstractmethod
+    def verify(self, names):
+        pass
+
+
+class OpenAIVerifier(MerchantVerifier):
+    '''
+    Asks the LLM about a whole batch of merchants in one prompt
+    '''
+
+    def __init__(self, model="gpt-3.5-turbo"):
+        self.model = model
+
+    def verify(self, names):
+        companies = "\n".join(f"{i}. {name}" for i, name in enumerate(names, start=1))
+        response = openai.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": VERIFY_PROMPT.format(companies=companies)}
+            ],
+            max_tokens=10 * len(names),
+            temperature=0  # lower the more deterministic the output
+        )
+
+        answer = response.choices[0].message.content
+        verdicts = {}
+        for number, verdict in ANSWER_LINE.findall(answer):
+            i = int(number) - 1
+            if 0 <= i < len(names):
+                verdicts[names[i]] = "Yes" if verdict.lower() == "yes" else "No"
+        return verdicts
+
+
+class StubVerifier(MerchantVerifier):
+    '''
+    Local stand-in for tests and offline runs. Answers 'Yes' for the given names,
+    the default for everything else, and can sleep to act like a real round-trip
+    '''
+
+    def __init__(self, legitimate=(), default="No", delay=0.0):
+        self.legitimate = {name.upper() for name in legitimate}
+        self.default = default
+        self.delay = delay
+        self.calls = 0
+
+    def verify(self, names):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return {name: "Yes" if name.upper() in self.legitimate else self.default for name in names}
+
+
+class VerificationQueue:
+    '''
+    Verifies merchants off the request path. Names are submitted as they come in,
+    and a background thread groups whatever has queued up (up to batch_size, or
+    after max_wait seconds) into a single verify call. Every outcome, 'Yes', 'No'
+    or 'error', is handed to on_verdict(key, verdict) from the worker thread
+    '''
+
+    def __init__(self, verifier, on_verdict, batch_size=20, max_wait=0.5):
+        self.verifier = verifier
+        self.on_verdict = on_verdict
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.pending = {}
+        self.in_flight = set()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.batches = 0
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self._run, name="merchant-verifier", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def submit(self, key, name=None):
+        '''
+        Queues a merchant for verification. key is what the verdict is reported
+        under and name is what gets sent to the verifier. Merchants already waiting
+        or being verified aren't queued twice
+        '''
+        with self.cond:
+            if key in self.pending or key in self.in_flight:
+                return
+            self.pending[key] = name if name is not None else key
+            self.cond.notify_all()
+
+    def is_pending(self, key):
+        with self.cond:
+            return key in self.pending or key in self.in_flight
+
+    def __len__(self):
+        with self.cond:
+            return len(self.pending) + len(self.in_flight)
+
+    def _next_batch(self):
+        with self.cond:
+            while self.running and not self.pending:
+                self.cond.wait()
+            if not self.pending:
+                return None
+
+            # Give a few more names the chance to join the batch
+            deadline = time.monotonic() + self.max_wait
+            while self.running and len(self.pending) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            batch = dict(list(self.pending.items())[:self.batch_size])
+            for key in batch:
+                del self.pending[key]
+            self.in_flight.update(batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            try:
+                with span('llm_verify'):
+                    verdicts = self.verifier.verify(list(batch.values()))
+            except Exception as e:
+                logger.error("Merchant verification failed: %s", e)
+                verdicts = {}
+            self.batches += 1
+
+            for key, name in batch.items():
+                try:
+                    self.on_verdict(key, verdicts.get(name, "error"))
+                except Exception as e:
+                    logger.error("Error handling verdict for %s: %s", name, e)
+                finally:
+                    with self.cond:
+                        self.in_flight.discard(key)
@@ -0,0 +1,490 @@
+'''
+Load test for the API. Starts the app under uvicorn, in its own process by
+default or on a thread of this one with --in-process, with a stub ledger in
+place of the ledger service on localhost:3001 and the stub merchant verifier in
+place of the LLM. Each of --users synthetic users gets a model trained on the
+first --train-rows rows of their history, and the rows after that are replayed
+against /predict one at a time and /predict/batch --batch-rows at a time, at
+every --concurrency level in turn (that many requests in flight at once).
+
+For each endpoint and level it reports the throughput and the p50, p95 and p99
+latency of each stage: the request as the client sees it, for /predict the
+time from its response to the record reaching the ledger in the background,
+and every stage the app times itself and exposes on /metrics (the request on
+its side, merchant checks, feature building, predict_proba, the ledger post
+and so on), read before and after the level.
+Everything is written as JSON to --out along with the commit it ran on, and
+--compare prints the change from an earlier run.
+
+The app runs in a scratch directory with its own models, verdict cache and
+addresses, and its output goes to server.log there. Run from the project root:
+
+    python benchmarks/bench_api.py [--users 4] [--concurrency 1 8 32] [--requests 2000] [--out bench_api.json]
+'''
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import httpx
+import numpy as np
+
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+sys.path.append(str(project_root / 'data'))
+
+import synthetic_data_generator as generator
+
+PERCENTILES = (50, 95, 99)
+
+
+class StubLedger:
+    '''
+    Takes records the way the ledger service does, one or a batch per request,
+    and notes when each transaction ID arrived
+    '''
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.arrived = {}
+        self.requests = 0
+        ledger = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if ledger.latency:
+                    time.sleep(ledger.latency)
+                records = body['transactions'] if self.path == '/record-transactions' else [body]
+                now = time.perf_counter()
+                ledger.requests += 1
+                for record in records:
+                    ledger.arrived[record['transactionId']] = now
+                data = json.dumps({'success': True, 'results': [{'success': True} for _ in records]}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def commit():
+    try:
+        head = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=project_root, capture_output=True, text=True, check=True)
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=project_root,
+                               capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return head.stdout.strip(), bool(dirty.stdout.strip())
+
+
+def make_workdir(root, ledger_url, args):
+    '''
+    The directory layout the app expects when it's run from app/, with
+    ethereum_addresses.txt one level up, and the environment it runs with
+    '''
+    os.makedirs(os.path.join(root, 'app'))
+    with open(os.path.join(root, 'ethereum_addresses.txt'), 'w') as f:
+        f.writelines(f"0x{i:040x}\n" for i in range(1, args.addresses + 1))
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(filter(None, [str(project_root), os.environ.get('PYTHONPATH')])),
+               MODEL_DIR=os.path.join(root, 'models'),
+               VERDICT_CACHE_PATH=os.path.join(root, 'verdict_cache.db'),
+               MERCHANT_STORE_PATH=os.path.join(root, 'merchants.db'),
+               LEDGER_URL=ledger_url,
+               MERCHANT_VERIFIER='stub',
+               STUB_VERIFIER_DELAY=str(args.verifier_latency / 1000))
+    return os.path.join(root, 'app'), env
+
+
+@contextlib.contextmanager
+def run_server(cwd, env, port, in_process, log_path):
+    '''
+    Serves the app on port until the block exits
+    '''
+    with open(log_path, 'w') as log:
+        if in_process:
+            import uvicorn
+            os.environ.update(env)
+            os.chdir(cwd)
+            server = uvicorn.Server(uvicorn.Config('app.main:app', host='127.0.0.1', port=port, log_level='warning'))
+            # Whatever the app prints goes to the log, as it would under its own process
+            with contextlib.redirect_stdout(log):
+                thread = threading.Thread(target=server.run, daemon=True)
+                thread.start()
+                try:
+                    yield
+                finally:
+                    server.should_exit = True
+                    thread.join(60)
+        else:
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'uvicorn', 'app.main:app', '--host', '127.0.0.1', '--port', str(port),
+                 '--log-level', 'warning'],
+                cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT
+            )
+            try:
+                yield
+            finally:
+                process.terminate()
+                try:
+                    process.wait(60)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+
+async def wait_until_up(client, timeout=120):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if (await client.get('/')).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"The API didn't come up within {timeout} s, see server.log")
+        await asyncio.sleep(0.2)
+
+
+def make_users(args, workdir):
+    '''
+    Each user's training CSV and the transactions to replay after it, in time order
+    '''
+    rng = np.random.default_rng(args.seed)
+    replay_rows = args.requests + args.warmup + args.batch_requests * args.batch_rows
+    replay_rows = len(args.concurrency) * -(-replay_rows // args.users)
+    users = []
+    for i in range(args.users):
+        user = generator.random_user(rng)
+        frame = generator.to_frame(user, generator.generate_rows(user, args.train_rows + replay_rows, rng))
+        path = os.path.join(workdir, f'train-{i}.csv')
+        frame[:args.train_rows].to_csv(path, index=False)
+
+        replay = frame[args.train_rows:args.train_rows + replay_rows]
+        transactions = [
+            {'DateTime': f"{date} {clock}", 'Name': name, 'Amount': float(amount), 'Location': location,
+             'Zip': int(zip_code), 'Balance': float(balance)}
+            for date, clock, name, amount, location, zip_code, balance in zip(
+                replay['Date'], replay['Time'], replay['Name'], replay['Amount'], replay['Location'],
+                replay['Zip'], replay['Balance'])
+        ]
+        users.append((f'bench-{i}', path, transactions))
+    return users
+
+
+async def train(client, user_id, path, poll=0.5):
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        response = await client.post('/train', data={'user_id': user_id}, files={'file': (os.path.basename(path), f)})
+    response.raise_for_status()
+    job_id = response.json()['job_id']
+    while True:
+        job = (await client.get(f'/train/{job_id}')).json()
+        if job['status'] == 'done':
+            return time.perf_counter() - start
+        if job['status'] == 'failed':
+            raise RuntimeError(f"Training {user_id} failed: {job.get('error')}")
+        await asyncio.sleep(poll)
+
+
+def summarize(times_ms):
+    if not times_ms:
+        return None
+    times_ms = np.asarray(times_ms)
+    summary = {f'p{p}_ms': float(np.percentile(times_ms, p)) for p in PERCENTILES}
+    summary['mean_ms'] = float(times_ms.mean())
+    return summary
+
+
+async def replay(client, requests, concurrency):
+    '''
+    Sends (path, user_id, body) requests with concurrency of them in flight,
+    taking them in order. Returns each one's status, start and finish time, and
+    the JSON it got back
+    '''
+    results = [None] * len(requests)
+    queue = iter(enumerate(requests))
+
+    async def worker():
+        for i, (path, user_id, body) in queue:
+            start = time.perf_counter()
+            try:
+                response = await client.post(path, params={'user_id': user_id}, json=body)
+                status = response.status_code
+                reply = response.json() if status == 200 else None
+            except httpx.HTTPError as e:
+                status, reply = type(e).__name__, None
+            results[i] = (status, start, time.perf_counter(), reply)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+
+async def wait_for_ledger(client, timeout=60):
+    # Ledger records go out in the background, give them the chance to land
+    deadline = time.monotonic() + timeout
+    while (await client.get('/ledger/stats')).json()['pending'] and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+
+
+def read_histograms(text):
+    '''
+    The histograms in a /metrics page, (name, label) -> [cumulative bucket
+    counts by upper bound, sum, count], where label is the metric's one label
+    '''
+    histograms = {}
+    for line in text.splitlines():
+        if line.startswith('#') or '{' not in line:
+            continue
+        series, value = line.rsplit(' ', 1)
+        name, labels = series[:-1].split('{', 1)
+        labels = dict(pair.split('=', 1) for pair in labels.split(','))
+        le = labels.pop('le', None)
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and len(labels) == 1:
+                entry = histograms.setdefault((name[:-len(suffix)], next(iter(labels.values())).strip('"')), [[], 0.0, 0])
+                if suffix == '_bucket':
+                    entry[0].append((float(le.strip('"')), float(value)))
+                else:
+                    entry[1 if suffix == '_sum' else 2] = float(value)
+    return histograms
+
+
+def histogram_summary(before, after):
+    '''
+    Percentiles of what was observed between two reads of a histogram,
+    interpolated within buckets the way Prometheus' histogram_quantile does
+    '''
+    if before is None:
+        before = [[(bound, 0) for bound, _ in after[0]], 0.0, 0]
+    buckets = [(bound, count - old) for (bound, count), (_, old) in zip(after[0], before[0])]
+    total = after[2] - before[2]
+    if not total:
+        return None
+    summary = {}
+    for p in PERCENTILES:
+        rank = total * p / 100
+        lower, below = 0.0, 0
+        for bound, count in buckets:
+            if count >= rank:
+                value = lower if bound == float('inf') else lower + (bound - lower) * (rank - below) / (count - below)
+                break
+            lower, below = bound, count
+        summary[f'p{p}_ms'] = value * 1000
+    summary['mean_ms'] = (after[1] - before[1]) / total * 1000
+    return summary
+
+
+async def run_level(client, ledger, endpoint, requests, rows_per_request, concurrency, warmup):
+    await replay(client, requests[:warmup], concurrency)
+    requests = requests[warmup:]
+    before = read_histograms((await client.get('/metrics')).text)
+    start = time.perf_counter()
+    results = await replay(client, requests, concurrency)
+    seconds = time.perf_counter() - start
+
+    statuses = {}
+    for status, *_ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = [result for result in results if result[0] == 200]
+    stages = {'request': summarize([(end - begin) * 1000 for _, begin, end, _ in ok])}
+    if endpoint == 'predict':
+        await wait_for_ledger(client)
+        stages['ledger'] = summarize([
+            (ledger.arrived[reply['transaction_id']] - end) * 1000
+            for _, _, end, reply in ok if reply['transaction_id'] in ledger.arrived
+        ])
+
+    # What the app timed itself while the level ran: the request from its side,
+    # and each stage of scoring (see /metrics)
+    after = read_histograms((await client.get('/metrics')).text)
+    route = '/' + endpoint
+    if ('fraud_api_request_seconds', route) in after:
+        stages['server'] = histogram_summary(before.get(('fraud_api_request_seconds', route)),
+                                             after[('fraud_api_request_seconds', route)])
+    for (name, stage), histogram in sorted(after.items()):
+        if name == 'fraud_api_stage_seconds':
+            summary = histogram_summary(before.get((name, stage)), histogram)
+            if summary is not None:
+                stages[stage] = summary
+
+    return {
+        'endpoint': endpoint,
+        'concurrency': concurrency,
+        'requests': len(results),
+        'rows_per_request': rows_per_request,
+        'errors': len(results) - len(ok),
+        'status_codes': statuses,
+        'seconds': seconds,
+        'throughput_rps': len(ok) / seconds,
+        'rows_per_s': len(ok) * rows_per_request / seconds,
+        'stages': stages,
+    }
+
+
+def interleave(users, count, offset):
+    # Takes turns between users, each one's transactions in time order
+    per_user = [transactions[offset:] for _, _, transactions in users]
+    ordered = []
+    for i in range(max(map(len, per_user))):
+        for (user_id, _, _), transactions in zip(users, per_user):
+            if i < len(transactions):
+                ordered.append((user_id, transactions[i]))
+    return ordered[:count]
+
+
+async def run_load(args, base_url, ledger, users):
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        await wait_until_up(client)
+        print(f"Training {len(users)} models on {args.train_rows:,} rows each", file=sys.stderr)
+        training = [{'user_id': user_id, 'seconds': await train(client, user_id, path)}
+                    for user_id, path, _ in users]
+
+        runs = []
+        per_level = args.requests + args.warmup + args.batch_requests * args.batch_rows
+        for level, concurrency in enumerate(args.concurrency):
+            # Each level replays transactions the ones before it haven't
+            offset = level * -(-per_level // len(users))
+            ordered = interleave(users, per_level, offset)
+            single = [('/predict', user_id, transaction) for user_id, transaction in ordered[:args.requests + args.warmup]]
+            runs.append(await run_level(client, ledger, 'predict', single, 1, concurrency, args.warmup))
+
+            if args.batch_requests:
+                batches = {}
+                for user_id, transaction in ordered[args.requests + args.warmup:]:
+                    batches.setdefault(user_id, []).append(transaction)
+                batched = [('/predict/batch', user_id, transactions[i:i + args.batch_rows])
+                           for user_id, transactions in batches.items()
+                           for i in range(0, len(transactions), args.batch_rows)]
+                warmup = min(len(batched) // 10, args.warmup)
+                runs.append(await run_level(client, ledger, 'predict/batch', batched, args.batch_rows,
+                                            concurrency, warmup))
+            for run in runs[-2 if args.batch_requests else -1:]:
+                print_run(run, file=sys.stderr)
+    return training, runs
+
+
+def print_run(run, file=sys.stdout):
+    print(f"{run['endpoint']} x{run['concurrency']}: {run['throughput_rps']:,.1f} req/s, "
+          f"{run['rows_per_s']:,.1f} rows/s, {run['errors']} errors", file=file)
+    for stage, s in run['stages'].items():
+        if s:
+            print(f"    {stage:>18}  p50 {s['p50_ms']:>9.3f}  p95 {s['p95_ms']:>9.3f}  p99 {s['p99_ms']:>9.3f} ms",
+                  file=file)
+
+
+def compare(previous, result):
+    '''
+    Prints how throughput and request p99 moved since an earlier run
+    '''
+    before = {(run['endpoint'], run['concurrency']): run for run in previous['runs']}
+    print(f"Compared with {previous.get('commit') or 'an earlier run'}:")
+    for run in result['runs']:
+        old = before.get((run['endpoint'], run['concurrency']))
+        if old is None or not run['stages']['request'] or not old['stages']['request']:
+            continue
+        throughput = run['throughput_rps'] / old['throughput_rps'] - 1
+        p99 = run['stages']['request']['p99_ms'] / old['stages']['request']['p99_ms'] - 1
+        print(f"{run['endpoint']:>14} x{run['concurrency']:<3} throughput {throughput:+7.1%}, request p99 {p99:+7.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--train-rows', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=2000, help='/predict requests per concurrency level')
+    parser.add_argument('--batch-requests', type=int, default=100, help='/predict/batch requests per level, 0 to skip')
+    parser.add_argument('--batch-rows', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=50, help='requests sent before each level that are not counted')
+    parser.add_argument('--ledger-latency', type=float, default=5.0, help='ms the stub ledger waits per request')
+    parser.add_argument('--verifier-latency', type=float, default=500.0, help='ms the stub verifier waits per batch')
+    parser.add_argument('--addresses', type=int, default=1000)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--in-process', action='store_true', help='serve the app on a thread of this process')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--out', default='bench_api.json')
+    parser.add_argument('--compare', help='an earlier --out to compare with')
+    parser.add_argument('--keep', action='store_true', help="keep the app's scratch directory")
+    args = parser.parse_args()
+    # The app is run from its scratch directory, which --in-process changes into
+    args.out = os.path.abspath(args.out)
+    args.compare = args.compare and os.path.abspath(args.compare)
+
+    head, dirty = commit()
+    started = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    ledger = StubLedger(args.ledger_latency / 1000)
+    root = tempfile.mkdtemp(prefix='bench_api_')
+    try:
+        cwd, env = make_workdir(root, ledger.url, args)
+        users = make_users(args, root)
+        port = free_port()
+        with run_server(cwd, env, port, args.in_process, os.path.join(root, 'server.log')):
+            training, runs = asyncio.run(run_load(args, f'http://127.0.0.1:{port}', ledger, users))
+    finally:
+        ledger.close()
+        if args.keep:
+            print(f"App directory kept in {root}", file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    result = {
+        'benchmark': 'api',
+        'commit': head,
+        'dirty': dirty,
+        'started_at': started,
+        'machine': {'cpus': os.cpu_count(), 'python': platform.python_version(), 'platform': platform.platform()},
+        'config': vars(args),
+        'training': training,
+        'runs': runs,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    for run in runs:
+        print_run(run)
+    print(f"Results written to {args.out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
+
+
+if __name__ == '__main__':
+    main()
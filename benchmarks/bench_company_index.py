@@ -0,0 +1,100 @@
+'''
+Benchmarks CompanyIndex against the linear process.extractOne scan it replaced,
+at 10k, 100k and 1M merchant names. The names are the real company list padded
+out with made-up names built from its own tokens, and every query is checked to
+give the same name and score both ways.
+
+Run from the project root:
+
+    python benchmarks/bench_company_index.py [--sizes 10000 100000 1000000] [--queries 8]
+'''
+import argparse
+import csv
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from fuzzywuzzy import process, fuzz
+from app.utils.company_index import CompanyIndex
+
+SUFFIXES = ['', '', '', ' INC', ' LLC', ' CO', ' GROUP', ' HOLDINGS', ' & SONS', ' CORP']
+QUERIES = ['WAWA', 'PUBLIX', "TRADER JOE'S", 'FREE BITCOIN', 'PAYPAL', 'UNKNOWN', 'COMPUTERPART',
+           "MCDONALD'S", 'WALMART SUPERCENTER', 'AMAZON MKTP', 'STARBUCKS #1234', 'SHELL OIL 5742']
+
+
+def load_names():
+    with open(os.path.join(project_root, 'data', 'combined_comp_database.csv'), newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader)
+        return [row[0] for row in reader]
+
+
+def make_names(base, size, rng):
+    vocab = sorted({token for name in base for token in name.split() if token.isalpha()})
+    names = list(base[:size])
+    seen = set(names)
+    while len(names) < size:
+        name = ' '.join(rng.choice(vocab) for _ in range(rng.randint(1, 3))) + rng.choice(SUFFIXES)
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+def mutate(name, rng):
+    chars = list(name)
+    for _ in range(rng.randint(1, 2)):
+        i = rng.randrange(len(chars))
+        chars[i] = rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+    return ''.join(chars)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--queries', type=int, default=8, help='misspelled names to query on top of the fixed ones, the linear scan at 1M takes seconds each')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    base = load_names()
+
+    print(f"{'names':>10} {'build s':>9} {'linear ms':>11} {'index ms':>10} {'speedup':>9} {'candidates':>11}  match")
+    for size in args.sizes:
+        names = make_names(base, size, rng)
+
+        start = time.perf_counter()
+        index = CompanyIndex(names)
+        build = time.perf_counter() - start
+
+        queries = QUERIES + [mutate(rng.choice(names), rng) for _ in range(args.queries)]
+
+        linear = indexed = 0.0
+        candidates = 0
+        same = True
+        for query in queries:
+            start = time.perf_counter()
+            expected = process.extractOne(query, names, scorer=fuzz.token_set_ratio, score_cutoff=80)
+            linear += time.perf_counter() - start
+
+            start = time.perf_counter()
+            result = index.extract_one(query, score_cutoff=80)
+            indexed += time.perf_counter() - start
+
+            candidates += len(index.candidates(index._process_query(query)))
+            if expected != result:
+                same = False
+                print(f"  mismatch for {query!r}: scan={expected} index={result}")
+
+        n = len(queries)
+        print(f"{size:>10,} {build:>9.2f} {linear / n * 1e3:>11.2f} {indexed / n * 1e3:>10.3f} "
+              f"{linear / indexed:>8.0f}x {candidates // n:>11,}  {'yes' if same else 'NO'}")
+
+
+if __name__ == '__main__':
+    main()
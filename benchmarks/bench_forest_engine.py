@@ -0,0 +1,86 @@
+'''
+Benchmarks scoring with FlatForest, the fraud model's forest laid out as flat
+arrays, against the forest's own predict_proba, at batch sizes of 1, 64 and 4096
+rows. The model is trained the way train_model does it on a synthetic history of
+--rows transactions. FlatForest is timed with its NumPy version, and with the
+Numba kernel when Numba is installed (the first call, which compiles it, isn't
+counted).
+
+For each batch size it reports the median time per call and per row, and the
+largest difference from predict_proba, which has to stay under 1e-9.
+
+Run from the project root:
+
+    python benchmarks/bench_forest_engine.py [--rows 100000] [--sizes 1 64 4096] [--repeats 200]
+'''
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+os.environ.setdefault('MERCHANT_VERIFIER', 'stub')
+
+from app.models.fraud_model import process_data, train_model
+from app.models.forest_engine import FlatForest, numba
+from bench_compact_training import make_history
+
+
+def median_seconds(predict, X, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict(X)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--locations', type=int, default=40)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 64, 4096])
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        X, y, *_ = process_data(make_history(args.rows, args.locations, rng), {'credit_score': 650, 'age': 35})
+        model, _, X_test, _, columns = train_model(X, y)
+    del X, y
+
+    engines = {'predict_proba': model}
+    engines['FlatForest numpy'] = FlatForest(model, use_numba=False)
+    if numba is not None:
+        engines['FlatForest numba'] = FlatForest(model, use_numba=True)
+    else:
+        print("Numba isn't installed, only the NumPy version of FlatForest is timed")
+    nodes = sum(estimator.tree_.node_count for estimator in model.estimators_)
+    print(f"{len(model.estimators_)} trees, {nodes:,} nodes, {len(columns)} features, "
+          f"flat arrays {engines['FlatForest numpy'].nbytes / 1024:,.0f} KiB")
+
+    for size in args.sizes:
+        batch = X_test[rng.integers(0, len(X_test), size)]
+        expected = model.predict_proba(batch)
+        repeats = max(5, args.repeats * 64 // max(size, 64))
+        baseline = None
+        for name, engine in engines.items():
+            # Warms up caches and compiles the Numba kernel before timing
+            diff = np.abs(engine.predict_proba(batch) - expected).max()
+            seconds = median_seconds(engine.predict_proba, batch, repeats)
+            baseline = baseline or seconds
+            print(f"batch {size:>5} {name:>17}: {seconds * 1e6:>10,.1f} us per call, {seconds / size * 1e6:>8.2f} us per row, "
+                  f"{baseline / seconds:>6.1f}x, max diff {diff:.1e}")
+            assert diff <= 1e-9, f"{name} differs from predict_proba by {diff}"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+'''
+Benchmarks bulk ledger reads against a local stub node, at 1k, 10k and 100k
+records. The stub answers eth_call for the contract's transactions(i) and
+transactionCount(), one call or a JSON-RPC batch per request, and sleeps for
+--latency ms per request to stand in for the round-trip to a real node.
+
+One call per record (what the endpoints used to do) is timed on the first
+--baseline records only, since it takes minutes at 100k, and its rate is compared
+with batched reads of the whole ledger. Every record read is checked against
+what the stub holds.
+
+Run from the project root:
+
+    python benchmarks/bench_ledger_reader.py [--sizes 1000 10000 100000] [--latency 2]
+'''
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from app.utils.ledger_reader import LedgerReader, TRANSACTIONS_SELECTOR, TRANSACTION_COUNT_SELECTOR
+
+CONTRACT = '0x5FbDB2315678afecb367f032d93F642f64180aa3'
+COMPANIES = [b'WAWA', b'PUBLIX', b'TARGET', b'AMAZON', b'SHELL OIL']
+
+
+def make_record(i):
+    return (i, i.to_bytes(4, 'big') * 8, i % 17 == 0, COMPANIES[i % len(COMPANIES)].ljust(32, b'\0'))
+
+
+class StubNode:
+    '''
+    Just enough of an Ethereum node to answer the contract's read calls
+    '''
+
+    def __init__(self, count, latency):
+        self.count = count
+        self.latency = latency
+        self.requests = 0
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                # Headers and body go out as separate writes, don't let them wait on delayed ACKs
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                node.requests += 1
+                if node.latency:
+                    time.sleep(node.latency)
+                reply = [node.answer(call) for call in body] if isinstance(body, list) else node.answer(body)
+                data = json.dumps(reply).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def answer(self, call):
+        data = call['params'][0]['data'][2:]
+        if data == TRANSACTION_COUNT_SELECTOR:
+            result = self.count.to_bytes(32, 'big')
+        elif data.startswith(TRANSACTIONS_SELECTOR):
+            i = int(data[8:], 16)
+            if 1 <= i <= self.count:
+                id, data_hash, is_fraudulent, company_id = make_record(i)
+                result = id.to_bytes(32, 'big') + data_hash + int(is_fraudulent).to_bytes(32, 'big') + company_id
+            else:
+                result = bytes(128)
+        else:
+            return {'jsonrpc': '2.0', 'id': call['id'], 'error': {'code': -32601, 'message': 'unknown call'}}
+        return {'jsonrpc': '2.0', 'id': call['id'], 'result': '0x' + result.hex()}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def read_all(reader, ids):
+    start = time.perf_counter()
+    records = reader.get_many(ids)
+    elapsed = time.perf_counter() - start
+    same = all(records[i] == make_record(i) for i in ids)
+    return elapsed, same
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--latency', type=float, default=2.0, help='ms the stub node waits per HTTP request')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--baseline', type=int, default=1_000, help='records to time one call at a time')
+    args = parser.parse_args()
+
+    print(f"{'records':>9} {'1-by-1 rec/s':>13} {'batched rec/s':>14} {'batched s':>10} {'requests':>9} {'speedup':>8}  match")
+    for size in args.sizes:
+        node = StubNode(size, args.latency / 1000)
+
+        single = LedgerReader(node.url, CONTRACT, batch_size=1, concurrency=1)
+        ids = list(range(1, min(size, args.baseline) + 1))
+        single_time, single_same = read_all(single, ids)
+        single_rate = len(ids) / single_time
+        single.close()
+
+        batched = LedgerReader(node.url, CONTRACT, batch_size=args.batch_size, concurrency=args.concurrency)
+        node.requests = 0
+        count = batched.transaction_count()
+        batched_time, batched_same = read_all(batched, range(1, count + 1))
+        batched_rate = count / batched_time
+        batched.close()
+
+        print(f"{size:>9,} {single_rate:>13,.0f} {batched_rate:>14,.0f} {batched_time:>10.2f} {node.requests:>9,} "
+              f"{batched_rate / single_rate:>7.0f}x  {'yes' if single_same and batched_same else 'NO'}")
+        node.close()
+
+
+if __name__ == '__main__':
+    main()
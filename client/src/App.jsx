@@ -68,8 +68,21 @@ const FraudDetectionDashboard = () => {
           method: 'POST',
           body: formData,
         });
-        const data = await response.json();
-        setTrainingMessage(data.message);
+        const { job_id } = await response.json();
+
+        // Training runs in the background, poll until the job is finished
+        let job;
+        do {
+          await new Promise(resolve => setTimeout(resolve, 1000));
+          const statusResponse = await fetch(`http://127.0.0.1:8000/train/${job_id}`);
+          job = await statusResponse.json();
+        } while (job.status === 'queued' || job.status === 'running');
+
+        if (job.status === 'done') {
+          setTrainingMessage(job.message);
+        } else {
+          setTrainingMessage('Error training model. Please try again.');
+        }
       } catch (error) {
         console.error('Error training model:', error);
         setTrainingMessage('Error training model. Please try again.');
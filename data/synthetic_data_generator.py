@@ -1,163 +1,115 @@
-import random
-from datetime import timedelta
+'''
+Synthetic transaction histories: paychecks every two weeks, bills on the 1st
+and 7th of the month, a few purchases a day and fraud on about one day in ten.
+Every row of a stretch of days is drawn at once with NumPy rather than one at a
+time.
+
+Run it to write one user's history as a CSV, as it always has:
+
+    python data/synthetic_data_generator.py [--entries 1000] [--csv transactionsPredict.csv]
+
+or thousands of users with their own habits, generated across a process pool
+and streamed to Parquet files under --out, with the users' details in
+users.jsonl next to them:
+
+    python data/synthetic_data_generator.py --users 10000 --rows-per-user 10000 --out data/synthetic
+'''
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 
 credit_score = 710
 age = 42
 
-def fraud_purchase(current_date, balance):
-    location = [
-        'Los Angeles CA',
-        'New York NY',
-        'London EN',
-        'Pittsburgh PA',
-        'Honolulu HI',
-        'Tokyo JP',
-        'Charleston SC',
-        'Mexico City MC',
-        'Anchorage AL',
-        'Groton CT'
-    ]
-
-    random_location = random.choice(location)
-
-    names = [
-        'Paypal',
-        'Online',
-        'Valley',
-        'Unknown',
-        'User',
-        'ComputerPart',
-        'Free Bitcoin'
-    ]
-
-    random_name = random.choice(names)
-
-    hour = random.randint(0, 5)
-    minute = random.randint(0, 59)
-    time = f"{hour:02d}:{minute:02d}:00"
-    amount = round(-random.uniform(100, 1800), 2)
+COLUMNS = ['Date', 'Time', 'Name', 'Amount', 'Location', 'Zip', 'Balance', 'Fraud']
 
-    return {
-        "Date": current_date.date(),
-        "Time": time,
-        "Name": random_name,
-        "Amount": amount,
-        "Location": random_location,
-        "Zip": random.randint(11111, 99999),
-        "Balance": round(balance + amount, 2)
-    }, balance
-
-def random_purchase(current_date, balance, weights):
-    location_zip = {
-        'Oviedo FL': '32765',
-        'Orlando FL': '32816',
-        'Winter Park FL': '32789'
-    }
+CATEGORIES = {
+    "Shopping": ["Amazon", "Target", "Best Buy", "Walmart", "Home Depot", "Petco"],
+    "Groceries": ["Kroger", "Publix", "Trader Joe's", "Whole Foods", "Lowes Foods"],
+    "Food": ["McDonald's", "Starbucks", "Subway", "Panera", "Smoothie King", "Qdoba"],
+    "Gas": ["Shell", "BP", "Chevron", "Exxon", "7-Eleven", "Racetrac", "Wawa"],
+    "Car Expense": ["AutoZone", "Midas", "Pep Boys", "Take5", "Valvoline"],
+    "Entertainment": ["Movie Theater", "Concert Tickets", "Disney World", "Movie Rental"],
+    "Miscellaneous": ["Walgreens", "CVS", "Dollar Tree", "Five Below", "Gamestop"]
+}
+# The spending range of a purchase in each category
+AMOUNT_RANGES = {
+    "Shopping": (10, 150),
+    "Groceries": (30, 100),
+    "Food": (5, 40),
+    "Gas": (10, 30),
+    "Car Expense": (40, 200),
+    "Entertainment": (10, 60),
+    "Miscellaneous": (5, 50),
+}
+DEFAULT_WEIGHTS = {
+    "Shopping": 1.5,
+    "Groceries": 1,
+    "Food": 3,
+    "Gas": 1,
+    "Car Expense": 0.5,
+    "Entertainment": 1,
+    "Miscellaneous": 1
+}
 
-    random_location = random.choice(list(location_zip.keys()))
-    zip_code = location_zip[random_location]
-
-    categories = {
-        "Shopping": ["Amazon", "Target", "Best Buy", "Walmart", "Home Depot", "Petco"],
-        "Groceries": ["Kroger", "Publix", "Trader Joe's", "Whole Foods", "Lowes Foods"],
-        "Food": ["McDonald's", "Starbucks", "Subway", "Panera", "Smoothie King", "Qdoba"],
-        "Gas": ["Shell", "BP", "Chevron", "Exxon", "7-Eleven", "Racetrac", "Wawa"],
-        "Car Expense": ["AutoZone", "Midas", "Pep Boys", "Take5", "Valvoline"],
-        "Entertainment": ["Movie Theater", "Concert Tickets", "Disney World", "Movie Rental"],
-        "Miscellaneous": ["Walgreens", "CVS", "Dollar Tree", "Five Below", "Gamestop"]
-    }
+# Where users live and shop, the first one is where the default user lives
+HOME_LOCATIONS = {
+    'Oviedo FL': 32765,
+    'Orlando FL': 32816,
+    'Winter Park FL': 32789,
+    'Austin TX': 73301,
+    'Denver CO': 80202,
+    'Seattle WA': 98101,
+    'Columbus OH': 43215,
+    'Raleigh NC': 27601,
+    'Phoenix AZ': 85004,
+    'Boston MA': 2108,
+}
+FRAUD_LOCATIONS = ['Los Angeles CA', 'New York NY', 'London EN', 'Pittsburgh PA', 'Honolulu HI', 'Tokyo JP',
+                   'Charleston SC', 'Mexico City MC', 'Anchorage AL', 'Groton CT']
+FRAUD_NAMES = ['Paypal', 'Online', 'Valley', 'Unknown', 'User', 'ComputerPart', 'Free Bitcoin']
 
-    # Pick a random category based on weights
-    category = random.choices(list(categories.keys()), weights=list(weights.values()))[0]
-    name = random.choice(categories[category])
-    
-    # Assign a spending range based on the category
-    match category:
-        case "Shopping":
-            amount = round(-random.uniform(10, 150), 2)
-        case "Groceries":
-            amount = round(-random.uniform(30, 100), 2)
-        case "Food":
-            amount = round(-random.uniform(5, 40), 2)
-        case "Gas":
-            amount = round(-random.uniform(10, 30), 2)
-        case "Car Expense":
-            amount = round(-random.uniform(40, 200), 2)
-        case "Entertainment":
-            amount = round(-random.uniform(10, 60), 2)
-        case _:
-            amount = round(-random.uniform(5, 50), 2)
-
-    # Modify spending amounts based on credit score and balance
-    credit_mod = 800 / credit_score
-    balance_mod = 1
-
-    if balance > 6000:
-        balance_mod = 1.5
-    elif balance > 8000:
-        balance_mod = 2
-    elif balance > 10000:
-        balance_mod = 2.5
-    elif balance > 12000:
-        balance_mod = 3
-
-    amount = round(amount * balance_mod * credit_mod, 2)
-    balance = round(balance + amount, 2)
-    
-    # Choose spending hours for a particular user
-    hours_start = age % 24
-    hours_end = (age + 6) % 24
-
-    if hours_start > hours_end:
-        hours_temp = hours_start
-        hours_start = hours_end
-        hours_end = hours_temp
-
-    hour = random.randint(hours_start, hours_end)
-    minute = random.randint(0, 59)
-    time = f"{hour:02d}:{minute:02d}:00"
+# Bills by the day of the month they're paid on, in the order they're paid
+BILLS = {1: ["Rent", "Insurance", "Car", "Utilities"], 7: ["Spotify", "Internet", "Streaming"]}
 
-    return {
-        "Date": current_date.date(),
-        "Time": time,
-        "Name": name,
-        "Amount": amount,
-        "Location": random_location,
-        "Zip": zip_code,
-        "Balance": balance
-    }, balance
-
-def generate_transactions(num_entries=100, weights=None):
-    if weights is None:
-        weights = {
-            "Shopping": 1.5,
-            "Groceries": 1,
-            "Food": 3,
-            "Gas": 1,
-            "Car Expense": 0.5,
-            "Entertainment": 1,
-            "Miscellaneous": 1
-        }
-
-    data = {
-        "Date": [],
-        "Time": [],
-        "Name": [],
-        "Amount": [],
-        "Location": [],
-        "Zip": [],
-        "Balance": [],
-        "Fraud": []
-    }
-    
-    # Get car and rent costs based on age, credit, and income
-    balance = 3745.87
-    paycheck_amount = 3000.00
-    car = round((-paycheck_amount / 12) * (800 / credit_score), 2)
-    rent = round((-paycheck_amount / 2) * (40 / age), 2)
-
-    recurring_bills = {
+# Every name and location as one vocabulary each, rows hold their positions in them
+MERCHANTS = [name for names in CATEGORIES.values() for name in names]
+NAMES = ['Paycheck'] + BILLS[1] + BILLS[7] + MERCHANTS + FRAUD_NAMES
+LOCATIONS = list(HOME_LOCATIONS) + [loc for loc in FRAUD_LOCATIONS if loc not in HOME_LOCATIONS]
+TIMES = np.array([f"{minute // 60:02d}:{minute % 60:02d}:00" for minute in range(24 * 60)], dtype=object)
+
+# Each category's merchants as a slice of MERCHANTS
+_category_start = np.cumsum([0] + [len(names) for names in CATEGORIES.values()])[:-1]
+_category_size = np.array([len(names) for names in CATEGORIES.values()])
+_category_low = np.array([AMOUNT_RANGES[c][0] for c in CATEGORIES], dtype=np.float64)
+_category_high = np.array([AMOUNT_RANGES[c][1] for c in CATEGORIES], dtype=np.float64)
+_merchant_offset = NAMES.index(MERCHANTS[0])
+_fraud_offset = NAMES.index(FRAUD_NAMES[0])
+_fraud_location_codes = np.array([LOCATIONS.index(loc) for loc in FRAUD_LOCATIONS])
+_home_zips = np.array(list(HOME_LOCATIONS.values()))
+
+# Kinds of rows, in the order they come in a day
+PAYCHECK, BILL, PURCHASE, FRAUD = range(4)
+
+
+def default_user(credit_score=credit_score, age=age, weights=None):
+    '''
+    The user the generator has always made: lives in Oviedo FL and shops around
+    Orlando, paid 3000 every two weeks
+    '''
+    return make_user(credit_score, age, weights or DEFAULT_WEIGHTS, balance=3745.87, paycheck=3000.0,
+                     homes=[0, 1, 2], max_purchases=5, fraud_rate=0.1)
+
+
+def make_user(credit_score, age, weights, balance, paycheck, homes, max_purchases, fraud_rate, start='2012-01-01'):
+    # Car and rent costs based on age, credit and income
+    car = round((-paycheck / 12) * (800 / credit_score), 2)
+    rent = round((-paycheck / 2) * (40 / age), 2)
+    bills = {
         "Car": car,
         "Rent": rent,
         "Spotify": -12,
@@ -167,86 +119,266 @@ def generate_transactions(num_entries=100, weights=None):
         "Streaming": round(-25 * (40 / age), 2),
     }
 
-    # Dates for recurring bills
-    day_1_bills = ["Rent", "Insurance", "Car", "Utilities"]
-    day_7_bills = ["Spotify", "Internet", "Streaming"]
-
-    current_date = pd.to_datetime("2012-01-01")
-    paycheck_date = current_date
-
-    while len(data["Date"]) < num_entries:
-        # Add paycheck every 2 weeks
-        if current_date == paycheck_date:
-            balance = round(balance + paycheck_amount, 2)
-            data["Date"].append(paycheck_date.date())
-            data["Time"].append("08:00:00")
-            data["Name"].append("Paycheck")
-            data["Amount"].append(paycheck_amount)
-            data["Location"].append("Oviedo FL")
-            data["Zip"].append(32765)
-            data["Balance"].append(balance)
-            data["Fraud"].append(0)
-            paycheck_date += timedelta(days=14)
-
-        # Add recurring bills on the 1st of the month
-        if current_date.day == 1:
-            for bill in day_1_bills:
-                amount = recurring_bills[bill]
-                balance = round(balance + amount, 2)
-                data["Date"].append(current_date.date())
-                data["Time"].append("09:00:00")
-                data["Name"].append(bill)
-                data["Amount"].append(amount)
-                data["Location"].append("Oviedo FL")
-                data["Zip"].append(32765)
-                data["Balance"].append(balance)
-                data["Fraud"].append(0)
-
-        # Add recurring bills on the 7th of the month
-        if current_date.day == 7:
-            for bill in day_7_bills:
-                amount = recurring_bills[bill]
-                balance = round(balance + amount, 2)
-                data["Date"].append(current_date.date())
-                data["Time"].append("09:00:00")
-                data["Name"].append(bill)
-                data["Amount"].append(amount)
-                data["Location"].append("Oviedo FL")
-                data["Zip"].append(32765)
-                data["Balance"].append(balance)
-                data["Fraud"].append(0)
-
-        # Add a number of random purchases each day
-        num_rand = random.randint(0, 5)
-        i = 0
-        while i < num_rand:
-            random_transaction, balance = random_purchase(current_date, balance, weights)
-            data["Date"].append(random_transaction["Date"])
-            data["Time"].append(random_transaction["Time"])
-            data["Name"].append(random_transaction["Name"])
-            data["Amount"].append(random_transaction["Amount"])
-            data["Location"].append(random_transaction["Location"])
-            data["Zip"].append(random_transaction["Zip"])
-            data["Balance"].append(random_transaction["Balance"])
-            data["Fraud"].append(0)
-            i = i + 1
-
-        # Insert fraud transactions randomly
-        if random.randint(1, 10) == 1:
-            fraud_transaction, balance = fraud_purchase(current_date, balance)
-            data["Date"].append(fraud_transaction["Date"])
-            data["Time"].append(fraud_transaction["Time"])
-            data["Name"].append(fraud_transaction["Name"])
-            data["Amount"].append(fraud_transaction["Amount"])
-            data["Location"].append(fraud_transaction["Location"])
-            data["Zip"].append(fraud_transaction["Zip"])
-            data["Balance"].append(fraud_transaction["Balance"])
-            data["Fraud"].append(1)
-        current_date += timedelta(days=1)
-
-    return pd.DataFrame(data)
-
-result = generate_transactions(num_entries=1000)
-
-output_file = 'transactionsPredict.csv'
-result.to_csv(output_file, index=False)
+    # Spending hours for a particular user
+    hours = sorted((age % 24, (age + 6) % 24))
+
+    return {
+        'credit_score': int(credit_score),
+        'age': int(age),
+        'weights': [float(weights[c]) for c in CATEGORIES],
+        'balance': float(balance),
+        'paycheck': float(paycheck),
+        'bills': bills,
+        'homes': [int(h) for h in homes],
+        'hours': hours,
+        'max_purchases': int(max_purchases),
+        'fraud_rate': float(fraud_rate),
+        'start': start,
+    }
+
+
+def random_user(rng):
+    '''
+    A user with their own habits: credit score, age, income, where they live,
+    what they spend on and how often, and how often their card is used for fraud
+    '''
+    base = np.array([DEFAULT_WEIGHTS[c] for c in CATEGORIES])
+    weights = dict(zip(CATEGORIES, base * rng.gamma(2.0, 0.5, len(base))))
+    homes = rng.choice(len(HOME_LOCATIONS), int(rng.integers(1, 4)), replace=False)
+    return make_user(
+        credit_score=int(rng.integers(500, 851)), age=int(rng.integers(18, 81)), weights=weights,
+        balance=round(float(rng.uniform(500, 8000)), 2), paycheck=round(float(rng.lognormal(np.log(3000), 0.35)), 2),
+        homes=homes, max_purchases=int(rng.integers(2, 9)), fraud_rate=float(rng.uniform(0.02, 0.15)),
+        start=str(np.datetime64('2012-01-01') + int(rng.integers(0, 3 * 365)))
+    )
+
+
+def _draw_days(user, first_day, days, rng):
+    '''
+    Every row of days days of a user's history from first_day (days since the
+    user's start) at once, in the order they happen in each day. Purchase amounts
+    are left unscaled, they depend on the balance
+    '''
+    day = np.arange(first_day, first_day + days)
+    dates = np.datetime64(user['start'], 'D') + day
+    day_of_month = (dates - dates.astype('datetime64[M]')).astype(np.int64) + 1
+    home = user['homes'][0]
+    # Columns of each kind of row: day, name, amount, minute of the day, location
+    parts = {}
+
+    # Paycheck every 2 weeks
+    paid = day[day % 14 == 0]
+    n = len(paid)
+    parts[PAYCHECK] = (paid, np.full(n, NAMES.index('Paycheck')), np.full(n, user['paycheck']),
+                       np.full(n, 8 * 60), np.full(n, home))
+
+    # Recurring bills on the 1st and 7th of the month
+    bill_parts = []
+    for bill_day, bills in BILLS.items():
+        due = day[day_of_month == bill_day]
+        n = len(due) * len(bills)
+        bill_parts.append((np.repeat(due, len(bills)), np.tile([NAMES.index(b) for b in bills], len(due)),
+                           np.tile([user['bills'][b] for b in bills], len(due)), np.full(n, 9 * 60), np.full(n, home)))
+    # The 1st and 7th never fall on the same day, so putting them in day order is enough
+    bills = [np.concatenate(column) for column in zip(*bill_parts)]
+    order = np.argsort(bills[0], kind='stable')
+    parts[BILL] = tuple(column[order] for column in bills)
+
+    # A number of random purchases each day
+    counts = rng.integers(0, user['max_purchases'] + 1, days)
+    n = int(counts.sum())
+    weights = np.asarray(user['weights'])
+    category = rng.choice(len(weights), n, p=weights / weights.sum())
+    low, high = user['hours']
+    parts[PURCHASE] = (
+        np.repeat(day, counts),
+        _merchant_offset + _category_start[category] + (rng.random(n) * _category_size[category]).astype(np.int64),
+        np.round(-rng.uniform(_category_low[category], _category_high[category]), 2),
+        rng.integers(low, high + 1, n) * 60 + rng.integers(0, 60, n),
+        np.asarray(user['homes'])[rng.integers(0, len(user['homes']), n)],
+    )
+
+    # Fraud transactions on random days, late at night somewhere far away
+    hit = day[rng.random(days) < user['fraud_rate']]
+    n = len(hit)
+    parts[FRAUD] = (hit, _fraud_offset + rng.integers(0, len(FRAUD_NAMES), n), np.round(-rng.uniform(100, 1800, n), 2),
+                    rng.integers(0, 6, n) * 60 + rng.integers(0, 60, n),
+                    _fraud_location_codes[rng.integers(0, len(FRAUD_LOCATIONS), n)])
+
+    kinds = np.concatenate([np.full(len(columns[0]), kind) for kind, columns in parts.items()])
+    days_, names, amounts, minutes, locations = (np.concatenate(column) for column in zip(*parts.values()))
+    # By day, then by kind, keeping each kind's own order
+    order = np.lexsort((kinds, days_))
+    rows = {'day': days_[order], 'kind': kinds[order], 'name': names[order], 'amount': amounts[order],
+            'minute': minutes[order], 'location': locations[order]}
+    rows['fraud'] = rows['kind'] == FRAUD
+    rows['zip'] = np.where(rows['fraud'], rng.integers(11111, 100000, len(order)),
+                           _home_zips[np.minimum(rows['location'], len(_home_zips) - 1)])
+    return rows
+
+
+def _apply_balance(user, rows, balance):
+    '''
+    Scales purchases by credit score and balance, and runs the balance through
+    the rows in whole cents. The balance the scale goes by is the one the rows
+    start from, not the one before each purchase, which is what lets a block of
+    days be drawn at once. Fraud shows in its own row's balance but doesn't
+    carry over. Returns the amounts, balances and the balance left
+    '''
+    credit_mod = 800 / user['credit_score']
+    balance_mod = 1.5 if balance > 6000 else 1
+    purchase = rows['kind'] == PURCHASE
+    amounts = np.where(purchase, np.round(rows['amount'] * balance_mod * credit_mod, 2), rows['amount'])
+    cents = np.rint(amounts * 100).astype(np.int64)
+    running = int(round(balance * 100)) + np.cumsum(np.where(rows['fraud'], 0, cents))
+    balances = running + np.where(rows['fraud'], cents, 0)
+    left = running[-1] / 100 if len(running) else balance
+    return cents / 100, balances / 100, left
+
+
+def generate_rows(user, num_entries, rng, block_days=30):
+    '''
+    A user's history as arrays (see _draw_days), with at least num_entries rows,
+    ending at the end of a day. Days are drawn block_days at a time
+    '''
+    blocks = []
+    total = 0
+    balance = user['balance']
+    first_day = 0
+    while total < num_entries:
+        rows = _draw_days(user, first_day, block_days, rng)
+        rows['amount'], rows['balance'], balance = _apply_balance(user, rows, balance)
+        blocks.append(rows)
+        total += len(rows['day'])
+        first_day += block_days
+
+    rows = {key: np.concatenate([block[key] for block in blocks]) for key in blocks[0]}
+    # Stop after the day the num_entries-th row falls on
+    if num_entries > 0:
+        end = np.searchsorted(rows['day'], rows['day'][num_entries - 1], side='right')
+        rows = {key: values[:end] for key, values in rows.items()}
+    return rows
+
+
+def to_frame(user, rows):
+    dates = np.datetime64(user['start'], 'D') + rows['day']
+    return pd.DataFrame({
+        'Date': pd.to_datetime(dates).date,
+        'Time': TIMES[rows['minute']],
+        'Name': np.asarray(NAMES, dtype=object)[rows['name']],
+        'Amount': rows['amount'],
+        'Location': np.asarray(LOCATIONS, dtype=object)[rows['location']],
+        'Zip': rows['zip'],
+        'Balance': rows['balance'],
+        'Fraud': rows['fraud'].astype(int),
+    }, columns=COLUMNS)
+
+
+def generate_transactions(num_entries=100, weights=None, credit_score=credit_score, age=age, seed=None):
+    '''
+    One user's history with at least num_entries rows, as a DataFrame with the
+    columns training expects. The same seed gives the same history
+    '''
+    rng = np.random.default_rng(seed)
+    user = default_user(credit_score, age, weights)
+    return to_frame(user, generate_rows(user, num_entries, rng))
+
+
+def _arrow_table(user_ids, users, rows_list):
+    import pyarrow as pa
+    rows = {key: np.concatenate([rows[key] for rows in rows_list]) for key in rows_list[0]}
+    starts = np.concatenate([np.full(len(r['day']), np.datetime64(u['start'], 'D')) for u, r in zip(users, rows_list)])
+    seconds = ((starts + rows['day']).astype('datetime64[s]').astype(np.int64) + rows['minute'] * 60)
+    return pa.table({
+        'UserId': pa.array(np.repeat(user_ids, [len(r['day']) for r in rows_list]).astype(np.int32)),
+        'DateTime': pa.array(seconds, type=pa.timestamp('s')),
+        'Name': pa.DictionaryArray.from_arrays(rows['name'].astype(np.int32), NAMES),
+        'Amount': pa.array(rows['amount']),
+        'Location': pa.DictionaryArray.from_arrays(rows['location'].astype(np.int32), LOCATIONS),
+        'Zip': pa.array(rows['zip'].astype(np.int32)),
+        'Balance': pa.array(rows['balance']),
+        'Fraud': pa.array(rows['fraud'].astype(np.int8)),
+    })
+
+
+def write_users(path, first_user, n_users, rows_per_user, seed, row_group_rows=1_000_000):
+    '''
+    Generates users first_user to first_user + n_users - 1 into one Parquet
+    file, a row group at a time. Every user draws from their own seed, so a user
+    comes out the same whichever worker makes them. Returns the users' details
+    and the number of rows written
+    '''
+    import pyarrow.parquet as pq
+    users = {}
+    written = 0
+    pending = []
+    writer = None
+    try:
+        for user_id in range(first_user, first_user + n_users):
+            rng = np.random.default_rng([seed, user_id])
+            user = random_user(rng)
+            users[user_id] = user
+            pending.append((user_id, user, generate_rows(user, rows_per_user, rng)))
+            if sum(len(p[2]['day']) for p in pending) >= row_group_rows or user_id == first_user + n_users - 1:
+                ids, pending_users, rows_list = zip(*pending)
+                table = _arrow_table(np.array(ids), pending_users, rows_list)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                written += table.num_rows
+                pending = []
+    finally:
+        if writer is not None:
+            writer.close()
+    return users, written
+
+
+def generate_users(n_users, rows_per_user, out_dir, seed=0, workers=None, users_per_file=100):
+    '''
+    Generates n_users users with their own habits, about rows_per_user rows each,
+    across a pool of worker processes. Each worker streams its users to its own
+    Parquet file under out_dir (part-00000.parquet, ...) with the users' IDs in a
+    UserId column, and their details go to out_dir/users.jsonl. Returns the
+    number of rows written
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    total = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool, \
+            open(os.path.join(out_dir, 'users.jsonl'), 'w', encoding='utf-8') as users_file:
+        futures = []
+        for part, first_user in enumerate(range(0, n_users, users_per_file)):
+            path = os.path.join(out_dir, f'part-{part:05d}.parquet')
+            futures.append(pool.submit(write_users, path, first_user, min(users_per_file, n_users - first_user),
+                                       rows_per_user, seed))
+        for future in futures:
+            users, written = future.result()
+            total += written
+            for user_id, user in users.items():
+                users_file.write(json.dumps(dict(user, user_id=user_id)) + '\n')
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=1000)
+    parser.add_argument('--csv', default='transactionsPredict.csv')
+    parser.add_argument('--users', type=int, default=0)
+    parser.add_argument('--rows-per-user', type=int, default=10000)
+    parser.add_argument('--out', default='synthetic')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    if not args.users:
+        result = generate_transactions(num_entries=args.entries, seed=args.seed)
+        result.to_csv(args.csv, index=False)
+        return
+
+    start = time.perf_counter()
+    rows = generate_users(args.users, args.rows_per_user, args.out, seed=args.seed or 0, workers=args.workers)
+    elapsed = time.perf_counter() - start
+    print(f"{rows:,} rows for {args.users:,} users in {elapsed:.1f} s ({rows / elapsed:,.0f} rows/s), written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
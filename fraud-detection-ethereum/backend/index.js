@@ -56,86 +56,147 @@ function hashTransactionData(transactionData) {
     return crypto.createHash('sha256').update(dataString).digest('hex');
 }
 
-app.post('/record-transaction', async (req, res) => {
-  const transactionData = req.body;
+// Saves a transaction, updates its company's risk score and records it on the
+// blockchain. Returns the blockchain transaction hash.
+//
+// The API retries whatever it didn't get an answer for, so the same transaction
+// can arrive more than once. Each step is done once per transaction: the Mongo
+// document for (transactionId, dataHash) is upserted and notes which steps are
+// done. A retry of one that's already on-chain gets its hash back, and one that
+// another request is still writing is refused so it's retried later. The data
+// hash is part of the key because the API numbers transactions from 1 again
+// after a restart
+async function recordTransaction(transactionData) {
   const { isFraudulent = false } = transactionData;
 
-  try {
-    // Generate data hash
-    const dataHash = hashTransactionData(transactionData);
+  // Generate data hash
+  const dataHash = hashTransactionData(transactionData);
+  const key = { transactionId: transactionData.transactionId, dataHash };
+
+  // Save transaction data to MongoDB, once
+  const { transactionId, ...fields } = transactionData;
+  await transactionsCollection.updateOne(
+    key,
+    { $setOnInsert: fields },
+    { upsert: true }
+  );
+
+  // Update company's transaction counts, once
+  const counted = await transactionsCollection.updateOne(
+    { ...key, counted: { $ne: true } },
+    { $set: { counted: true } }
+  );
+  const companyId = transactionData.companyId;
+  if (counted.modifiedCount === 1) {
+    await countTransaction(companyId, isFraudulent);
+  }
 
-    // Add hash to transaction data
-    transactionData.dataHash = dataHash;
+  // Record transaction on blockchain, once. Whoever sets chainState first writes it
+  const claimed = await transactionsCollection.findOneAndUpdate(
+    { ...key, chainState: { $exists: false } },
+    { $set: { chainState: 'sending' } },
+    { returnDocument: 'before', includeResultMetadata: true }
+  );
+  if (!claimed.value) {
+    const existing = await transactionsCollection.findOne(key);
+    if (existing && existing.txHash) {
+      return existing.txHash;
+    }
+    throw new Error(`Transaction ${transactionId} is already being recorded`);
+  }
 
-    const senderAddress = transactionData.senderAddress || wallet.address; // Use the address tied to the wallet
+  // Convert companyId to bytes32
+  const companyIdBytes32 = stringToBytes32(companyId);
 
-    // Save transaction data to MongoDB
-    await transactionsCollection.insertOne(transactionData);
+  console.log('Data Hash:', `0x${dataHash}`);
+  console.log('Is Fraudulent:', isFraudulent);
+  console.log('Company ID (bytes32):', companyIdBytes32);
 
-    // Update company's transaction counts
-    const companyId = transactionData.companyId;
-    const updateFields = {
-      $inc: { totalTransactions: 1 },
-      $setOnInsert: { companyId: companyId },
-    };
+  let tx;
+  try {
+    tx = await contract.recordTransaction(`0x${dataHash}`, isFraudulent, companyIdBytes32);
+  } catch (error) {
+    // Nothing was sent, let a retry have another go
+    await transactionsCollection.updateOne(key, { $unset: { chainState: '' } });
+    throw error;
+  }
+  // Sent, a retry from here on gets this hash rather than writing it again
+  await transactionsCollection.updateOne(key, { $set: { txHash: tx.hash } });
+  await tx.wait();
+  await transactionsCollection.updateOne(key, { $set: { chainState: 'recorded' } });
 
-    if (isFraudulent) {
-      updateFields.$inc.fraudulentTransactions = 1;
-    }
+  return tx.hash;
+}
 
-    const options = { returnDocument: 'after', upsert: true };
-
-    const updatedCompany = await companiesCollection.findOneAndUpdate(
-      { companyId: companyId },
-      updateFields,
-      options
-    );
-
-    if (!updatedCompany.value) {
-      // Fetch the document if value is null
-      const companyDoc = await companiesCollection.findOne({ companyId: companyId });
-      if (!companyDoc) {
-        return res.status(500).send({ success: false, message: 'Error retrieving company data' });
-      }
-      updatedCompany.value = companyDoc;
-    }
+// Counts a transaction against its company and updates the company's risk score
+async function countTransaction(companyId, isFraudulent) {
+  const updateFields = {
+    $inc: { totalTransactions: 1 },
+    $setOnInsert: { companyId: companyId },
+  };
 
-    // Calculate new risk score
-    const totalTransactions = updatedCompany.value.totalTransactions || 1;
-    const fraudulentTransactions = updatedCompany.value.fraudulentTransactions || 0;
-    const riskScore = (fraudulentTransactions / totalTransactions) * 100;
-
-    // Update risk score
-    await companiesCollection.updateOne(
-      { companyId: companyId },
-      { $set: { riskScore: riskScore } }
-    );
-
-    // Convert companyId to bytes32
-    let companyIdBytes32;
-    if (ethers.utils.isAddress(companyId)) {
-      // If companyId is an Ethereum address
-      companyIdBytes32 = ethers.utils.hexZeroPad(companyId, 32);
-    } else {
-      // If companyId is a string
-      companyIdBytes32 = ethers.utils.formatBytes32String(companyId);
+  if (isFraudulent) {
+    updateFields.$inc.fraudulentTransactions = 1;
+  }
+
+  const options = { returnDocument: 'after', upsert: true };
+
+  const updatedCompany = await companiesCollection.findOneAndUpdate(
+    { companyId: companyId },
+    updateFields,
+    options
+  );
+
+  if (!updatedCompany.value) {
+    // Fetch the document if value is null
+    const companyDoc = await companiesCollection.findOne({ companyId: companyId });
+    if (!companyDoc) {
+      throw new Error('Error retrieving company data');
     }
+    updatedCompany.value = companyDoc;
+  }
 
-    console.log('Data Hash:', `0x${dataHash}`);
-    console.log('Is Fraudulent:', isFraudulent);
-    console.log('Company ID (bytes32):', companyIdBytes32);
+  // Calculate new risk score
+  const totalTransactions = updatedCompany.value.totalTransactions || 1;
+  const fraudulentTransactions = updatedCompany.value.fraudulentTransactions || 0;
+  const riskScore = (fraudulentTransactions / totalTransactions) * 100;
 
-    // Record transaction on blockchain
-    const tx = await contract.recordTransaction(`0x${dataHash}`, isFraudulent, companyIdBytes32);
-    await tx.wait();
+  // Update risk score
+  await companiesCollection.updateOne(
+    { companyId: companyId },
+    { $set: { riskScore: riskScore } }
+  );
+}
 
-    res.status(200).send({ success: true, txHash: tx.hash });
+app.post('/record-transaction', async (req, res) => {
+  try {
+    const txHash = await recordTransaction(req.body);
+    res.status(200).send({ success: true, txHash });
   } catch (error) {
     console.error('Error recording transaction:', error);
     res.status(500).send({ success: false, error: error.message });
   }
 });
 
+// Records a batch of transactions in order. Each one gets its own result, so a
+// failure only has to be retried for the transactions it affected
+app.post('/record-transactions', async (req, res) => {
+  const { transactions = [] } = req.body;
+  const results = [];
+
+  for (const transactionData of transactions) {
+    try {
+      const txHash = await recordTransaction(transactionData);
+      results.push({ success: true, txHash });
+    } catch (error) {
+      console.error('Error recording transaction:', error);
+      results.push({ success: false, error: error.message });
+    }
+  }
+
+  res.status(200).send({ success: true, results });
+});
+
 app.get('/companies/:companyId', async (req, res) => {
   const { companyId } = req.params;
 
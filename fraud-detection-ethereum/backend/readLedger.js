@@ -31,25 +31,34 @@ const provider = new ethers.providers.JsonRpcProvider(NETWORK_URL);
 // For read-only operations, signer is not necessary. You can omit the wallet.
 const contract = new ethers.Contract(CONTRACT_ADDRESS, contractAbi, provider);
 
-// Load company-address mapping
-const companyAddressMapFile = path.resolve(__dirname, '../../app/company_address_map.json');
+// Load company-address mapping, an append-only log with one JSON assignment per line
+const companyAddressLogFile = path.resolve(__dirname, '../../app/company_addresses.jsonl');
 let companyAddressMap = {};
 
 // Function to load company-address mappings
 function loadCompanyAddressMap() {
-  if (fs.existsSync(companyAddressMapFile)) {
+  if (!fs.existsSync(companyAddressLogFile)) {
+    console.warn(`Warning: ${companyAddressLogFile} not found. Sender addresses will be marked as 'N/A'.`);
+    companyAddressMap = {};
+    return;
+  }
+
+  const map = {};
+  const lines = fs.readFileSync(companyAddressLogFile, 'utf8').split('\n');
+  for (const line of lines) {
+    if (!line.trim()) continue;
     try {
-      const data = fs.readFileSync(companyAddressMapFile, 'utf8');
-      companyAddressMap = JSON.parse(data);
-      console.log(`Loaded company-address mappings for ${Object.keys(companyAddressMap).length} companies.`);
+      const { company, address } = JSON.parse(line);
+      // The first assignment a company got is the one that stands
+      if (!(company in map)) {
+        map[company] = address;
+      }
     } catch (error) {
-      console.error(`Error reading ${companyAddressMapFile}:`, error);
-      process.exit(1);
+      // A line cut short by a crash, skip it
     }
-  } else {
-    console.warn(`Warning: ${companyAddressMapFile} not found. Sender addresses will be marked as 'N/A'.`);
-    companyAddressMap = {};
   }
+  companyAddressMap = map;
+  console.log(`Loaded company-address mappings for ${Object.keys(companyAddressMap).length} companies.`);
 }
 
 // Initialize company-address mapping
@@ -67,6 +76,9 @@ function decodeBytes32(bytes32String) {
 
 async function readLedger() {
   try {
+    // Pick up companies that were given an address since the last read
+    loadCompanyAddressMap();
+
     const transactionCount = await contract.transactionCount();
     const count = transactionCount.toNumber();
     const ledger = [];
@@ -0,0 +1,68 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+
+from app.models import bundle
+from app.models.bundle import BundleError, ModelState, current_version, load_bundle, save_bundle
+
+COLUMNS = ['Amount', 'Hour', 'Amt_To_Hour_Zscore', 'Usual_Location']
+
+
+def make_state():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(200, len(COLUMNS)))
+    y = (X[:, 0] > 1).astype(int)
+    model = RandomForestClassifier(n_estimators=3, max_depth=3, random_state=0).fit(X, y)
+    amount_stats = pd.DataFrame({'amount_mean': [20.0, 30.0], 'amount_std': [5.0, 6.0]},
+                                index=pd.Index([9, 10], name='Hour'))
+    return ModelState.create(model, None, COLUMNS, {'credit_score': 650, 'age': 35}, 10, 2.0, ['Oviedo FL'],
+                             amount_stats)
+
+
+def test_load_checks_checksums_only_when_asked(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    version = save_bundle(make_state(), directory)
+
+    hashed = []
+    sha256 = bundle._sha256
+    monkeypatch.setattr(bundle, '_sha256', lambda path: hashed.append(path) or sha256(path))
+    assert load_bundle(directory).version == version
+    assert hashed == []
+
+    assert load_bundle(directory, verify=True).version == version
+    assert hashed
+
+    with open(os.path.join(directory, version, 'metadata.json'), 'a') as f:
+        f.write(' ')
+    with pytest.raises(BundleError):
+        load_bundle(directory, verify=True)
+
+
+def test_unreadable_bundle_is_a_bundle_error(tmp_path):
+    directory = str(tmp_path)
+    version = save_bundle(make_state(), directory)
+    with open(os.path.join(directory, version, 'model.joblib'), 'wb') as f:
+        f.write(b'not a model')
+
+    with pytest.raises(BundleError):
+        load_bundle(directory)
+
+
+def test_versions_are_utc_and_sort_after_the_current_one(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    first = save_bundle(make_state(), directory)
+    assert first[:15] <= time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+
+    # A bundle saved by a clock that was ahead, or in local time east of UTC
+    ahead = time.strftime('%Y%m%d-%H%M%S', time.gmtime(time.time() + 3600)) + '-00000000'
+    os.rename(os.path.join(directory, first), os.path.join(directory, ahead))
+    with open(os.path.join(directory, 'CURRENT'), 'w') as f:
+        f.write(ahead)
+
+    second = save_bundle(make_state(), directory)
+    assert second > ahead
+    assert current_version(directory) == second
@@ -0,0 +1,25 @@
+from fuzzywuzzy import fuzz, process
+
+from app.utils.company_index import CompanyIndex
+
+
+def extract_one(query, names):
+    return process.extractOne(query, names, scorer=fuzz.token_set_ratio, score_cutoff=80)
+
+
+def test_exact_match_loses_a_tie_to_an_earlier_name():
+    # 'acme' scores 100 against both, and extractOne keeps the first
+    names = ['Acme Holdings', 'Globex', 'ACME']
+    assert CompanyIndex(names).extract_one('acme') == extract_one('acme', names) == ('Acme Holdings', 100)
+
+    names = ['Acme', 'Acme Holdings']
+    assert CompanyIndex(names).extract_one('acme') == extract_one('acme', names) == ('Acme', 100)
+
+
+def test_fuzzy_ties_go_to_the_first_name_added():
+    names = ['Initech', 'Globex Corp', 'Corp Globex', 'Globex Co']
+    index = CompanyIndex(names)
+    for query in ['globex corp', 'globex cor', 'glbex', 'initech llc', 'unknown']:
+        assert index.extract_one(query) == extract_one(query, names)
+    assert index.extract_one('globex corp') == ('Globex Corp', 100)
+    assert index.extract_one('corp globex') == ('Globex Corp', 100)
@@ -0,0 +1,33 @@
+import numpy as np
+
+from app.models.engines import ForestEngine
+from app.models.feedback import refresh_forest
+
+
+def make_rows(n, seed):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, 4)).astype(np.float32)
+    y = (X[:, 0] + rng.normal(scale=0.5, size=n) > 1).astype(int)
+    return X, y
+
+
+def test_refresh_forest_fit_on_a_sample_bigger_than_the_window():
+    X, y = make_rows(2000, 0)
+    model = ForestEngine(n_estimators=20, max_samples=1000, n_jobs=1).fit(X, y)
+    # As a model saved before the sample size was reset after the fit has it
+    model.set_params(max_samples=1000)
+
+    window_X, window_y = make_rows(200, 1)
+    refreshed = refresh_forest(model, window_X, window_y, trees=5)
+
+    assert len(refreshed.estimators_) == 20
+    assert refreshed.estimators_[-1] not in model.estimators_
+    assert len(model.estimators_) == 20
+    assert refreshed.predict_proba(window_X).shape == (200, 2)
+
+
+def test_forest_engine_drops_sample_size_after_fit():
+    X, y = make_rows(2000, 0)
+    model = ForestEngine(n_estimators=5, max_samples=1000, n_jobs=1).fit(X, y)
+    assert model.max_samples is None
+    assert model.n_jobs is None
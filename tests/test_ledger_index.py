@@ -0,0 +1,239 @@
+import importlib
+from types import SimpleNamespace
+
+import pytest
+from web3 import Web3
+
+from app.utils.ledger_index import LedgerIndex
+
+
+def company(name):
+    return Web3.to_bytes(text=name).ljust(32, b'\x00')
+
+
+def data_hash(id):
+    return bytes([id]) * 32
+
+
+class FakeEvent:
+    '''
+    A contract event whose get_logs answers from a list of (block, args), and
+    refuses ranges wider than max_range blocks the way a node would
+    '''
+
+    def __init__(self, max_range=None):
+        self.logs = []
+        self.max_range = max_range
+        self.calls = []
+
+    def emit(self, block, **args):
+        self.logs.append((block, args))
+
+    def get_logs(self, from_block, to_block):
+        self.calls.append((from_block, to_block))
+        if self.max_range is not None and to_block - from_block + 1 > self.max_range:
+            raise ValueError("query returned more than 10000 results")
+        return [{'args': args, 'blockNumber': block} for block, args in self.logs if from_block <= block <= to_block]
+
+
+class FakeContract:
+    '''
+    Just enough of the FraudDetection contract for LedgerIndex: the two events and
+    the transactionCount/transactions views
+    '''
+
+    def __init__(self, max_range=None):
+        self.records = {}
+        self.block_number = 0
+        self.events = SimpleNamespace(TransactionRecorded=FakeEvent(max_range), FraudFlagged=FakeEvent(max_range))
+        self.functions = SimpleNamespace(
+            transactionCount=lambda: SimpleNamespace(call=lambda: len(self.records)),
+            transactions=lambda id: SimpleNamespace(call=lambda: self.records.get(id, (0, bytes(32), False, bytes(32))))
+        )
+        self.w3 = SimpleNamespace(eth=self)
+
+    def record(self, block, name, is_fraudulent=False, emit=True):
+        id = len(self.records) + 1
+        self.records[id] = (id, data_hash(id), is_fraudulent, company(name))
+        self.block_number = max(self.block_number, block)
+        if emit:
+            self.events.TransactionRecorded.emit(block, id=id, dataHash=data_hash(id),
+                                                 isFraudulent=is_fraudulent, companyId=company(name))
+        return id
+
+    def flag(self, block, id):
+        id, hash, _, company_id = self.records[id]
+        self.records[id] = (id, hash, True, company_id)
+        self.block_number = max(self.block_number, block)
+        self.events.FraudFlagged.emit(block, id=id)
+
+
+def make_index(tmp_path, contract, **kwargs):
+    return LedgerIndex(str(tmp_path / 'index.db'), contract, contract.w3, **kwargs)
+
+
+def test_sync_indexes_recorded_transactions(tmp_path):
+    contract = FakeContract()
+    contract.record(3, 'ACME')
+    contract.record(7, 'GLOBEX', is_fraudulent=True)
+    index = make_index(tmp_path, contract)
+
+    assert index.sync() == 2
+    assert index.get(1) == {"id": 1, "dataHash": '0x' + data_hash(1).hex(), "isFraudulent": False, "companyId": 'ACME'}
+    assert index.get(2)["isFraudulent"] is True
+    assert index.get(2)["companyId"] == 'GLOBEX'
+    assert index.sync() == 0
+
+
+def test_refused_range_is_shrunk(tmp_path):
+    contract = FakeContract(max_range=5)
+    for block in range(1, 41, 3):
+        contract.record(block, 'ACME')
+    index = make_index(tmp_path, contract, chunk_size=32)
+
+    index.sync()
+    calls = contract.events.TransactionRecorded.calls
+    # Every refused range was split until the node took it, and no block was skipped
+    taken = sorted(call for call in calls if call[1] - call[0] + 1 <= 5)
+    assert taken[0][0] == 0 and taken[-1][1] == contract.block_number
+    assert all(a[1] + 1 == b[0] for a, b in zip(taken, taken[1:]))
+    assert index.query()[1] == len(contract.records)
+
+
+def test_range_refused_for_a_single_block_raises(tmp_path):
+    contract = FakeContract(max_range=0)
+    contract.record(1, 'ACME')
+    index = make_index(tmp_path, contract)
+
+    with pytest.raises(ValueError):
+        index.sync()
+
+
+def test_fraud_flagged_updates_record(tmp_path):
+    contract = FakeContract()
+    id = contract.record(1, 'ACME')
+    index = make_index(tmp_path, contract)
+    index.sync()
+    assert index.get(id)["isFraudulent"] is False
+
+    contract.flag(5, id)
+    assert index.sync() == 1
+    assert index.get(id)["isFraudulent"] is True
+
+    # A record read again later doesn't clear the flag
+    index._store(id, data_hash(id), False, company('ACME'))
+    assert index.get(id)["isFraudulent"] is True
+
+
+def test_sync_resumes_from_stored_block(tmp_path):
+    contract = FakeContract()
+    contract.record(10, 'ACME')
+    index = make_index(tmp_path, contract, start_block=5)
+    index.sync()
+    assert contract.events.TransactionRecorded.calls[0][0] == 5
+    index.close()
+
+    contract.record(20, 'GLOBEX')
+    contract.events.TransactionRecorded.calls.clear()
+    index = make_index(tmp_path, contract, start_block=5)
+    assert index.sync() == 1
+    assert contract.events.TransactionRecorded.calls == [(11, 20)]
+    assert index.get(2)["companyId"] == 'GLOBEX'
+
+
+def test_records_without_events_are_read_from_contract(tmp_path):
+    contract = FakeContract()
+    contract.record(1, 'ACME', emit=False)
+    contract.record(2, 'GLOBEX')
+    contract.record(3, 'INITECH', emit=False)
+    index = make_index(tmp_path, contract)
+
+    index.sync()
+    assert [record["companyId"] for record in index.query()[0]] == ['ACME', 'GLOBEX', 'INITECH']
+
+
+def test_query_filters_and_pages(tmp_path):
+    contract = FakeContract()
+    for i in range(10):
+        contract.record(i + 1, 'ACME' if i % 2 else 'GLOBEX', is_fraudulent=i % 3 == 0)
+    index = make_index(tmp_path, contract)
+    index.sync()
+
+    records, total = index.query(offset=4, limit=3)
+    assert total == 10
+    assert [record["id"] for record in records] == [5, 6, 7]
+
+    records, total = index.query(company_id='ACME', is_fraudulent=True)
+    assert total == 2
+    assert [record["id"] for record in records] == [4, 10]
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # main reads the address list from the parent directory and keeps its files
+    # in the working directory, the way it's run from app/
+    (tmp_path / 'ethereum_addresses.txt').write_text('0x' + '11' * 20 + '\n')
+    (tmp_path / 'app').mkdir()
+    monkeypatch.chdir(tmp_path / 'app')
+    monkeypatch.setenv('MODEL_DIR', str(tmp_path / 'models'))
+    monkeypatch.setenv('VERDICT_CACHE_PATH', str(tmp_path / 'verdict_cache.db'))
+    monkeypatch.setenv('MERCHANT_STORE_PATH', str(tmp_path / 'merchants.db'))
+    monkeypatch.setenv('MERCHANT_VERIFIER', 'stub')
+    main = importlib.import_module('app.main')
+    # Opened again from the paths above rather than kept from an earlier test
+    api = importlib.import_module('app.utils.api')
+    monkeypatch.setattr(api, 'COMPANY_STORE', None)
+    monkeypatch.setattr(api, 'VERDICT_CACHE', None)
+    from fastapi.testclient import TestClient
+
+    contract = FakeContract()
+    for i in range(25):
+        contract.record(i + 1, 'ACME' if i < 15 else 'GLOBEX', is_fraudulent=i % 5 == 0)
+    index = make_index(tmp_path, contract)
+    monkeypatch.setattr(main, 'ledger_index', index)
+    monkeypatch.setattr(main, 'contract', contract, raising=False)
+    yield TestClient(main.app), contract
+    index.close()
+
+
+def test_get_all_transactions_pages_and_filters(client):
+    client, contract = client
+
+    body = client.get('/get-all-transactions', params={'offset': 10, 'limit': 10}).json()
+    assert body["total"] == 25
+    assert [record["id"] for record in body["transactions"]] == list(range(11, 21))
+
+    body = client.get('/get-all-transactions', params={'companyId': 'GLOBEX', 'isFraudulent': 'true'}).json()
+    assert [record["id"] for record in body["transactions"]] == [16, 21]
+
+    # Records added on the chain since the last request show up on the next one
+    contract.record(30, 'GLOBEX', is_fraudulent=True)
+    body = client.get('/get-all-transactions', params={'companyId': 'GLOBEX', 'isFraudulent': 'true'}).json()
+    assert [record["id"] for record in body["transactions"]] == [16, 21, 26]
+
+
+def test_get_all_transactions_rejects_bad_paging(client):
+    client, _ = client
+    assert client.get('/get-all-transactions', params={'limit': 0}).status_code == 400
+    assert client.get('/get-all-transactions', params={'offset': -1}).status_code == 400
+
+
+def test_get_transactions_reads_what_the_index_lacks_from_the_chain(client):
+    client, contract = client
+    client.get('/get-all-transactions')
+    contract.record(30, 'INITECH')
+
+    body = client.get('/get-transactions', params=[('ids', 3), ('ids', 26), ('ids', 99)]).json()
+    assert [record["id"] for record in body["transactions"]] == [3, 26]
+    assert body["transactions"][1]["companyId"] == 'INITECH'
+    assert client.get('/get-transaction/26').json()["transaction"]["companyId"] == 'INITECH'
+
+
+def test_merchant_checks_keep_their_stores_out_of_the_tree(client, tmp_path):
+    api = importlib.import_module('app.utils.api')
+    api.check_company_legitimacy('WALMART')
+    api.get_verdict_cache()
+
+    assert api.COMPANY_STORE.path == str(tmp_path / 'merchants.db')
+    assert (tmp_path / 'merchants.db').exists()
+    assert (tmp_path / 'verdict_cache.db').exists()
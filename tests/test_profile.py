@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+from app.models import profile as profile_module
+from app.models.profile import BehavioralProfile, LiveProfile
+
+
+def make_live(path):
+    base = BehavioralProfile()
+    base.update([9, 10, 10], [20.0, 30.0, 40.0], ['Oviedo FL'] * 3)
+    return LiveProfile(base, str(path), '20240101-000000-00000000')
+
+
+def test_failed_sync_keeps_the_delta(tmp_path, monkeypatch):
+    live = make_live(tmp_path / 'profile.json')
+    live.add(10, 50.0, 'Orlando FL')
+    live.add(11, 60.0, 'Orlando FL')
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(profile_module.json, 'dump', fail)
+    with pytest.raises(OSError):
+        live.sync()
+    assert live.pending == 2
+    assert not list(tmp_path.glob('*.tmp'))
+
+    # Added while the failed sync was running or after it, kept along with the rest
+    live.add(12, 70.0, 'Orlando FL')
+    monkeypatch.undo()
+    assert live.sync()
+    assert live.pending == 0
+    with open(tmp_path / 'profile.json') as f:
+        shared = BehavioralProfile.from_dict(json.load(f)['profile'])
+    assert shared.transactions == 6
+    assert live.transactions == 6
+
+
+def test_unwritable_profile_file_keeps_the_delta(tmp_path):
+    live = make_live(tmp_path / 'missing' / 'profile.json')
+    live.add(10, 50.0, 'Orlando FL')
+
+    with pytest.raises(OSError):
+        live.sync()
+    assert live.pending == 1
+    assert live.transactions == 4
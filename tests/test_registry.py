@@ -0,0 +1,70 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+from app.models import registry
+from app.models.registry import ModelRegistry
+
+
+class SlowRegistry(ModelRegistry):
+    '''
+    A registry whose bundles take a while to load, and counts the loads
+    '''
+
+    def __init__(self, root, delay=0.2):
+        super().__init__(root)
+        self.delay = delay
+        self.load_threads = []
+
+    def _load(self, user_id, version=None, verify=False):
+        self.load_threads.append(threading.get_ident())
+        time.sleep(self.delay)
+        with self.lock:
+            self.loads += 1
+        return SimpleNamespace(version='20240101000000000000', scorer=None, profile=None)
+
+
+def test_get_async_loads_once_off_the_event_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(registry, 'bundle_bytes', lambda directory, version: 1)
+    models = SlowRegistry(str(tmp_path))
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        states = await asyncio.gather(*(models.get_async('alice') for _ in range(5)))
+        ticker.cancel()
+        return states, ticks
+
+    states, ticks = asyncio.run(run())
+    assert models.loads == 1
+    assert all(state is states[0] for state in states)
+    assert models.load_threads[0] != threading.get_ident()
+    # The loop kept running while the bundle loaded
+    assert ticks >= 5
+    assert models.get('alice') is states[0]
+
+
+def test_cancelled_waiter_does_not_cancel_the_load(tmp_path, monkeypatch):
+    monkeypatch.setattr(registry, 'bundle_bytes', lambda directory, version: 1)
+    models = SlowRegistry(str(tmp_path))
+
+    async def run():
+        owner = asyncio.create_task(models.get_async('bob'))
+        await asyncio.sleep(0.05)
+        waiter = asyncio.create_task(models.get_async('bob'))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        return await owner
+
+    state = asyncio.run(run())
+    assert state is not None
+    assert models.loads == 1
+    assert 'bob' in models